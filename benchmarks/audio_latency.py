@@ -0,0 +1,179 @@
+"""Local loopback harness for mouth-to-ear audio latency.
+
+Runs a real ConferenceServer on localhost, a simulated microphone that produces
+16 kHz samples in real time, and a receiver socket. Each audio packet carries the
+capture time of its first sample, so the receiver can measure how long the oldest
+sample in the packet took to reach it.
+
+    python benchmarks/audio_latency.py [--seconds 5] [--frame-ms 20]
+
+'legacy' models the old sender: blocking read of 2048 samples followed by a
+50 ms sleep, played out through a 2048-sample output buffer. 'callback' models
+the current sender: frames of --frame-ms pushed by the capture callback into a
+ring buffer and sent immediately, played out through a one-frame output buffer.
+"""
+import argparse
+import base64
+import json
+import os
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from collections import deque
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from server import ConferenceServer
+
+RATE = 16000
+SAMPLE_BYTES = 2
+
+
+class SimulatedMicrophone:
+    """Produces samples at RATE from t0; tracks how many have been consumed."""
+    def __init__(self):
+        self.t0 = time.perf_counter()
+        self.consumed = 0
+
+    def read(self, frames):
+        """Blocking read, like stream_in.read(): returns (first_sample_time, payload)."""
+        ready_at = self.t0 + (self.consumed + frames) / RATE
+        delay = ready_at - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        first = self.t0 + self.consumed / RATE
+        self.consumed += frames
+        return first, b'\x00' * (frames * SAMPLE_BYTES)
+
+
+def start_relay(data_dir):
+    server = ConferenceServer(tcp_port=0, udp_port=0, file_store_dir=os.path.join(data_dir, 'files'),
+                              chat_log_path=os.path.join(data_dir, 'chat_history.db'))
+    server_thread = threading.Thread(target=server.start)
+    server_thread.daemon = True
+    server_thread.start()
+    while server.udp_socket.getsockname()[1] == 0:
+        time.sleep(0.01)
+    return server, server.udp_socket.getsockname()[1]
+
+
+def send_packet(sock, relay_addr, first_sample_time, payload):
+    message = json.dumps({
+        'type': 'audio_frame',
+        'username': 'talker',
+        'audio': base64.b64encode(payload).decode('utf-8'),
+        'capture_time': first_sample_time
+    })
+    sock.sendto(message.encode('utf-8'), relay_addr)
+
+
+def legacy_sender(sock, relay_addr, stop):
+    mic = SimulatedMicrophone()
+    while not stop.is_set():
+        first, payload = mic.read(2048)
+        send_packet(sock, relay_addr, first, payload)
+        time.sleep(0.05)
+
+
+def callback_sender(sock, relay_addr, stop, frame_samples):
+    mic = SimulatedMicrophone()
+    ring = deque(maxlen=50)
+    ready = threading.Event()
+
+    def capture():
+        # Stands in for the PyAudio callback thread
+        while not stop.is_set():
+            ring.append(mic.read(frame_samples))
+            ready.set()
+
+    capture_thread = threading.Thread(target=capture)
+    capture_thread.daemon = True
+    capture_thread.start()
+
+    while not stop.is_set():
+        try:
+            first, payload = ring.popleft()
+        except IndexError:
+            ready.clear()
+            if not ring:
+                ready.wait(0.1)
+            continue
+        send_packet(sock, relay_addr, first, payload)
+
+
+def run(mode, seconds, frame_samples, output_frames):
+    data_dir = tempfile.TemporaryDirectory(prefix='audio-latency-')
+    server, udp_port = start_relay(data_dir.name)
+    relay_addr = ('127.0.0.1', udp_port)
+
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.bind(('127.0.0.1', 0))
+    receiver.settimeout(0.5)
+    receiver.sendto(json.dumps({'type': 'register', 'username': 'listener'}).encode('utf-8'), relay_addr)
+
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sender.sendto(json.dumps({'type': 'register', 'username': 'talker'}).encode('utf-8'), relay_addr)
+    time.sleep(0.2)
+
+    stop = threading.Event()
+    if mode == 'legacy':
+        target, args = legacy_sender, (sender, relay_addr, stop)
+    else:
+        target, args = callback_sender, (sender, relay_addr, stop, frame_samples)
+    send_thread = threading.Thread(target=target, args=args)
+    send_thread.daemon = True
+    send_thread.start()
+
+    latencies = []
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        try:
+            data, _ = receiver.recvfrom(131072)
+        except socket.timeout:
+            continue
+        arrived = time.perf_counter()
+        message = json.loads(data.decode('utf-8'))
+        if message.get('type') == 'audio_frame':
+            latencies.append(arrived - message['capture_time'])
+
+    stop.set()
+    send_thread.join(1.0)
+    server.running = False
+    server.udp_socket.close()
+    server.tcp_socket.close()
+    server.chat_log.close()
+    data_dir.cleanup()
+    sender.close()
+    receiver.close()
+
+    playout = output_frames / RATE
+    return latencies, playout
+
+
+def report(mode, latencies, playout):
+    if not latencies:
+        print(f"{mode:>9}: no packets received")
+        return
+    ms = sorted(x * 1000 for x in latencies)
+    p95 = ms[int(len(ms) * 0.95) - 1]
+    print(f"{mode:>9}: packets={len(ms):5d}  capture->arrival p50={statistics.median(ms):6.1f} ms  "
+          f"p95={p95:6.1f} ms  mouth-to-ear p50={statistics.median(ms) + playout * 1000:6.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--seconds', type=float, default=5.0)
+    parser.add_argument('--frame-ms', type=int, default=20)
+    args = parser.parse_args()
+
+    frame_samples = RATE * args.frame_ms // 1000
+    latencies, playout = run('legacy', args.seconds, frame_samples, 2048)
+    report('legacy', latencies, playout)
+    latencies, playout = run('callback', args.seconds, frame_samples, frame_samples)
+    report('callback', latencies, playout)
+
+
+if __name__ == '__main__':
+    main()
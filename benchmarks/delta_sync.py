@@ -0,0 +1,134 @@
+"""Delta sync: bytes sent to re-share a new version of a large file after a small edit.
+
+Each scenario starts from a base version and applies one edit. Three ways of uploading
+the new version are compared:
+
+    full   every byte of the file
+    chunks the 256 KiB chunks whose hash changed (what the store deduplicates by itself)
+    delta  literal bytes plus copy frames against the base's block signature
+
+Sizes are in bytes; 'saved' is chunks over delta, and 'sig' is the signature the server sends
+down first. The times are for building the signature of the base (server side) and for scanning the
+new version against it (client side).
+
+    python benchmarks/delta_sync.py [--size-mb 64] [--file PATH]
+
+With --file the edits are applied to a copy of that file instead of the synthetic
+build binary and log.
+"""
+import argparse
+import io
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from delta import block_size_for, delta_cost, delta_ops, signature
+from protocol import pack_frame
+from transfer import CHUNK_SIZE, hash_bytes, split_chunks
+
+
+def synthetic_binary(size):
+    """Compiled-artifact-like bytes: repeating code-ish blocks with small variations, not compressible noise."""
+    rng = np.random.default_rng(1)
+    blocks = [rng.integers(0, 256, 4096, dtype=np.uint8).tobytes() for _ in range(64)]
+    picks = rng.integers(0, len(blocks), size // 4096 + 1)
+    data = bytearray(b''.join(blocks[i] for i in picks)[:size])
+    # Addresses that differ per function, so blocks are not literally repeated
+    offsets = rng.integers(0, size - 4, size // 512)
+    values = rng.integers(0, 1 << 32, len(offsets), dtype=np.uint32)
+    view = np.frombuffer(data, dtype=np.uint8)
+    for offset, value in zip(offsets.tolist(), values.tolist()):
+        view[offset:offset + 4] = np.frombuffer(value.to_bytes(4, 'little'), dtype=np.uint8)
+    return bytes(data)
+
+
+def synthetic_log(size):
+    rng = np.random.default_rng(2)
+    log = io.StringIO()
+    i = 0
+    while log.tell() < size:
+        log.write(f"2026-10-19 12:{i // 60 % 60:02d}:{i % 60:02d}.{i % 1000:03d} worker-{i % 8} "
+                  f"request id={rng.integers(1 << 32):08x} path=/api/v1/items/{i % 5000} took={rng.integers(1, 900)} ms\n")
+        i += 1
+    return log.getvalue().encode('utf-8')[:size]
+
+
+def edits(data):
+    """(name, new version) pairs: small edits at realistic places."""
+    middle = len(data) // 2
+    return [
+        ('insert 16 B', data[:middle] + os.urandom(16) + data[middle:]),
+        ('overwrite 4 KB', data[:middle] + os.urandom(4096) + data[middle + 4096:]),
+        ('delete 1 KB', data[:middle] + data[middle + 1024:]),
+        ('append 64 KB', data + os.urandom(65536)),
+        ('prepend 100 B', os.urandom(100) + data),
+        ('10 scattered', scattered(data, 10)),
+    ]
+
+
+def scattered(data, count):
+    rng = np.random.default_rng(3)
+    new = bytearray(data)
+    for offset in sorted(rng.integers(0, len(data) - 64, count).tolist(), reverse=True):
+        new[offset:offset + 32] = os.urandom(48)
+    return bytes(new)
+
+
+def chunk_upload_bytes(base, new):
+    stored = {hash_bytes(chunk) for chunk in split_chunks(base)}
+    return sum(len(chunk) for chunk in split_chunks(new) if hash_bytes(chunk) not in stored)
+
+
+def delta_upload(base_path, new_path, size):
+    """(bytes on the wire, signature seconds, scan seconds, signature bytes)."""
+    block_size = block_size_for(size)
+    start = time.perf_counter()
+    packed = signature([base_path], block_size)
+    signature_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    ops = list(delta_ops(new_path, packed, block_size))
+    scan_time = time.perf_counter() - start
+    literal, _ = delta_cost(ops, block_size)
+    frames = sum(len(pack_frame({'copy': [op[1], op[2]]})) for op in ops if op[0] == 'copy')
+    frames += sum(len(pack_frame({'literal': True})) * -(-op[2] // CHUNK_SIZE) for op in ops if op[0] == 'literal')
+    return literal + frames, signature_time, scan_time, len(packed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size-mb', type=float, default=64)
+    parser.add_argument('--file', help='file to edit (default: synthetic build binary and log)')
+    args = parser.parse_args()
+
+    size = int(args.size_mb * 1024 * 1024)
+    if args.file:
+        with open(args.file, 'rb') as f:
+            files = [(os.path.basename(args.file), f.read())]
+    else:
+        files = [('build.bin', synthetic_binary(size)), ('server.log', synthetic_log(size))]
+
+    print(f"{'file':<12} {'edit':<15} {'full':>10} {'chunks':>10} {'delta':>10} "
+          f"{'saved':>7} {'sig':>8} {'sig ms':>7} {'scan ms':>8}")
+    with tempfile.TemporaryDirectory() as directory:
+        base_path = os.path.join(directory, 'base')
+        new_path = os.path.join(directory, 'new')
+        for name, base in files:
+            with open(base_path, 'wb') as f:
+                f.write(base)
+            for edit, new in edits(base):
+                with open(new_path, 'wb') as f:
+                    f.write(new)
+                chunk_bytes = chunk_upload_bytes(base, new)
+                wire_bytes, signature_time, scan_time, signature_bytes = delta_upload(base_path, new_path, len(base))
+                print(f"{name[:12]:<12} {edit:<15} {len(new):>10} {chunk_bytes:>10} "
+                      f"{wire_bytes:>10} {chunk_bytes / max(wire_bytes, 1):6.0f}x {signature_bytes:>8} "
+                      f"{signature_time * 1000:7.0f} {scan_time * 1000:8.0f}")
+
+
+if __name__ == '__main__':
+    main()
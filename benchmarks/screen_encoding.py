@@ -0,0 +1,141 @@
+"""Screen-share encoding: bytes per frame and quality on a screenshot corpus.
+
+Compares the old encoder (whole frame scaled to 1280x720, JPEG quality 80) with
+the content-aware TileEncoder at native resolution (PNG for text/UI tiles, JPEG
+for photo/video tiles). Quality is PSNR against the native screenshot after the
+viewer's decode, with the old output scaled back up to native size as a viewer
+window would show it.
+
+    python benchmarks/screen_encoding.py [--corpus DIR] [--quality 80]
+
+DIR holds PNG/JPEG screenshots (IDE, slides, video...). Without --corpus a
+small synthetic corpus is generated: a code editor, a slide and a video frame.
+For each screenshot the harness also encodes a one-line edit and then a scroll
+of a few lines to show delta-frame cost.
+"""
+import argparse
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from codec import TileEncoder, TileCanvas
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp')
+
+
+def synthetic_corpus(width=1920, height=1080):
+    rng = np.random.default_rng(1)
+
+    ide = np.full((height, width, 3), (30, 30, 30), dtype=np.uint8)
+    ide[:, :260] = (40, 40, 45)
+    for line, y in enumerate(range(40, height - 10, 22)):
+        indent = 300 + 32 * (line % 5)
+        text = f"{line + 1:4d}  def handler_{line}(self, request): return self.route(request, {line * 7})"
+        cv2.putText(ide, text, (indent, y), cv2.FONT_HERSHEY_SIMPLEX, 0.55, (212, 212, 170), 1, cv2.LINE_AA)
+        cv2.putText(ide, f"file_{line % 30}.py", (20, y), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (180, 180, 180), 1, cv2.LINE_AA)
+
+    slide = np.zeros((height, width, 3), dtype=np.uint8)
+    slide[:] = np.linspace(250, 200, width, dtype=np.uint8)[None, :, None]
+    cv2.putText(slide, "Quarterly results", (160, 200), cv2.FONT_HERSHEY_DUPLEX, 3, (60, 40, 20), 4, cv2.LINE_AA)
+    for i in range(6):
+        cv2.putText(slide, f"- Bullet point number {i + 1} with some detail", (200, 360 + 90 * i),
+                    cv2.FONT_HERSHEY_SIMPLEX, 1.5, (40, 40, 40), 2, cv2.LINE_AA)
+    photo = cv2.GaussianBlur(rng.integers(0, 255, (360, 540, 3), dtype=np.uint8), (31, 31), 0)
+    slide[600:960, 1250:1790] = cv2.normalize(photo, None, 0, 255, cv2.NORM_MINMAX)
+
+    yy, xx = np.mgrid[0:height, 0:width]
+    video = np.stack([(xx * 255 // width), (yy * 255 // height), ((xx + yy) * 127 // (width + height))], axis=2)
+    video = video.astype(np.int16) + rng.normal(0, 12, (height, width, 3)).astype(np.int16)
+    video = cv2.GaussianBlur(np.clip(video, 0, 255).astype(np.uint8), (5, 5), 0)
+
+    return [('ide', ide), ('slide', slide), ('video', video)]
+
+
+def load_corpus(directory):
+    corpus = []
+    for name in sorted(os.listdir(directory)):
+        if name.lower().endswith(IMAGE_EXTENSIONS):
+            image = cv2.imread(os.path.join(directory, name), cv2.IMREAD_COLOR)
+            if image is not None:
+                corpus.append((name, image))
+    return corpus
+
+
+def psnr(reference, decoded):
+    mse = np.mean((reference.astype(np.float64) - decoded.astype(np.float64)) ** 2)
+    if mse == 0:
+        return float('inf')
+    return 10 * np.log10(255.0 ** 2 / mse)
+
+
+def legacy(image, quality):
+    height, width = image.shape[:2]
+    scaled = cv2.resize(image, (1280, 720), interpolation=cv2.INTER_AREA)
+    ok, buffer = cv2.imencode('.jpg', scaled, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    decoded = cv2.imdecode(buffer, cv2.IMREAD_COLOR)
+    return len(buffer), psnr(image, cv2.resize(decoded, (width, height), interpolation=cv2.INTER_LINEAR))
+
+
+def content_aware(image, quality):
+    encoder = TileEncoder(quality=quality)
+    canvas = TileCanvas()
+
+    start = time.perf_counter()
+    header, payload = encoder.encode(image)
+    keyframe_ms = (time.perf_counter() - start) * 1000
+    canvas.apply(header, payload)
+    result = {
+        'keyframe_bytes': len(payload),
+        'keyframe_psnr': psnr(image, canvas.render()),
+        'keyframe_ms': keyframe_ms,
+        'base': 'png' if payload[:4] == b'\x89PNG' else 'jpeg',
+        'overlay_tiles': len(header.get('tiles', [])),
+    }
+
+    # A small edit (one line of text typed) and a scroll by three lines
+    edited = image.copy()
+    cv2.putText(edited, "value = compute(42)", (320, 128), cv2.FONT_HERSHEY_SIMPLEX, 0.55, (255, 255, 255), 1, cv2.LINE_AA)
+    for name, frame in (('edit', edited), ('scroll', np.roll(edited, -66, axis=0))):
+        encoded = encoder.encode(frame)
+        if encoded:
+            canvas.apply(*encoded)
+        result[name] = (encoded[0]['action'] if encoded else '-', len(encoded[1]) if encoded else 0,
+                        psnr(frame, canvas.render()))
+    return result
+
+
+def format_delta(delta):
+    action, size, quality = delta
+    return f"{action:>6} {size / 1024:7.1f} KB {quality:6.2f} dB"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--corpus', help='directory of screenshots (default: synthetic samples)')
+    parser.add_argument('--quality', type=int, default=80)
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.corpus) if args.corpus else synthetic_corpus()
+    if not corpus:
+        print("No screenshots found")
+        return
+
+    print(f"{'screenshot':<24} {'size':>10} | {'legacy 720p jpeg':>20} | {'content-aware native keyframe':>38} | "
+          f"{'edit':>24} | {'scroll':>24}")
+    for name, image in corpus:
+        height, width = image.shape[:2]
+        legacy_bytes, legacy_psnr = legacy(image, args.quality)
+        result = content_aware(image, args.quality)
+        print(f"{name[:24]:<24} {width:>4}x{height:<5} | "
+              f"{legacy_bytes / 1024:7.1f} KB {legacy_psnr:6.2f} dB | "
+              f"{result['keyframe_bytes'] / 1024:7.1f} KB {result['keyframe_psnr']:6.2f} dB "
+              f"{result['base']:>4}+{result['overlay_tiles']:<3} {result['keyframe_ms']:5.0f} ms | "
+              f"{format_delta(result['edit'])} | {format_delta(result['scroll'])}")
+
+
+if __name__ == '__main__':
+    main()
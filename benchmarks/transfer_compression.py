@@ -0,0 +1,141 @@
+"""File transfer compression: effective throughput on a mix of text and binary artifacts.
+
+For each file and codec the harness measures the compressed size and the time to
+compress and decompress it chunk by chunk, as the upload path does. Effective
+throughput is file bytes delivered per second over a link of the given speed.
+Compression, the wire and decompression overlap in the pipeline, so the slowest
+of the three sets the pace. The 'auto' row shows what choose_compression picks
+from an entropy sample of the first chunk.
+
+    python benchmarks/transfer_compression.py [--files DIR] [--link-mbps 100 1000]
+
+DIR holds the artifacts to measure. Without --files a synthetic mix is
+generated: a server log, a CSV export, a source tarball, the same tarball
+gzipped, random bytes (think encrypted or media data) and a float array dump.
+"""
+import argparse
+import gzip
+import io
+import os
+import sys
+import tarfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from transfer import (CHUNK_SIZE, COMPRESSION_CODECS, byte_entropy, choose_compression, compress_chunk,
+                      decompress_chunk, split_chunks)
+
+
+def synthetic_artifacts(size=8 * 1024 * 1024):
+    rng = np.random.default_rng(1)
+
+    levels = ['INFO', 'INFO', 'INFO', 'DEBUG', 'WARN', 'ERROR']
+    log = io.StringIO()
+    i = 0
+    while log.tell() < size:
+        log.write(f"2026-10-19 12:{i // 60 % 60:02d}:{i % 60:02d}.{i % 1000:03d} {levels[i % 6]:<5} "
+                  f"worker-{i % 8} request id={rng.integers(1 << 32):08x} path=/api/v1/items/{i % 5000} "
+                  f"status={200 if i % 17 else 500} took={rng.integers(1, 900)} ms\n")
+        i += 1
+
+    csv = io.StringIO()
+    csv.write("id,timestamp,region,product,quantity,unit_price,total\n")
+    i = 0
+    while csv.tell() < size:
+        quantity, price = int(rng.integers(1, 50)), float(rng.uniform(1, 500))
+        csv.write(f"{i},2026-10-{i % 28 + 1:02d}T{i % 24:02d}:00:00,region-{i % 12},SKU-{i % 3000:05d},"
+                  f"{quantity},{price:.2f},{quantity * price:.2f}\n")
+        i += 1
+
+    root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+    tar_buffer = io.BytesIO()
+    with tarfile.open(fileobj=tar_buffer, mode='w') as tar:
+        for directory, _, names in os.walk(root):
+            if '.git' in directory:
+                continue
+            for name in sorted(names):
+                if name.endswith(('.py', '.md', '.txt', '.json', '.jsonl')):
+                    tar.add(os.path.join(directory, name), arcname=os.path.relpath(os.path.join(directory, name), root))
+    source_tar = tar_buffer.getvalue()
+
+    floats = np.cumsum(rng.normal(0, 1, size // 8)).astype(np.float64).tobytes()
+
+    return [
+        ('server.log', log.getvalue().encode('utf-8')[:size]),
+        ('export.csv', csv.getvalue().encode('utf-8')[:size]),
+        ('source.tar', source_tar),
+        ('source.tar.gz', gzip.compress(source_tar)),
+        ('random.bin', os.urandom(size)),
+        ('floats.npy', floats),
+    ]
+
+
+def load_artifacts(directory):
+    artifacts = []
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if os.path.isfile(path):
+            with open(path, 'rb') as f:
+                artifacts.append((name, f.read()))
+    return artifacts
+
+
+def measure(data, codec):
+    """(bytes on the wire, compress seconds, decompress seconds) for chunked transfer of data."""
+    chunks = split_chunks(data)
+    if codec is None:
+        return len(data), 0.0, 0.0
+
+    start = time.perf_counter()
+    compressed = [compress_chunk(codec, chunk) for chunk in chunks]
+    compress_time = time.perf_counter() - start
+    # Chunks that don't shrink go as they are, like the upload path sends them
+    payloads = [(c, True) if len(c) < len(chunk) else (chunk, False) for c, chunk in zip(compressed, chunks)]
+
+    start = time.perf_counter()
+    for payload, is_compressed in payloads:
+        if is_compressed:
+            decompress_chunk(codec, payload, CHUNK_SIZE)
+    decompress_time = time.perf_counter() - start
+    return sum(len(payload) for payload, _ in payloads), compress_time, decompress_time
+
+
+def effective_throughput(size, wire_bytes, compress_time, decompress_time, link_mbps):
+    """File MB/s delivered when compression, transfer and decompression run as a pipeline."""
+    wire_time = wire_bytes * 8 / (link_mbps * 1e6)
+    return size / max(compress_time, wire_time, decompress_time, 1e-9) / 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--files', help='directory of artifacts (default: synthetic mix)')
+    parser.add_argument('--link-mbps', type=float, nargs='+', default=[100, 1000])
+    args = parser.parse_args()
+
+    artifacts = load_artifacts(args.files) if args.files else synthetic_artifacts()
+    if not artifacts:
+        print("No files found")
+        return
+
+    links = ''.join(f" {f'{mbps:g} Mbit/s':>13}" for mbps in args.link_mbps)
+    print(f"{'file':<16} {'size':>9} {'entropy':>7} {'codec':>6} {'ratio':>6} {'comp MB/s':>9} "
+          f"{'decomp MB/s':>11} |{links}")
+    for name, data in artifacts:
+        size = len(data)
+        entropy = byte_entropy(data[:CHUNK_SIZE])
+        auto = choose_compression(data[:CHUNK_SIZE])
+        for label, codec in [('none', None)] + [(c, c) for c in COMPRESSION_CODECS] + [('auto', auto)]:
+            wire_bytes, compress_time, decompress_time = measure(data, codec)
+            rates = ''.join(
+                f" {effective_throughput(size, wire_bytes, compress_time, decompress_time, mbps):8.1f} MB/s"
+                for mbps in args.link_mbps)
+            shown = f"{label}" if label != 'auto' else f"={codec or 'none'}"
+            print(f"{name[:16]:<16} {size / 1e6:7.2f}MB {entropy:7.2f} {shown:>6} {size / wire_bytes:6.2f} "
+                  f"{size / max(compress_time, 1e-9) / 1e6 if codec else 0:9.1f} "
+                  f"{size / max(decompress_time, 1e-9) / 1e6 if codec else 0:11.1f} |{rates}")
+
+
+if __name__ == '__main__':
+    main()
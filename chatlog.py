@@ -0,0 +1,109 @@
+import sqlite3
+import threading
+import time
+
+# Chat history kept by the server in SQLite, so late joiners and reconnecting clients can page back
+# through it. WAL mode lets pages be read while messages are appended; nothing is held in memory
+# beyond SQLite's page cache, however long the session runs. Messages are indexed by room and id
+# (ids increase with time), by sender and by recipient, and their text by an FTS5 index when
+# the SQLite build has it.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    room TEXT NOT NULL,
+    time REAL NOT NULL,
+    sender TEXT NOT NULL,
+    recipient TEXT NOT NULL,
+    message TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_room ON messages (room, id);
+CREATE INDEX IF NOT EXISTS messages_time ON messages (room, time);
+CREATE INDEX IF NOT EXISTS messages_sender ON messages (sender, id);
+CREATE INDEX IF NOT EXISTS messages_recipient ON messages (recipient, id);
+"""
+
+FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(message, content='messages', content_rowid='id');
+CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+    INSERT INTO messages_fts (rowid, message) VALUES (new.id, new.message);
+END;
+"""
+
+class ChatLog:
+    """Append-only chat log. Public messages have recipient 'everyone'; private ones are visible
+    to their sender and recipient only. Pages are fetched newest first by id (keyset paging), so
+    each page costs the same however far back it is."""
+    def __init__(self, path, room='main'):
+        self.room = room
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+        try:
+            self.db.executescript(FTS_SCHEMA)
+            self.fts = True
+        except sqlite3.OperationalError:
+            print("SQLite has no FTS5, chat search falls back to substring matching")
+            self.fts = False
+        self.db.commit()
+    
+    def append(self, sender, recipient, message, timestamp=None):
+        """Store a message. Returns its row as sent to clients, with the id assigned to it."""
+        row = {
+            'timestamp': timestamp or time.time(),
+            'from': sender,
+            'recipient': recipient,
+            'message': message
+        }
+        with self.lock:
+            cursor = self.db.execute(
+                "INSERT INTO messages (room, time, sender, recipient, message) VALUES (?, ?, ?, ?, ?)",
+                (self.room, row['timestamp'], sender, recipient, message))
+            self.db.commit()
+        row['id'] = cursor.lastrowid
+        return row
+    
+    def history(self, username, before=None, limit=50, query=None, participant=None):
+        """(messages, has_more): up to limit messages username can see, older than id `before`,
+        oldest first. query filters by full-text match, participant by sender or recipient."""
+        conditions = ["m.room = ?", "(m.recipient = 'everyone' OR m.recipient = ? OR m.sender = ?)"]
+        params = [self.room, username, username]
+        tables = "messages m"
+        if before is not None:
+            conditions.append("m.id < ?")
+            params.append(before)
+        if participant:
+            conditions.append("(m.sender = ? OR m.recipient = ?)")
+            params += [participant, participant]
+        if query:
+            if self.fts:
+                tables += " JOIN messages_fts f ON f.rowid = m.id"
+                conditions.append("messages_fts MATCH ?")
+                params.append(fts_query(query))
+            else:
+                conditions.append("m.message LIKE ?")
+                params.append(f"%{query}%")
+        sql = (f"SELECT m.id, m.time, m.sender, m.recipient, m.message FROM {tables} "
+               f"WHERE {' AND '.join(conditions)} ORDER BY m.id DESC LIMIT ?")
+        with self.lock:
+            rows = self.db.execute(sql, params + [limit + 1]).fetchall()
+        messages = [{'id': row[0], 'timestamp': row[1], 'from': row[2], 'recipient': row[3], 'message': row[4]}
+                    for row in rows[:limit]]
+        messages.reverse()
+        return messages, len(rows) > limit
+    
+    def count(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM messages WHERE room = ?", (self.room,)).fetchone()[0]
+    
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+def fts_query(text):
+    """Search text as an FTS5 query: every word must appear, the last one as a prefix.
+    Words are quoted so punctuation in chat never reads as query syntax."""
+    terms = ['"' + word.replace('"', '""') + '"' for word in text.split()] or ['""']
+    terms[-1] += '*'
+    return ' '.join(terms)
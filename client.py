@@ -7,12 +7,1027 @@ from PyQt6.QtGui import *
 import cv2
 import pyaudio
 import base64
+import hashlib
+import itertools
+import secrets
 import time
 from PIL import Image
 import numpy as np
 from mss import mss
 import sys
 import os
+import queue
+from collections import deque
+from codec import TileEncoder, TileCanvas, decode_reduction, decode_image
+from protocol import pack_frame, read_frame
+from transfer import (hash_bytes, hash_file, iter_file_chunks, choose_compression, compress_chunk, decompressor, send_stream,
+                      CHUNK_SIZE, COMPRESSION_CODECS, COMPRESSION_SAMPLE)
+from delta import delta_ops, delta_cost
+
+# Upload and download ids share one sequence so progress updates can't be confused
+TRANSFER_IDS = itertools.count(1)
+
+AUDIO_RATE = 16000
+AUDIO_FRAME_MS = 20
+AUDIO_JITTER_TARGET = 2  # frames buffered per sender before playout starts
+CURSOR_ARROW = [(0, 0), (0, 17), (4, 13), (7, 20), (10, 19), (7, 12), (12, 12)]  # presenter cursor outline, hotspot at 0,0
+
+class AudioRingBuffer:
+    """Fixed-size ring of captured audio frames shared by the PyAudio callback and the sender thread.
+    deque.append/popleft are atomic, so the capture callback never blocks on a lock; the oldest
+    frame is overwritten if the sender falls behind.
+    """
+    def __init__(self, capacity=50):
+        self.frames = deque(maxlen=capacity)
+        self.ready = threading.Event()
+    
+    def push(self, frame):
+        self.frames.append(frame)
+        self.ready.set()
+    
+    def pop(self, timeout=0.1):
+        while True:
+            try:
+                return self.frames.popleft()
+            except IndexError:
+                self.ready.clear()
+                # Re-check after clearing so a push racing with clear() isn't missed
+                if self.frames:
+                    continue
+                if not self.ready.wait(timeout):
+                    return None
+    
+    def clear(self):
+        self.frames.clear()
+        self.ready.clear()
+
+class AudioJitterBuffer:
+    """Per-sender playout buffer keyed by sequence number.
+    Each playout tick pops exactly one frame: the expected packet if it arrived in time, otherwise a
+    concealment frame (last frame repeated with a fade). Packets arriving after their slot are dropped.
+    """
+    def __init__(self, target_depth=AUDIO_JITTER_TARGET, max_conceal=5, fade=0.5):
+        self.lock = threading.Lock()
+        self.packets = {}
+        self.next_seq = None
+        self.target_depth = target_depth
+        self.max_conceal = max_conceal
+        self.fade = fade
+        self.last_frame = None
+        self.conceal_count = 0
+        # Sender capture time of the frame most recently handed to playout
+        self.playout_ts = None
+        self.stats = {'received': 0, 'late': 0, 'lost': 0, 'concealed': 0}
+    
+    def put(self, seq, pcm, ts=None):
+        with self.lock:
+            if self.next_seq is not None and seq < self.next_seq:
+                if self.next_seq - seq > 50:
+                    # Sender restarted its sequence numbers; start a new talkspurt
+                    self._reset()
+                else:
+                    self.stats['late'] += 1
+                    return False
+            self.packets[seq] = (pcm, ts)
+            self.stats['received'] += 1
+            # Keep latency bounded if packets pile up (burst or clock drift)
+            if self.next_seq is not None and len(self.packets) > self.target_depth + 4:
+                newest = max(self.packets)
+                self.next_seq = newest - self.target_depth + 1
+                for old in [s for s in self.packets if s < self.next_seq]:
+                    del self.packets[old]
+            return True
+    
+    def pop(self):
+        """Return the next int16 frame for playout, or None while idle/prebuffering."""
+        with self.lock:
+            if self.next_seq is None:
+                if len(self.packets) < self.target_depth:
+                    return None
+                self.next_seq = min(self.packets)
+            
+            packet = self.packets.pop(self.next_seq, None)
+            self.next_seq += 1
+            if packet is not None:
+                frame, ts = packet
+                self.last_frame = frame
+                self.conceal_count = 0
+                self.playout_ts = ts
+                return frame
+            
+            # Gap in the sequence, or the packet missed its playout deadline
+            self.stats['lost'] += 1
+            if self.playout_ts is not None and self.last_frame is not None:
+                self.playout_ts += len(self.last_frame) / AUDIO_RATE
+            if self.last_frame is None or self.conceal_count >= self.max_conceal:
+                if not self.packets:
+                    # Talkspurt ended; prebuffer again before the next one
+                    self._reset()
+                    return None
+                return np.zeros_like(self.last_frame) if self.last_frame is not None else None
+            return self._conceal()
+    
+    def _conceal(self):
+        self.stats['concealed'] += 1
+        start = self.fade ** self.conceal_count
+        self.conceal_count += 1
+        end = self.fade ** self.conceal_count
+        ramp = np.linspace(start, end, len(self.last_frame), dtype=np.float32)
+        return (self.last_frame.astype(np.float32) * ramp).astype(np.int16)
+    
+    def _reset(self):
+        self.packets.clear()
+        self.next_seq = None
+        self.last_frame = None
+        self.conceal_count = 0
+        self.playout_ts = None
+
+class AVSyncController:
+    """Per-sender lip-sync: maps the sender's capture clock onto local time through audio playout and
+    holds video frames until the audio captured at the same instant is being heard."""
+    def __init__(self, max_hold=0.5):
+        self.max_hold = max_hold
+        self.audio_ts = None
+        self.audio_wall = None
+        self.offset_ms = None
+    
+    def on_audio_played(self, ts, wall, output_latency=0.0):
+        """Record that audio captured at sender time ts will be heard at local time wall + latency."""
+        if ts is None:
+            return
+        self.audio_ts = ts
+        self.audio_wall = wall + output_latency
+    
+    def audio_clock(self, now):
+        """Sender capture time of the audio being heard now, or None without recent audio."""
+        if self.audio_wall is None or now - self.audio_wall > 0.5:
+            return None
+        return self.audio_ts + (now - self.audio_wall)
+    
+    def render_delay(self, video_ts, now):
+        clock = self.audio_clock(now)
+        if video_ts is None or clock is None:
+            return 0.0
+        return min(max(video_ts - clock, 0.0), self.max_hold)
+    
+    def on_video_rendered(self, video_ts, now):
+        clock = self.audio_clock(now)
+        if video_ts is None or clock is None:
+            return
+        offset = (video_ts - clock) * 1000
+        self.offset_ms = offset if self.offset_ms is None else self.offset_ms + 0.1 * (offset - self.offset_ms)
+
+def put_latest(q, item):
+    """Put into a bounded queue, discarding the oldest entry instead of blocking when it is full."""
+    while True:
+        try:
+            q.put_nowait(item)
+            return
+        except queue.Full:
+            try:
+                q.get_nowait()
+            except queue.Empty:
+                pass
+
+class ScreenSharePipeline:
+    """Presenter pipeline: capture -> convert -> encode -> send, one thread per stage.
+    OpenCV releases the GIL during colour conversion, resizing and JPEG encoding, so the stages overlap.
+    Stale frames are dropped before encoding (the tile encoder must see every frame it diffs against),
+    and converted frames are written into a small pool of reused buffers instead of fresh copies.
+    A buffer goes back to the pool only once the encoder is done with it (or the frame is dropped
+    unencoded); when all are in use the newest capture is skipped. The local preview is built only while
+    it is on screen, at the size it is shown, into a second pool the GUI hands back after painting.
+    Frames go out at native resolution while the link keeps up, and are scaled down to max_size
+    while capture keeps stalling on unacknowledged frames. Each tier (full view, nav-bar thumbnail)
+    is encoded only while the relay reports a viewer for it.
+    """
+    def __init__(self, client, max_size=(1920, 1080), fps=30, pool_size=4, resolution_hold=5.0,
+                 thumb_size=(320, 180), thumb_fps=5):
+        self.client = client
+        self.max_size = max_size
+        self.native = True
+        self.stall = 0.0
+        self.resolution_hold = resolution_hold
+        self.resolution_changed_at = time.monotonic()
+        self.interval = 1.0 / fps
+        self.pool_size = pool_size
+        # Free frame buffers, all of pool_shape; taken by convert, returned by encode
+        self.pool = []
+        self.pool_shape = None
+        self.pool_lock = threading.Lock()
+        self.scratch = None
+        # Free preview buffers of preview_shape; taken by convert, returned by the GUI once painted
+        self.previews = []
+        self.preview_buffers = []
+        self.preview_shape = None
+        self.convert_queue = queue.Queue(maxsize=1)
+        self.encode_queue = queue.Queue(maxsize=1)
+        self.send_queue = queue.Queue(maxsize=2)
+        self.encoders = {'full': TileEncoder(), 'thumb': TileEncoder()}
+        self.tiers = set()
+        self.thumb_size = thumb_size
+        self.thumb_interval = 1.0 / thumb_fps
+        self.last_thumb = 0.0
+        self.frame_count = 0
+        self.error = None
+    
+    def active(self):
+        return self.error is None and self.client.screen_share_enabled and self.client.running
+    
+    def run(self):
+        self.client.screen_encoders = self.encoders
+        self.client.screen_pipeline = self
+        stages = [self.capture_stage, self.convert_stage, self.encode_stage, self.send_stage]
+        threads = []
+        for stage in stages:
+            thread = threading.Thread(target=self._run_stage, args=(stage,))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        print(f"[INFO] Screen share stopped. Sent {self.frame_count} frames")
+        if self.error is not None:
+            raise self.error
+    
+    def _run_stage(self, stage):
+        try:
+            stage()
+        except Exception as e:
+            if self.error is None:
+                self.error = e
+    
+    def open_grabber(self):
+        """Return a function grabbing the screen as (array, cvtColor code). mss on every platform;
+        PIL ImageGrab only where mss can't open the display."""
+        try:
+            sct = mss()
+            try:
+                monitor = sct.monitors[1]
+            except:
+                monitor = sct.monitors[0]
+            print(f"[INFO] Capturing monitor with mss: {monitor}")
+            self.client.screen_capture_area = (monitor['left'], monitor['top'], monitor['width'], monitor['height'])
+            return lambda: (np.asarray(sct.grab(monitor)), cv2.COLOR_BGRA2BGR)
+        except Exception as e:
+            from PIL import ImageGrab
+            print(f"[INFO] mss unavailable ({e}), using PIL ImageGrab")
+            width, height = ImageGrab.grab().size
+            self.client.screen_capture_area = (0, 0, width, height)
+            return lambda: (np.asarray(ImageGrab.grab().convert('RGB')), cv2.COLOR_RGB2BGR)
+    
+    def capture_stage(self):
+        grab = self.open_grabber()
+        next_capture = time.monotonic()
+        # Capture only once the link has drained (see wait_for_screen_window), so frames are never stale
+        while True:
+            waited = time.monotonic()
+            if not (self.client.wait_for_screen_window() and self.active()):
+                break
+            self.update_resolution(time.monotonic() - waited)
+            delay = next_capture - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            next_capture = max(next_capture + self.interval, time.monotonic())
+            put_latest(self.convert_queue, grab())
+    
+    def update_resolution(self, waited):
+        """Track how long capture waits for acknowledgements and switch between native and
+        max_size output, holding each choice for a while since every switch costs a keyframe."""
+        self.stall = 0.8 * self.stall + 0.2 * waited
+        now = time.monotonic()
+        if now - self.resolution_changed_at < self.resolution_hold:
+            return
+        if self.native and self.stall > self.interval:
+            self.native = False
+        elif not self.native and self.stall < self.interval / 4:
+            self.native = True
+        else:
+            return
+        self.resolution_changed_at = now
+        print(f"[INFO] Screen share resolution: {'native' if self.native else 'scaled to %dx%d' % self.max_size}")
+    
+    def next_buffer(self, shape):
+        """A free buffer of this shape, owned by the caller until release_buffer(), or None if all are in use."""
+        with self.pool_lock:
+            if self.pool_shape != shape:
+                # Buffers of the old shape still being encoded are dropped when released
+                self.pool_shape = shape
+                self.pool = [np.empty(shape, dtype=np.uint8) for _ in range(self.pool_size)]
+            return self.pool.pop() if self.pool else None
+    
+    def release_buffer(self, buffer):
+        with self.pool_lock:
+            if buffer.shape == self.pool_shape and len(self.pool) < self.pool_size:
+                self.pool.append(buffer)
+    
+    def next_preview(self, frame):
+        """frame scaled into a free preview buffer at the size the GUI last showed, or None if the GUI still holds them all."""
+        height, width = frame.shape[:2]
+        target = self.client.screen_preview_size
+        scale = min(1.0, target[0] / width, target[1] / height) if target else 1.0
+        shape = (max(1, int(height * scale)), max(1, int(width * scale)), 3)
+        with self.pool_lock:
+            if self.preview_shape != shape:
+                self.preview_shape = shape
+                self.preview_buffers = [np.empty(shape, dtype=np.uint8) for _ in range(2)]
+                self.previews = list(self.preview_buffers)
+            if not self.previews:
+                return None
+            preview = self.previews.pop()
+        if scale < 1.0:
+            cv2.resize(frame, (shape[1], shape[0]), dst=preview, interpolation=cv2.INTER_AREA)
+        else:
+            np.copyto(preview, frame)
+        return preview
+    
+    def release_preview(self, buffer):
+        with self.pool_lock:
+            if any(buffer is preview for preview in self.preview_buffers):
+                self.previews.append(buffer)
+    
+    def queue_frame(self, frame):
+        """Hand a frame to the encoder, replacing (and releasing) one it hasn't picked up yet."""
+        while True:
+            try:
+                self.encode_queue.put_nowait(frame)
+                return
+            except queue.Full:
+                try:
+                    self.release_buffer(self.encode_queue.get_nowait())
+                except queue.Empty:
+                    pass
+    
+    def convert_stage(self):
+        max_width, max_height = self.max_size
+        while self.active():
+            try:
+                source, code = self.convert_queue.get(timeout=0.2)
+            except queue.Empty:
+                continue
+            
+            height, width = source.shape[:2]
+            scale = 1.0 if self.native else min(1.0, max_width / width, max_height / height)
+            out_width, out_height = (int(width * scale), int(height * scale)) if scale < 1.0 else (width, height)
+            frame = self.next_buffer((out_height, out_width, 3))
+            if frame is None:
+                # Every buffer is queued or being encoded: the encoder is behind, skip this capture
+                continue
+            if scale < 1.0:
+                if self.scratch is None or self.scratch.shape[:2] != (height, width):
+                    self.scratch = np.empty((height, width, 3), dtype=np.uint8)
+                cv2.cvtColor(source, code, self.scratch)
+                cv2.resize(self.scratch, (out_width, out_height), dst=frame, interpolation=cv2.INTER_AREA)
+            else:
+                cv2.cvtColor(source, code, frame)
+            
+            if self.client.current_page == 0:
+                preview = self.next_preview(frame)
+                if preview is not None:
+                    self.client.screen_share_frame_signal.emit(preview)
+            self.queue_frame(frame)
+    
+    def encode_stage(self):
+        while self.active():
+            try:
+                frame = self.encode_queue.get(timeout=0.2)
+            except queue.Empty:
+                continue
+            
+            tiers = set(self.client.screen_tiers)
+            for tier in tiers - self.tiers:
+                # Viewers of a tier that just came back need a fresh keyframe
+                self.encoders[tier].request_keyframe()
+            self.tiers = tiers
+            
+            try:
+                encoded = {}
+                if 'full' in tiers:
+                    encoded['full'] = self.encoders['full'].encode(frame)
+                now = time.monotonic()
+                if 'thumb' in tiers and now - self.last_thumb >= self.thumb_interval:
+                    self.last_thumb = now
+                    encoded['thumb'] = self.encoders['thumb'].encode(self.thumbnail(frame))
+            finally:
+                # The encoders keep their own copy of the frame to diff against
+                self.release_buffer(frame)
+            for tier, result in encoded.items():
+                self.queue_encoded(tier, result)
+    
+    def thumbnail(self, frame):
+        height, width = frame.shape[:2]
+        scale = min(self.thumb_size[0] / width, self.thumb_size[1] / height)
+        return cv2.resize(frame, (max(1, int(width * scale)), max(1, int(height * scale))), interpolation=cv2.INTER_AREA)
+    
+    def queue_encoded(self, tier, encoded):
+        if encoded is None:
+            # Nothing changed on screen; nothing to send
+            return
+        header, payload = encoded
+        header['tier'] = tier
+        # Never drop after encoding: the next tiles are diffed against this frame
+        while self.active():
+            try:
+                self.send_queue.put((header, payload), timeout=0.2)
+                break
+            except queue.Full:
+                continue
+    
+    def send_stage(self):
+        while self.active():
+            try:
+                header, payload = self.send_queue.get(timeout=0.2)
+            except queue.Empty:
+                continue
+            try:
+                self.client.send_screen_payload(header, payload)
+            except socket.error as e:
+                print(f"[ERROR] Screen channel send failed: {e}")
+                self.client.screen_share_enabled = False
+                break
+            self.frame_count += 1
+            if self.frame_count % 50 == 0:
+                print(f"[INFO] Sent {self.frame_count} frames via screen channel")
+
+class DownloadManager:
+    """Receives files in background threads, one per transfer.
+    Data is written chunk by chunk to a temporary file next to the destination and renamed into place
+    only once it is complete and matches its content hash, so a cancelled or failed download never
+    leaves a partial file under the chosen name. Progress and completion reach the GUI through the
+    client's file_progress_signal and file_downloaded_signal.
+    """
+    def __init__(self, client, buffer_size=1024 * 1024, progress_interval=0.1, peer_timeout=3.0, relay_timeout=120.0):
+        self.client = client
+        self.buffer_size = buffer_size
+        self.progress_interval = progress_interval
+        self.peer_timeout = peer_timeout
+        self.relay_timeout = relay_timeout
+        self.lock = threading.Lock()
+        # {transfer_id: {'id', 'filename', 'from', 'path', 'size', 'received', 'cancelled': Event, 'socket', 'file'}}
+        self.transfers = {}
+        # Transfers that fell back to the server, waiting for its file_download_ready: {file_hash: [transfer]}
+        self.relays = {}
+    
+    def start(self, message, save_path, target):
+        """Run target(transfer) in a worker thread for a new transfer. Returns its id."""
+        transfer_id = next(TRANSFER_IDS)
+        with self.lock:
+            transfer = {
+                'id': transfer_id,
+                'filename': message.get('filename', 'file'),
+                'from': message.get('from', 'Unknown'),
+                'path': save_path,
+                'size': message.get('size', 0),
+                'received': 0,
+                'cancelled': threading.Event(),
+                'socket': None,
+                'file': None
+            }
+            self.transfers[transfer_id] = transfer
+        worker = threading.Thread(target=self.run, args=(transfer, target))
+        worker.daemon = True
+        worker.start()
+        return transfer_id
+    
+    def download(self, message, save_path):
+        """Fetch a file straight from the sharer when the server gives a peer address, otherwise
+        (or if the sharer can't be reached) from the server on a data connection."""
+        return self.start(message, save_path, lambda transfer: self.fetch(transfer, message))
+    
+    def save_inline(self, message, save_path):
+        """Write a file that arrived base64-encoded in a control message (file_transfer relays)."""
+        data = message.get('data', '')
+        message = dict(message, size=len(data) * 3 // 4)
+        return self.start(message, save_path, lambda transfer: self.decode_inline(transfer, data, message.get('hash')))
+    
+    def cancel(self, transfer_id):
+        with self.lock:
+            transfer = self.transfers.get(transfer_id)
+        if transfer is None:
+            return
+        transfer['cancelled'].set()
+        if 'ready' in transfer:
+            transfer['ready'].set()
+        sock = transfer['socket']
+        if sock:
+            # Wakes the worker out of recv_into
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except:
+                pass
+    
+    def run(self, transfer, target):
+        result = {'id': transfer['id'], 'filename': transfer['filename'], 'from': transfer['from'], 'path': transfer['path']}
+        directory, name = os.path.split(transfer['path'])
+        temp_path = os.path.join(directory, f".{name}.{transfer['id']}.part")
+        start = time.time()
+        try:
+            with open(temp_path, 'wb') as f:
+                transfer['file'] = f
+                content_hash = target(transfer)
+            if transfer['cancelled'].is_set():
+                raise InterruptedError("cancelled")
+            if content_hash is not None:
+                raise IOError(f"{transfer['filename']} was corrupted in transfer")
+            os.replace(temp_path, transfer['path'])
+            result['size'] = transfer['received']
+            result['seconds'] = time.time() - start
+        except Exception as e:
+            if transfer['cancelled'].is_set():
+                result['cancelled'] = True
+            else:
+                print(f"File download error: {e}")
+                result['error'] = str(e)
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+        finally:
+            with self.lock:
+                self.transfers.pop(transfer['id'], None)
+        self.client.file_downloaded_signal.emit(result)
+    
+    def report(self, transfer, force=False):
+        now = time.monotonic()
+        if force or now - transfer.get('reported', 0.0) >= self.progress_interval:
+            transfer['reported'] = now
+            self.client.file_progress_signal.emit({
+                'id': transfer['id'], 'done': transfer['received'], 'size': transfer['size']
+            })
+    
+    def fetch(self, transfer, message):
+        peer = message.get('peer')
+        if not peer:
+            return self.receive_stream(transfer, message.get('token'))
+        try:
+            return self.receive_stream(transfer, message.get('token'), (peer['host'], peer['port']), self.peer_timeout)
+        except (OSError, ValueError) as e:
+            if transfer['cancelled'].is_set():
+                raise
+            print(f"Direct download from {transfer['from']} failed ({e}), falling back to the server")
+        
+        # Start over through the server: it has the sharer upload the file, then hands out a token
+        transfer['file'].seek(0)
+        transfer['file'].truncate()
+        transfer['received'] = 0
+        transfer['ready'] = threading.Event()
+        with self.lock:
+            self.relays.setdefault(message['hash'], []).append(transfer)
+        try:
+            self.client.send_tcp(json.dumps({
+                'type': 'file_download',
+                'hash': message['hash'],
+                'filename': transfer['filename'],
+                'relay': True
+            }).encode('utf-8'))
+            if not transfer['ready'].wait(self.relay_timeout):
+                raise TimeoutError("server did not relay the file")
+        finally:
+            with self.lock:
+                waiting = self.relays.get(message['hash'], [])
+                if transfer in waiting:
+                    waiting.remove(transfer)
+                if not waiting:
+                    self.relays.pop(message['hash'], None)
+        if transfer['cancelled'].is_set():
+            return None
+        return self.receive_stream(transfer, transfer['relay'].get('token'))
+    
+    def relay_ready(self, message):
+        """Called from the control connection's receive thread with a file_download_ready.
+        Returns True if it answers a fallback in progress rather than a new download."""
+        with self.lock:
+            waiting = self.relays.get(message.get('hash'))
+            if not waiting or message.get('peer'):
+                return False
+            transfer = waiting.pop(0)
+        transfer['relay'] = message
+        transfer['ready'].set()
+        return True
+    
+    def receive_stream(self, transfer, token, address=None, timeout=10):
+        """Returns None when the data matched its hash, otherwise the hash received."""
+        sock = socket.create_connection(address or (self.client.server_host, self.client.tcp_port), timeout=timeout)
+        transfer['socket'] = sock
+        try:
+            sock.sendall(json.dumps({
+                'username': self.client.username,
+                'channel': 'data',
+                'token': token,
+                'codecs': list(COMPRESSION_CODECS)
+            }).encode('utf-8'))
+            header, _, _ = read_frame(sock)
+            if not header or header.get('type') != 'file_data':
+                raise ConnectionError((header or {}).get('message', "server closed the data connection"))
+            sock.settimeout(10)
+            
+            transfer['size'] = header['size']
+            content_hash = hashlib.sha256()
+            buffer = bytearray(self.buffer_size)
+            view = memoryview(buffer)
+            if header.get('codec'):
+                # One compressed stream that ends where the decompressor says it does
+                stream = decompressor(header['codec'])
+                while not stream.eof and not transfer['cancelled'].is_set():
+                    received = sock.recv_into(view)
+                    if not received:
+                        raise ConnectionError("data connection closed early")
+                    data = stream.decompress(view[:received])
+                    content_hash.update(data)
+                    transfer['file'].write(data)
+                    transfer['received'] += len(data)
+                    self.report(transfer)
+            else:
+                remaining = transfer['size']
+                while remaining > 0 and not transfer['cancelled'].is_set():
+                    received = sock.recv_into(view, min(self.buffer_size, remaining))
+                    if not received:
+                        raise ConnectionError("data connection closed early")
+                    content_hash.update(view[:received])
+                    transfer['file'].write(view[:received])
+                    remaining -= received
+                    transfer['received'] = transfer['size'] - remaining
+                    self.report(transfer)
+            self.report(transfer, force=True)
+            return None if content_hash.hexdigest() == header['hash'] else content_hash.hexdigest()
+        finally:
+            sock.close()
+    
+    def decode_inline(self, transfer, data, expected_hash):
+        content_hash = hashlib.sha256()
+        # Whole base64 quanta, so each slice decodes on its own
+        step = self.buffer_size // 3 * 4
+        for offset in range(0, len(data), step):
+            if transfer['cancelled'].is_set():
+                break
+            chunk = base64.b64decode(data[offset:offset + step])
+            content_hash.update(chunk)
+            transfer['file'].write(chunk)
+            transfer['received'] += len(chunk)
+            self.report(transfer)
+        self.report(transfer, force=True)
+        if expected_hash and content_hash.hexdigest() != expected_hash:
+            return content_hash.hexdigest()
+        return None
+
+class PeerServer:
+    """Serves this client's shared files straight to other participants' DownloadManagers.
+    The relay only brokers the rendezvous (this machine's address, the port and a per-share token),
+    so the file crosses the LAN once and the server does no per-byte work. The protocol is the
+    server's data channel: a JSON hello with the token, then a framed header and the file bytes.
+    """
+    def __init__(self, client, port=0):
+        self.client = client
+        self.lock = threading.Lock()
+        # {file_hash: {'path', 'filename', 'recipient', 'token'}}
+        self.files = {}
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('0.0.0.0', port))
+        self.sock.listen(16)
+        self.port = self.sock.getsockname()[1]
+        accept_thread = threading.Thread(target=self.accept_loop)
+        accept_thread.daemon = True
+        accept_thread.start()
+    
+    def add(self, file_hash, path, filename, recipient):
+        """Serve a file from path. Returns the token receivers must present."""
+        with self.lock:
+            entry = self.files.get(file_hash)
+            if entry is None or entry['path'] != path:
+                entry = {'path': path, 'filename': filename, 'recipient': recipient, 'token': secrets.token_hex(16)}
+                self.files[file_hash] = entry
+            return entry['token']
+    
+    def get(self, file_hash):
+        with self.lock:
+            entry = self.files.get(file_hash)
+            return dict(entry) if entry else None
+    
+    def accept_loop(self):
+        while True:
+            try:
+                peer_socket, address = self.sock.accept()
+            except OSError:
+                break
+            peer_thread = threading.Thread(target=self.serve, args=(peer_socket, address))
+            peer_thread.daemon = True
+            peer_thread.start()
+    
+    def serve(self, peer_socket, address):
+        try:
+            peer_socket.settimeout(10)
+            hello = json.loads(peer_socket.recv(4096).decode('utf-8'))
+            with self.lock:
+                match = next(((file_hash, entry) for file_hash, entry in self.files.items()
+                              if secrets.compare_digest(entry['token'], str(hello.get('token')))), None)
+            if match is None:
+                peer_socket.sendall(pack_frame({'type': 'error', 'message': 'invalid token'}))
+                return
+            file_hash, entry = match
+            path = entry['path']
+            codecs = [codec for codec in hello.get('codecs', []) if codec in COMPRESSION_CODECS]
+            codec = None
+            if codecs:
+                with open(path, 'rb') as f:
+                    codec = choose_compression(f.read(COMPRESSION_SAMPLE), codecs)
+            
+            header = {'type': 'file_data', 'hash': file_hash, 'size': os.path.getsize(path)}
+            if codec:
+                header['codec'] = codec
+            peer_socket.settimeout(None)
+            start = time.time()
+            peer_socket.sendall(pack_frame(header))
+            sent = send_stream(peer_socket, [path], codec)
+            elapsed = max(time.time() - start, 1e-6)
+            print(f"Sent {entry['filename']} directly to {hello.get('username')} at {address[0]} "
+                  f"({header['size']} bytes as {sent} {codec or 'raw'}, {header['size'] / elapsed / 1e6:.1f} MB/s)")
+        except Exception as e:
+            print(f"Direct transfer to {address} failed: {e}")
+        finally:
+            try:
+                peer_socket.close()
+            except:
+                pass
+    
+    def close(self):
+        # shutdown() wakes the thread blocked in accept(); close() alone doesn't on Linux
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except:
+            pass
+        try:
+            self.sock.close()
+        except:
+            pass
+
+class UploadManager:
+    """Sends files to the server from a small pool of worker threads.
+    Uploads wait in a queue and up to `workers` run at once. Each file is hashed and offered by content
+    hash; the server answers with the chunks it lacks and a token for a data connection, and those chunks
+    are read from disk one at a time and sent there as binary frames, so a file is never held in memory
+    whole. Progress and results reach the GUI through file_progress_signal and file_uploaded_signal.
+    
+    Files are served straight from this machine when it runs a PeerServer, except new versions of a
+    filename shared before: those go to the store, and once the store holds a version of the file
+    the next ones are sent as rsync-style deltas when that is smaller than the missing chunks. The
+    server sends a block signature of the previous version, and only copy instructions and the
+    changed bytes go up. Receivers still download the whole new version.
+    """
+    def __init__(self, client, workers=3, offer_timeout=30.0, progress_interval=0.1):
+        self.client = client
+        self.offer_timeout = offer_timeout
+        self.progress_interval = progress_interval
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        # {transfer_id: {'id', 'path', 'filename', 'recipient', 'size', 'sent', 'cancelled': Event, 'socket', ...}}
+        self.transfers = {}
+        # Transfers waiting for the server's answer to their offer, in order: {file_hash: [transfer]}
+        self.offers = {}
+        # Content last shared under each filename, directly or not, offered as the base for the next
+        # version: {filename: file_hash}
+        self.versions = {}
+        for _ in range(workers):
+            worker = threading.Thread(target=self.run)
+            worker.daemon = True
+            worker.start()
+    
+    def add(self, filepath, filename, recipient, relay=False):
+        """Queue a file for sharing. Returns its transfer id. The file is served from this machine
+        when the client runs a PeerServer; relay uploads put it on the server for receivers that
+        couldn't connect directly."""
+        transfer = {
+            'id': next(TRANSFER_IDS),
+            'path': filepath,
+            'filename': filename,
+            'recipient': recipient,
+            'size': os.path.getsize(filepath),
+            'sent': 0,
+            'uploaded_bytes': 0,
+            'wire_bytes': 0,
+            'codec': None,
+            'delta': False,
+            'relay': relay,
+            'direct': False,
+            'cancelled': threading.Event(),
+            'replied': threading.Event(),
+            'reply': None,
+            'socket': None
+        }
+        with self.lock:
+            self.transfers[transfer['id']] = transfer
+        self.queue.put(transfer)
+        return transfer['id']
+    
+    def cancel(self, transfer_id):
+        with self.lock:
+            transfer = self.transfers.get(transfer_id)
+        if transfer is None:
+            return
+        transfer['cancelled'].set()
+        transfer['replied'].set()
+        sock = transfer['socket']
+        if sock:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except:
+                pass
+    
+    def offer_reply(self, message):
+        """Called from the control connection's receive thread with a file_offer_reply."""
+        with self.lock:
+            waiting = self.offers.get(message.get('hash'))
+            if not waiting:
+                return
+            transfer = waiting.pop(0)
+            if not waiting:
+                del self.offers[message['hash']]
+        transfer['reply'] = message
+        transfer['replied'].set()
+    
+    def run(self):
+        while True:
+            transfer = self.queue.get()
+            result = {'id': transfer['id'], 'filename': transfer['filename'], 'recipient': transfer['recipient']}
+            start = time.time()
+            try:
+                if transfer['cancelled'].is_set():
+                    raise InterruptedError("cancelled")
+                self.upload(transfer)
+                if transfer['cancelled'].is_set():
+                    raise InterruptedError("cancelled")
+                result['size'] = transfer['size']
+                result['uploaded_bytes'] = transfer['uploaded_bytes']
+                result['wire_bytes'] = transfer['wire_bytes']
+                result['codec'] = transfer['codec']
+                result['delta'] = transfer['delta']
+                result['chunks'] = transfer['chunks']
+                result['uploaded'] = transfer['uploaded']
+                result['direct'] = transfer['direct']
+                result['relay'] = transfer['relay']
+                result['seconds'] = time.time() - start
+            except Exception as e:
+                if transfer['cancelled'].is_set():
+                    result['cancelled'] = True
+                else:
+                    print(f"File upload error: {e}")
+                    result['error'] = str(e)
+            finally:
+                with self.lock:
+                    self.transfers.pop(transfer['id'], None)
+            self.client.file_uploaded_signal.emit(result)
+    
+    def report(self, transfer, force=False):
+        now = time.monotonic()
+        if force or now - transfer.get('reported', 0.0) >= self.progress_interval:
+            transfer['reported'] = now
+            self.client.file_progress_signal.emit({
+                'id': transfer['id'], 'done': transfer['sent'], 'size': transfer['size']
+            })
+    
+    def upload(self, transfer):
+        """Offer the file by content hash, then send whatever chunks the server is missing
+        (none if it already has this content, in which case the share is instant)."""
+        file_hash, chunk_hashes, size = hash_file(transfer['path'])
+        transfer['size'] = size
+        transfer['chunks'] = len(chunk_hashes)
+        offer = {
+            'type': 'file_offer',
+            'hash': file_hash,
+            'size': size,
+            'filename': transfer['filename'],
+            'recipient': transfer['recipient'],
+            'chunks': chunk_hashes
+        }
+        with self.lock:
+            base = self.versions.get(transfer['filename'])
+        # A new version of a file shared before goes through the store rather than being served
+        # directly: the store keeps the lineage, so this and later versions upload as deltas
+        versioned = bool(base) and base != file_hash
+        if versioned:
+            offer['base'] = base
+        peer_server = self.client.peer_server
+        if transfer['relay']:
+            offer['relay'] = True
+        elif peer_server and not versioned:
+            offer['peer'] = {
+                'port': peer_server.port,
+                'token': peer_server.add(file_hash, transfer['path'], transfer['filename'], transfer['recipient'])
+            }
+        with self.lock:
+            self.offers.setdefault(file_hash, []).append(transfer)
+        try:
+            self.client.send_tcp(json.dumps(offer).encode('utf-8'))
+            if not transfer['replied'].wait(self.offer_timeout):
+                raise TimeoutError("server did not answer the file offer")
+        finally:
+            with self.lock:
+                waiting = self.offers.get(file_hash, [])
+                if transfer in waiting:
+                    waiting.remove(transfer)
+                if not waiting:
+                    self.offers.pop(file_hash, None)
+        if transfer['cancelled'].is_set():
+            return
+        
+        if transfer['reply'].get('error'):
+            raise IOError(transfer['reply']['error'])
+        missing = set(transfer['reply'].get('missing', []))
+        transfer['uploaded'] = len(missing)
+        transfer['direct'] = bool(transfer['reply'].get('direct'))
+        if missing:
+            self.send_chunks(transfer, transfer['reply'].get('token'), missing, chunk_hashes)
+        if not transfer['cancelled'].is_set():
+            with self.lock:
+                self.versions[transfer['filename']] = file_hash
+        transfer['sent'] = size
+        self.report(transfer, force=True)
+    
+    def send_chunks(self, transfer, token, missing, chunk_hashes):
+        sock = socket.create_connection((self.client.server_host, self.client.tcp_port), timeout=10)
+        transfer['socket'] = sock
+        try:
+            sock.sendall(json.dumps({
+                'username': self.client.username,
+                'channel': 'data',
+                'token': token
+            }).encode('utf-8'))
+            header, signature, _ = read_frame(sock)
+            if not header or header.get('type') != 'upload_ready':
+                raise ConnectionError((header or {}).get('message', "server closed the data connection"))
+            sock.settimeout(None)
+            codecs = [codec for codec in COMPRESSION_CODECS if codec in header.get('codecs', [])]
+            with open(transfer['path'], 'rb') as f:
+                # Compressed formats and random data are sent as they are
+                transfer['codec'] = choose_compression(f.read(COMPRESSION_SAMPLE), codecs)
+            
+            ops = None
+            if header.get('block_size') and signature:
+                ops = list(delta_ops(transfer['path'], bytes(signature), header['block_size']))
+                literal, _ = delta_cost(ops, header['block_size'])
+                missing_bytes = sum(min(CHUNK_SIZE, transfer['size'] - index * CHUNK_SIZE) for index in missing)
+                # Each copy instruction is a small frame of its own
+                if literal + 32 * len(ops) >= missing_bytes:
+                    ops = None
+            if ops is not None:
+                transfer['delta'] = True
+                self.send_delta(sock, transfer, ops, header['block_size'])
+            else:
+                for index, chunk in enumerate(iter_file_chunks(transfer['path'])):
+                    if transfer['cancelled'].is_set():
+                        return
+                    if index in missing:
+                        if hash_bytes(chunk) != chunk_hashes[index]:
+                            raise IOError(f"{transfer['filename']} changed while it was being shared")
+                        self.send_data(sock, transfer, {'index': index}, chunk)
+                    transfer['sent'] += len(chunk)
+                    self.report(transfer)
+            if transfer['cancelled'].is_set():
+                return
+            
+            # Half-close so the server sees the end of the chunks, then wait for it to confirm
+            sock.shutdown(socket.SHUT_WR)
+            header, _, _ = read_frame(sock)
+            if not header or header.get('type') != 'upload_done':
+                raise ConnectionError((header or {}).get('message', "server closed the data connection"))
+        finally:
+            sock.close()
+    
+    def send_delta(self, sock, transfer, ops, block_size):
+        """Send the file as copies of the base's blocks and literal bytes, in file order.
+        The server checks every chunk it rebuilds against the offered hashes."""
+        with open(transfer['path'], 'rb') as f:
+            for op in ops:
+                if transfer['cancelled'].is_set():
+                    return
+                if op[0] == 'copy':
+                    frame = pack_frame({'copy': [op[1], op[2]]})
+                    sock.sendall(frame)
+                    transfer['wire_bytes'] += len(frame)
+                    transfer['sent'] += op[2] * block_size
+                else:
+                    f.seek(op[1])
+                    remaining = op[2]
+                    while remaining > 0:
+                        data = f.read(min(remaining, CHUNK_SIZE))
+                        if not data:
+                            raise IOError(f"{transfer['filename']} changed while it was being shared")
+                        self.send_data(sock, transfer, {'literal': True}, data)
+                        remaining -= len(data)
+                        transfer['sent'] += len(data)
+                self.report(transfer)
+    
+    def send_data(self, sock, transfer, header, data):
+        """One frame of file bytes, compressed with the transfer's codec when that makes it smaller."""
+        payload = data
+        if transfer['codec']:
+            compressed = compress_chunk(transfer['codec'], data)
+            if len(compressed) < len(data):
+                header['codec'] = transfer['codec']
+                payload = compressed
+        sock.sendall(pack_frame(header, payload))
+        transfer['uploaded_bytes'] += len(data)
+        transfer['wire_bytes'] += len(payload)
 
 class VideoLabel(QLabel):
     """Custom label for video display with modern styling"""
@@ -35,11 +1050,22 @@ class ConferenceClient(QMainWindow):
     screen_share_stop_signal = pyqtSignal()
     screen_share_frame_signal = pyqtSignal(object)
     chat_message_signal = pyqtSignal(dict)
+    chat_history_signal = pyqtSignal(dict)
     file_transfer_signal = pyqtSignal(dict)
     file_available_signal = pyqtSignal(dict)
+    file_stored_signal = pyqtSignal(dict)
+    file_download_ready_signal = pyqtSignal(dict)
+    file_upload_request_signal = pyqtSignal(dict)
+    file_catalog_signal = pyqtSignal(dict)
+    file_downloaded_signal = pyqtSignal(dict)
+    file_progress_signal = pyqtSignal(dict)
+    file_uploaded_signal = pyqtSignal(dict)
     server_shutdown_signal = pyqtSignal()
+    active_speaker_signal = pyqtSignal(dict)
+    screen_cursor_signal = pyqtSignal(dict)
+    screen_thumb_signal = pyqtSignal(object)
     
-    def __init__(self, server_host, server_port, username):
+    def __init__(self, server_host, server_port, username, audio_frame_ms=AUDIO_FRAME_MS):
         super().__init__()
         self.server_host = server_host
         self.tcp_port = server_port
@@ -47,7 +1073,23 @@ class ConferenceClient(QMainWindow):
         self.username = username
         
         self.tcp_socket = None
+        # Upload workers and the GUI thread both write to the control connection
+        self.tcp_send_lock = threading.Lock()
         self.udp_socket = None
+        self.screen_socket = None
+        self.screen_send_lock = threading.Lock()
+        # Presenter: {tier: TileEncoder} of the running pipeline, and the tiers the relay says viewers want
+        self.screen_encoders = {}
+        self.screen_pipeline = None
+        # (width, height) the shared screen was last shown at; the presenter's preview is scaled to it
+        self.screen_preview_size = None
+        self.screen_tiers = {'full'}
+        # Screen-share flow control: {seq: bytes} sent but not yet acknowledged by the relay
+        self.screen_flow = threading.Condition()
+        self.screen_seq = 0
+        self.screen_in_flight = {}
+        self.screen_max_frames_in_flight = 2
+        self.screen_max_bytes_in_flight = 4 * 1024 * 1024
         self.running = False
         
         self.video_enabled = False
@@ -61,14 +1103,60 @@ class ConferenceClient(QMainWindow):
         self.stream_in = None
         self.audio_out = None
         self.stream_out = None
+        # Capture/playout frame size; 10-20 ms keeps packetization delay low
+        self.audio_frame_samples = AUDIO_RATE * audio_frame_ms // 1000
+        self.audio_ring = AudioRingBuffer()
+        self.audio_seq = 0
+        self.jitter_buffers = {}
+        self.playout_thread = None
+        self.av_sync = {}
+        # Compressed video frames held for lip-sync: {username: deque of (render_at, ts, jpeg)}
+        self.pending_video = {}
+        # Size each visible participant's video is drawn at: {username: (width, height)}
+        self.video_view_sizes = {}
         
         self.participants = {}
         self.previous_participants = set()
         self.current_page = 0
         self.participants_per_page = 4
-        self.chat_windows = []
-        self.chat_history = []
+        # Move the relay's active speakers onto the first participant page
+        self.auto_place_speakers = True
+        self.speaker_ranking = []
+        self.dominant_speaker = None
+        # Open chat dialog, filled a page at a time from the server's chat log
+        self.chat_dialog = None
+        self.chat_page_size = 50
+        # Shared files are served from this machine when other clients can reach it
+        try:
+            self.peer_server = PeerServer(self)
+        except OSError as e:
+            print(f"Direct file sharing unavailable, files go through the server: {e}")
+            self.peer_server = None
+        self.uploads = UploadManager(self)
+        self.downloads = DownloadManager(self)
+        # Progress dialogs of running uploads and downloads: {transfer_id: QProgressDialog}
+        self.transfer_dialogs = {}
+        # Shared-files browser, filled a page at a time from the server's catalog
+        self.catalog_dialog = None
+        self.catalog_page_size = 50
         self.shared_screen_frame = None
+        # Screen updates stay compressed in these canvases until shown; the lock covers queueing vs. decoding
+        self.screen_canvas = TileCanvas()
+        self.screen_thumb_canvas = TileCanvas()
+        self.screen_canvas_lock = threading.Lock()
+        # Covers participants' frame_data, frame and source_size, written by the UDP thread and the GUI timer
+        self.video_lock = threading.Lock()
+        self.screen_view_size = None
+        self.screen_sync_requested_at = 0.0
+        # Viewport tier last declared to the relay: 'full' (page 0), 'thumb' (nav bar) or 'hidden'
+        self.screen_viewport = 'full'
+        # Cursor travels as metadata, not pixels: the presenter's capture area (left, top, width, height),
+        # the last cursor sent, and on viewers the presenter's cursor plus the frame it is drawn over
+        self.screen_capture_area = None
+        self.last_cursor_sent = None
+        self.last_cursor_sent_at = 0.0
+        self.screen_cursor = None
+        self.screen_share_pixmap = None
         
         self.video_labels = {}
         self.screen_share_label = None
@@ -81,12 +1169,35 @@ class ConferenceClient(QMainWindow):
         self.screen_share_stop_signal.connect(self.handle_screen_share_stop)
         self.screen_share_frame_signal.connect(self.update_screen_share_display)
         self.chat_message_signal.connect(self.handle_chat_message)
+        self.chat_history_signal.connect(self.handle_chat_history)
         self.file_transfer_signal.connect(self.handle_file_transfer)
         self.file_available_signal.connect(self.handle_file_available)
+        self.file_stored_signal.connect(self.handle_file_stored)
+        self.file_download_ready_signal.connect(self.handle_file_download_ready)
+        self.file_upload_request_signal.connect(self.handle_file_upload_request)
+        self.file_catalog_signal.connect(self.handle_file_catalog)
+        self.file_downloaded_signal.connect(self.handle_file_downloaded)
+        self.file_progress_signal.connect(self.update_file_progress)
+        self.file_uploaded_signal.connect(self.handle_file_uploaded)
         self.server_shutdown_signal.connect(self.handle_server_shutdown)
+        self.active_speaker_signal.connect(self.handle_active_speaker)
+        self.screen_cursor_signal.connect(self.handle_screen_cursor)
+        self.screen_thumb_signal.connect(self.update_screen_thumbnail)
         
         self.setup_gui()
         
+        self.video_sync_timer = QTimer(self)
+        self.video_sync_timer.timeout.connect(self.render_pending_video)
+        self.video_sync_timer.start(10)
+        
+        self.stats_timer = QTimer(self)
+        self.stats_timer.timeout.connect(self.refresh_stream_stats)
+        self.stats_timer.start(1000)
+        
+        # Presenter cursor updates at ~60 Hz while sharing
+        self.cursor_timer = QTimer(self)
+        self.cursor_timer.timeout.connect(self.send_screen_cursor)
+        
     def _open_camera_windows(self):
         """Try multiple backends and indices; always release failed handles so the camera isn't left locked."""
         preferred_backends = [cv2.CAP_DSHOW, cv2.CAP_MSMF, 0]  # 0 = default
@@ -193,6 +1304,14 @@ class ConferenceClient(QMainWindow):
         """)
         nav_layout.addWidget(self.page_label)
         
+        # Presenter's screen while browsing participant pages (fed by the relay's thumbnail tier)
+        self.screen_thumb_label = QLabel()
+        self.screen_thumb_label.setFixedSize(160, 90)
+        self.screen_thumb_label.setAlignment(Qt.AlignmentFlag.AlignCenter)
+        self.screen_thumb_label.setStyleSheet("background-color: black; border-radius: 4px;")
+        self.screen_thumb_label.hide()
+        nav_layout.addWidget(self.screen_thumb_label)
+        
         self.next_btn = QPushButton("Next ►")
         self.next_btn.clicked.connect(self.next_page)
         self.next_btn.setFixedWidth(120)
@@ -351,6 +1470,31 @@ class ConferenceClient(QMainWindow):
         """)
         control_layout.addWidget(self.file_btn)
         
+        self.files_btn = QPushButton("🗂️ Files")
+        self.files_btn.clicked.connect(self.open_file_catalog)
+        self.files_btn.setCursor(Qt.CursorShape.PointingHandCursor)
+        self.files_btn.setToolTip("Browse files shared in this meeting")
+        self.files_btn.setStyleSheet("""
+            QPushButton {
+                background: qlineargradient(x1:0, y1:0, x2:0, y2:1,
+                    stop:0 #614385, stop:1 #516395);
+                color: white;
+                border: none;
+                border-radius: 10px;
+                padding: 12px;
+                font-weight: bold;
+                font-size: 11px;
+            }
+            QPushButton:hover {
+                background: qlineargradient(x1:0, y1:0, x2:0, y2:1,
+                    stop:0 #516395, stop:1 #614385);
+            }
+            QPushButton:pressed {
+                background: #523a71;
+            }
+        """)
+        control_layout.addWidget(self.files_btn)
+        
         left_layout.addWidget(control_widget)
         
         main_layout.addWidget(left_widget, stretch=4)
@@ -485,7 +1629,7 @@ class ConferenceClient(QMainWindow):
             
             message = json.dumps({'username': self.username})
             try:
-                self.tcp_socket.send(message.encode('utf-8'))
+                self.send_tcp(message.encode('utf-8'))
             except Exception:
                 pass
             
@@ -513,11 +1657,62 @@ class ConferenceClient(QMainWindow):
             udp_thread.daemon = True
             udp_thread.start()
             
+            self.connect_screen_channel()
+            
             return True
         except Exception as e:
             QMessageBox.critical(self, "Connection Error", f"Could not connect:\n{e}")
             return False
 
+    def send_tcp(self, data):
+        """Send a whole message on the control connection without interleaving with other threads."""
+        with self.tcp_send_lock:
+            self.tcp_socket.sendall(data)
+    
+    def connect_screen_channel(self):
+        """Open the dedicated screen-share connection so frames never queue behind chat and control
+        messages. Frames use binary framing (protocol.py) so the relay can forward them untouched."""
+        try:
+            sock = socket.create_connection((self.server_host, self.tcp_port), timeout=5)
+            sock.sendall(json.dumps({'username': self.username, 'channel': 'screen'}).encode('utf-8'))
+            header, _, _ = read_frame(sock)
+            if not header or header.get('action') != 'ready':
+                raise ConnectionError("relay did not accept the screen channel")
+            sock.settimeout(None)
+            self.screen_socket = sock
+        except Exception as e:
+            print(f"Screen channel unavailable: {e}")
+            self.screen_socket = None
+            return
+        
+        screen_thread = threading.Thread(target=self.receive_screen)
+        screen_thread.daemon = True
+        screen_thread.start()
+    
+    def receive_screen(self):
+        while self.running:
+            try:
+                header, payload, _ = read_frame(self.screen_socket)
+                if header is None:
+                    break
+                
+                action = header.get('action')
+                if action in ['frame', 'tiles']:
+                    self.handle_screen_share_frame(header, payload)
+                elif action == 'keyframe_request':
+                    encoder = self.screen_encoders.get(header.get('tier', 'full'))
+                    if encoder:
+                        encoder.request_keyframe()
+                elif action == 'tiers':
+                    self.screen_tiers = set(header.get('tiers', []))
+                elif action == 'ack':
+                    self.handle_screen_ack(header.get('seq', 0))
+                    
+            except Exception as e:
+                if self.running:
+                    print(f"Screen channel error: {e}")
+                break
+    
     def init_audio_output(self):
         if self.stream_out and self.audio_out:
             return True
@@ -526,9 +1721,9 @@ class ConferenceClient(QMainWindow):
             self.stream_out = self.audio_out.open(
                 format=pyaudio.paInt16,
                 channels=1,
-                rate=16000,
+                rate=AUDIO_RATE,
                 output=True,
-                frames_per_buffer=2048
+                frames_per_buffer=self.audio_frame_samples
             )
             return True
         except Exception as e:
@@ -563,13 +1758,28 @@ class ConferenceClient(QMainWindow):
                             self.participant_list_signal.emit(message['participants'])
                         elif msg_type == 'chat':
                             self.chat_message_signal.emit(message)
+                        elif msg_type == 'chat_history':
+                            self.chat_history_signal.emit(message)
                         elif msg_type == 'file_transfer':
                             self.file_transfer_signal.emit(message)
                         elif msg_type == 'file_available':
                             self.file_available_signal.emit(message)
+                        elif msg_type == 'file_offer_reply':
+                            self.uploads.offer_reply(message)
+                        elif msg_type == 'file_stored':
+                            self.file_stored_signal.emit(message)
+                        elif msg_type == 'file_download_ready':
+                            if not self.downloads.relay_ready(message):
+                                self.file_download_ready_signal.emit(message)
+                        elif msg_type == 'file_upload_request':
+                            self.file_upload_request_signal.emit(message)
+                        elif msg_type == 'file_catalog':
+                            self.file_catalog_signal.emit(message)
+                        elif msg_type == 'active_speaker':
+                            self.active_speaker_signal.emit(message)
                         elif msg_type == 'ping':
                             try:
-                                self.tcp_socket.send(json.dumps({'type': 'pong'}).encode('utf-8'))
+                                self.send_tcp(json.dumps({'type': 'pong'}).encode('utf-8'))
                             except Exception:
                                 pass
                         elif msg_type == 'server_shutdown':
@@ -582,9 +1792,9 @@ class ConferenceClient(QMainWindow):
                                 if username != self.username:
                                     self.screen_share_start_signal.emit(username)
                             elif action == 'stop':
+                                self.screen_canvas.reset()
+                                self.screen_thumb_canvas.reset()
                                 self.screen_share_stop_signal.emit()
-                            elif action == 'frame':
-                                self.handle_screen_share_frame(message)
                             
                     except json.JSONDecodeError:
                         break
@@ -605,6 +1815,8 @@ class ConferenceClient(QMainWindow):
                     self.handle_video_frame(message)
                 elif msg_type == 'audio_frame':
                     self.handle_audio_frame(message)
+                elif msg_type == 'screen_cursor':
+                    self.screen_cursor_signal.emit(message)
                 elif msg_type == 'screen_share':
                     action = message.get('action')
                     username = message.get('username')
@@ -613,9 +1825,9 @@ class ConferenceClient(QMainWindow):
                         if username != self.username:
                             self.screen_share_start_signal.emit(username)
                     elif action == 'stop':
+                        self.screen_canvas.reset()
+                        self.screen_thumb_canvas.reset()
                         self.screen_share_stop_signal.emit()
-                    elif action == 'frame':
-                        self.handle_screen_share_frame(message)
                     
             except json.JSONDecodeError:
                 continue
@@ -627,54 +1839,252 @@ class ConferenceClient(QMainWindow):
         username = message.get('username')
         if username and username in self.participants:
             try:
+                # Frames stay compressed until shown: held frames that get superseded are never decoded
                 frame_data = base64.b64decode(message['frame'])
-                frame = cv2.imdecode(np.frombuffer(frame_data, np.uint8), cv2.IMREAD_COLOR)
-                self.participants[username]['frame'] = frame
-                self.video_frame_signal.emit(username, frame)
+                ts = message.get('ts')
+                now = time.time()
+                delay = self.get_av_sync(username).render_delay(ts, now)
+                if delay <= 0.005 and not self.pending_video.get(username):
+                    self.show_video_frame(username, frame_data, ts)
+                    return
+                pending = self.pending_video.get(username)
+                if pending is None:
+                    pending = deque(maxlen=30)
+                    self.pending_video[username] = pending
+                pending.append((now + delay, ts, frame_data))
             except Exception as e:
                 print(f"Video frame error: {e}")
-            
+    
+    def get_av_sync(self, username):
+        sync = self.av_sync.get(username)
+        if sync is None:
+            sync = AVSyncController()
+            self.av_sync[username] = sync
+        return sync
+    
+    def show_video_frame(self, username, frame_data, ts):
+        participant = self.participants.get(username)
+        if participant is None:
+            return
+        with self.video_lock:
+            participant['frame_data'] = frame_data
+        self.get_av_sync(username).on_video_rendered(ts, time.time())
+        # Participants on other pages keep only the compressed frame until they are shown
+        if username in self.video_labels:
+            frame = self.decode_video(username)
+            if frame is not None:
+                self.video_frame_signal.emit(username, frame)
+    
+    def decode_video(self, username):
+        """Decode the participant's newest received frame if it hasn't been yet, at reduced size when
+        the video cell is small. Returns the latest decoded frame."""
+        participant = self.participants.get(username)
+        if participant is None:
+            return None
+        # Called from the UDP thread and the GUI timer; decoding under the lock keeps the newest frame
+        with self.video_lock:
+            frame_data = participant.get('frame_data')
+            if frame_data is not None:
+                participant['frame_data'] = None
+                source_size = participant.get('source_size', (320, 240))
+                reduction = decode_reduction(source_size, self.video_view_sizes.get(username))
+                frame = decode_image(frame_data, reduction)
+                if frame is not None:
+                    participant['frame'] = frame
+                    participant['source_size'] = (frame.shape[1] * reduction, frame.shape[0] * reduction)
+            return participant['frame']
+    
+    def render_pending_video(self):
+        """GUI timer: paint the newest held frame per sender whose audio has caught up."""
+        now = time.time()
+        for username, pending in list(self.pending_video.items()):
+            due = None
+            while pending and pending[0][0] <= now:
+                due = pending.popleft()
+            if due is not None:
+                self.show_video_frame(username, due[2], due[1])
+    
+    def refresh_stream_stats(self):
+        """Show per-sender audio/video stats as tooltips in the participant list."""
+        # Also picks up minimizing and restoring the window
+        self.update_screen_viewport()
+        for i in range(self.participant_list.count()):
+            item = self.participant_list.item(i)
+            username = item.data(Qt.ItemDataRole.UserRole)
+            lines = []
+            jitter_buffer = self.jitter_buffers.get(username)
+            if jitter_buffer is not None:
+                stats = jitter_buffer.stats
+                lines.append(f"Audio: {stats['received']} received, {stats['lost']} lost, "
+                             f"{stats['late']} late, {stats['concealed']} concealed")
+            sync = self.av_sync.get(username)
+            if sync is not None and sync.offset_ms is not None:
+                lines.append(f"A/V offset: {sync.offset_ms:+.0f} ms")
+            item.setToolTip("\n".join(lines))
+    
     def handle_audio_frame(self, message):
         try:
+            username = message.get('username')
             audio_data = base64.b64decode(message['audio'])
-
-            if not self.stream_out:
-                ok = self.init_audio_output()
-                if not ok:
+            pcm = np.frombuffer(audio_data, dtype=np.int16)
+            
+            jitter_buffer = self.jitter_buffers.get(username)
+            if jitter_buffer is None:
+                jitter_buffer = AudioJitterBuffer()
+                self.jitter_buffers[username] = jitter_buffer
+            jitter_buffer.put(message.get('seq', 0), pcm, message.get('ts'))
+            
+            if self.playout_thread is None or not self.playout_thread.is_alive():
+                if not self.init_audio_output():
                     return
-
-            if self.stream_out and self.stream_out.is_active():
-                try:
-                    self.stream_out.write(audio_data)
-                except Exception as e:
-                    print(f"Audio playback error: {e}")
-                    try:
-                        self.stream_out.stop_stream()
-                        self.stream_out.close()
-                    except:
-                        pass
-                    try:
-                        if self.audio_out:
-                            self.audio_out.terminate()
-                    except:
-                        pass
-                    self.stream_out = None
-                    self.audio_out = None
+                self.playout_thread = threading.Thread(target=self.play_audio)
+                self.playout_thread.daemon = True
+                self.playout_thread.start()
         except Exception as e:
             print(f"Audio frame handling error: {e}")
             return
     
-    def handle_screen_share_frame(self, message):
+    def play_audio(self):
+        """Playout clock: every frame interval, take one frame from each sender's jitter buffer and mix."""
+        frame_seconds = self.audio_frame_samples / AUDIO_RATE
         try:
-            frame_data = base64.b64decode(message['frame'])
-            frame = cv2.imdecode(np.frombuffer(frame_data, np.uint8), cv2.IMREAD_COLOR)
-            self.shared_screen_frame = frame
+            output_latency = self.stream_out.get_output_latency()
+        except Exception:
+            output_latency = 0.0
+        next_tick = time.monotonic()
+        while self.running and self.stream_out:
+            next_tick += frame_seconds
+            delay = next_tick - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            elif delay < -frame_seconds * 5:
+                # Fell far behind (e.g. system stall); resynchronize instead of bursting
+                next_tick = time.monotonic()
+            
+            frames = []
+            wall = time.time()
+            for username, jitter_buffer in list(self.jitter_buffers.items()):
+                frame = jitter_buffer.pop()
+                if frame is not None:
+                    frames.append(frame)
+                    self.get_av_sync(username).on_audio_played(jitter_buffer.playout_ts, wall, output_latency)
+            if not frames:
+                continue
+            
+            if len(frames) == 1:
+                mixed = frames[0]
+            else:
+                length = max(len(f) for f in frames)
+                mixed = np.zeros(length, dtype=np.int32)
+                for f in frames:
+                    mixed[:len(f)] += f
+                mixed = np.clip(mixed, -32768, 32767).astype(np.int16)
             
-            if self.current_page == 0 and self.screen_share_active:
-                self.screen_share_frame_signal.emit(frame)
+            try:
+                self.stream_out.write(mixed.tobytes())
+            except Exception as e:
+                print(f"Audio playback error: {e}")
+                try:
+                    self.stream_out.stop_stream()
+                    self.stream_out.close()
+                except:
+                    pass
+                try:
+                    if self.audio_out:
+                        self.audio_out.terminate()
+                except:
+                    pass
+                self.stream_out = None
+                self.audio_out = None
+                break
+    
+    def handle_screen_share_frame(self, header, payload):
+        try:
+            thumb = header.get('tier') == 'thumb'
+            canvas = self.screen_thumb_canvas if thumb else self.screen_canvas
+            with self.screen_canvas_lock:
+                if not thumb:
+                    reduction = decode_reduction((header.get('width'), header.get('height')), self.screen_view_size)
+                    canvas.set_reduction(reduction)
+                applied = canvas.apply(header, payload)
+            if not applied:
+                # Tiles before the first keyframe; ask the relay for its cached screen
+                self.request_screen_sync()
+                return
+            if not thumb and reduction < canvas.reduction:
+                # The view grew since the last keyframe: resync now rather than waiting for the next one
+                self.request_screen_sync()
+            
+            # Decode only what is on screen; render_screen_canvas catches up when it becomes visible
+            if thumb:
+                if self.screen_viewport == 'thumb':
+                    self.screen_thumb_signal.emit(self.render_screen_canvas(thumb=True))
+            elif self.screen_viewport == 'full' and self.current_page == 0 and self.screen_share_active:
+                self.screen_share_frame_signal.emit(self.render_screen_canvas())
         except Exception as e:
             pass
     
+    def render_screen_canvas(self, thumb=False):
+        """Decode screen updates queued while the view was hidden. Returns a copy of the canvas, or None."""
+        canvas = self.screen_thumb_canvas if thumb else self.screen_canvas
+        with self.screen_canvas_lock:
+            frame = canvas.render()
+            frame = frame.copy() if frame is not None else None
+        if frame is not None and not thumb:
+            self.shared_screen_frame = frame
+        return frame
+    
+    def current_screen_viewport(self):
+        if self.isMinimized():
+            return 'hidden'
+        if self.screen_share_active and self.current_page != 0:
+            return 'thumb'
+        return 'full'
+    
+    def update_screen_viewport(self):
+        """Tell the relay which screen-share tier this window shows, so it only sends what gets rendered."""
+        viewport = self.current_screen_viewport()
+        watching = self.screen_share_active and self.screen_share_user != self.username
+        show_thumb = watching and viewport == 'thumb'
+        if show_thumb and not self.screen_thumb_label.isVisible():
+            self.screen_thumb_label.show()
+            frame = self.render_screen_canvas(thumb=True)
+            if frame is not None:
+                self.update_screen_thumbnail(frame)
+        elif not show_thumb:
+            self.screen_thumb_label.hide()
+        if viewport == self.screen_viewport or not self.screen_socket:
+            return
+        self.screen_viewport = viewport
+        try:
+            with self.screen_send_lock:
+                self.screen_socket.sendall(pack_frame({'type': 'screen_share', 'action': 'viewport', 'tier': viewport}))
+        except Exception:
+            pass
+    
+    def update_screen_thumbnail(self, frame):
+        if not self.screen_thumb_label.isVisible():
+            return
+        frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+        height, width = frame_rgb.shape[:2]
+        q_image = QImage(frame_rgb.data, width, height, 3 * width, QImage.Format.Format_RGB888)
+        pixmap = QPixmap.fromImage(q_image).scaled(self.screen_thumb_label.size(), Qt.AspectRatioMode.KeepAspectRatio,
+                                                   Qt.TransformationMode.SmoothTransformation)
+        self.screen_thumb_label.setPixmap(pixmap)
+        self.screen_thumb_label.setToolTip(f"Screen shared by {self.screen_share_user}")
+    
+    def request_screen_sync(self):
+        """Ask the relay to resend the presenter's latest full screen (throttled to once a second)."""
+        now = time.time()
+        if not self.screen_socket or self.screen_share_enabled or now - self.screen_sync_requested_at < 1.0:
+            return
+        self.screen_sync_requested_at = now
+        try:
+            with self.screen_send_lock:
+                self.screen_socket.sendall(pack_frame({'type': 'screen_share', 'action': 'sync'}))
+        except Exception:
+            pass
+    
     def log_activity(self, message):
         """Add a message to the activity log"""
         timestamp = time.strftime('%H:%M:%S')
@@ -702,7 +2112,9 @@ class ConferenceClient(QMainWindow):
                 self.participants[username] = {
                     'video': p['video'],
                     'audio': p['audio'],
-                    'frame': None
+                    'frame': None,
+                    # Newest received JPEG, decoded only once the participant is on screen
+                    'frame_data': None
                 }
             else:
                 old_video_status = self.participants[username]['video']
@@ -712,13 +2124,18 @@ class ConferenceClient(QMainWindow):
                 self.participants[username]['audio'] = p['audio']
                 
                 if old_video_status and not new_video_status:
-                    self.participants[username]['frame'] = None
+                    with self.video_lock:
+                        self.participants[username]['frame'] = None
+                        self.participants[username]['frame_data'] = None
                     if username in self.video_labels:
                         self.clear_user_video(username)
         
         for username in list(self.participants.keys()):
             if username not in current_usernames:
                 del self.participants[username]
+                self.jitter_buffers.pop(username, None)
+                self.av_sync.pop(username, None)
+                self.pending_video.pop(username, None)
         
         self.participant_list.clear()
         for username in self.participants.keys():
@@ -728,7 +2145,9 @@ class ConferenceClient(QMainWindow):
                 status += "📹 "
             if p_data['audio']:
                 status += "🎤 "
-            self.participant_list.addItem(f"{username} {status}")
+            item = QListWidgetItem(f"{username} {status}")
+            item.setData(Qt.ItemDataRole.UserRole, username)
+            self.participant_list.addItem(item)
         
         if not (self.screen_share_active and self.current_page == 0):
             self.update_video_display()
@@ -752,8 +2171,9 @@ class ConferenceClient(QMainWindow):
         
         self.video_labels.clear()
         QApplication.processEvents()
+        self.update_screen_viewport()
         
-        participant_list = list(self.participants.keys())
+        participant_list = self.ordered_participants()
         total_participants = len(participant_list)
         
         if self.screen_share_active:
@@ -837,6 +2257,8 @@ class ConferenceClient(QMainWindow):
             
             participant_data = self.participants[username]
             mic_status = "🎤" if participant_data['audio'] else "🔇"
+            if username == self.dominant_speaker:
+                mic_status = "🔊"
             mic_label = QLabel(mic_status)
             mic_label.setStyleSheet("font-size: 14px; background: transparent;")
             info_layout.addWidget(mic_label)
@@ -853,11 +2275,41 @@ class ConferenceClient(QMainWindow):
                 'cell_widget': cell_widget
             }
             
-            if participant_data['frame'] is not None:
-                self.update_video_frame(username, participant_data['frame'])
+            frame = self.decode_video(username)
+            if frame is not None:
+                self.update_video_frame(username, frame)
         
         self.page_label.setText(f"Page {self.current_page + 1}/{total_pages}")
     
+    def ordered_participants(self):
+        """Participants in display order: active speakers (by relay ranking) first, then join order."""
+        participant_list = list(self.participants.keys())
+        if not self.auto_place_speakers:
+            return participant_list
+        speakers = [u for u in self.speaker_ranking if u in self.participants]
+        return speakers + [u for u in participant_list if u not in speakers]
+    
+    def handle_active_speaker(self, message):
+        previous = self.dominant_speaker
+        self.dominant_speaker = message.get('username')
+        self.speaker_ranking = message.get('ranking', [])
+        
+        for username in (previous, self.dominant_speaker):
+            if username in self.video_labels:
+                participant_data = self.participants.get(username, {})
+                mic_status = "🎤" if participant_data.get('audio') else "🔇"
+                if username == self.dominant_speaker:
+                    mic_status = "🔊"
+                self.video_labels[username]['mic_label'].setText(mic_status)
+        
+        # Reorder the first participant page when the ranking changes what it shows. A user browsing
+        # another page stays where they are; the speakers are waiting on the first page.
+        first_page = 1 if self.screen_share_active else 0
+        if self.auto_place_speakers and self.current_page == first_page:
+            shown = self.ordered_participants()[:self.participants_per_page]
+            if shown != list(self.video_labels):
+                self.update_video_display()
+    
     def update_video_frame(self, username, frame):
         if username in self.video_labels:
             try:
@@ -872,6 +2324,7 @@ class ConferenceClient(QMainWindow):
                 cell_size = cell_widget.size()
                 available_width = max(cell_size.width() - 10, 100)
                 available_height = max(cell_size.height() - 40, 100)
+                self.video_view_sizes[username] = (available_width, available_height)
                 
                 pixmap = QPixmap.fromImage(q_image)
                 scaled_pixmap = pixmap.scaled(
@@ -922,6 +2375,8 @@ class ConferenceClient(QMainWindow):
             self.screen_share_label.setFixedSize(area_size)
         self.screen_share_label.setScaledContents(True)
         screen_container_layout.addWidget(self.screen_share_label)
+        if area_size.width() > 0 and area_size.height() > 0:
+            self.screen_view_size = (area_size.width(), area_size.height())
         
         # Presenter overlay removed per UX request
         
@@ -937,6 +2392,9 @@ class ConferenceClient(QMainWindow):
         self.video_layout.setRowStretch(0, 1)
         self.video_layout.setColumnStretch(0, 1)
         
+        if self.screen_share_user != self.username:
+            # Catch up on updates that arrived while the screen wasn't shown
+            self.render_screen_canvas()
         if self.shared_screen_frame is not None:
             self.update_screen_share_display(self.shared_screen_frame)
         
@@ -945,6 +2403,7 @@ class ConferenceClient(QMainWindow):
         participant_list = list(self.participants.keys())
         total_pages = 1 + max(1, (len(participant_list) - 1) // self.participants_per_page + 1)
         self.page_label.setText(f"Page 1/{total_pages} - Screen Share")
+        self.update_screen_viewport()
     
     def update_screen_share_display(self, frame):
         try:
@@ -960,11 +2419,42 @@ class ConferenceClient(QMainWindow):
             target_size = self.video_frame.size()
             if target_size.width() <= 0 or target_size.height() <= 0:
                 target_size = self.screen_share_label.size()
-            scaled_pixmap = pixmap.scaled(target_size, Qt.AspectRatioMode.KeepAspectRatio, Qt.TransformationMode.SmoothTransformation)
-            self.screen_share_label.setPixmap(scaled_pixmap)
-            self.screen_share_label.setText("")
+            self.screen_preview_size = (target_size.width(), target_size.height()) if target_size.width() > 0 else None
+            self.screen_share_pixmap = pixmap.scaled(target_size, Qt.AspectRatioMode.KeepAspectRatio, Qt.TransformationMode.SmoothTransformation)
+            self.render_screen_cursor()
         except Exception as e:
             pass
+        finally:
+            if self.screen_pipeline is not None:
+                # Hand a presenter preview buffer back; the pixmap no longer refers to it
+                self.screen_pipeline.release_preview(frame)
+    
+    def handle_screen_cursor(self, message):
+        username = message.get('username')
+        if username == self.username or username != self.screen_share_user:
+            return
+        self.screen_cursor = message
+        self.render_screen_cursor()
+    
+    def render_screen_cursor(self):
+        """Show the last screen frame with the presenter's cursor drawn over it.
+        Captured frames never contain the cursor, so pointing doesn't dirty any tiles."""
+        if not self.screen_share_label or self.screen_share_pixmap is None:
+            return
+        pixmap = self.screen_share_pixmap
+        cursor = self.screen_cursor
+        if cursor and cursor.get('visible'):
+            pixmap = pixmap.copy()
+            x = cursor['x'] * pixmap.width()
+            y = cursor['y'] * pixmap.height()
+            painter = QPainter(pixmap)
+            painter.setRenderHint(QPainter.RenderHint.Antialiasing)
+            painter.setPen(QPen(QColor('white'), 1.5))
+            painter.setBrush(QColor('black'))
+            painter.drawPolygon(QPolygonF([QPointF(x + dx, y + dy) for dx, dy in CURSOR_ARROW]))
+            painter.end()
+        self.screen_share_label.setPixmap(pixmap)
+        self.screen_share_label.setText("")
     
     def update_presenter_overlay(self, frame):
         try:
@@ -985,6 +2475,8 @@ class ConferenceClient(QMainWindow):
     
     def hide_screen_share(self):
         self.screen_share_label = None
+        self.screen_share_pixmap = None
+        self.screen_cursor = None
         self.screen_share_info = None
         self.presenter_overlay = None
         self.update_video_display()
@@ -993,6 +2485,8 @@ class ConferenceClient(QMainWindow):
         self.screen_share_active = True
         self.screen_share_user = username
         self.current_page = 0
+        # Frames travel on the screen channel and may have arrived before this start event;
+        # display_screen_share decodes whatever is queued
         self.shared_screen_frame = None
         if username != self.username:
             self.log_activity(f"🖥️ {username} started screen sharing")
@@ -1084,7 +2578,7 @@ class ConferenceClient(QMainWindow):
                 
                 message = json.dumps({'type': 'status_update', 'video': True})
                 try:
-                    self.tcp_socket.send(message.encode('utf-8'))
+                    self.send_tcp(message.encode('utf-8'))
                 except Exception:
                     pass
                 
@@ -1130,7 +2624,7 @@ class ConferenceClient(QMainWindow):
             
             message = json.dumps({'type': 'status_update', 'video': False})
             try:
-                self.tcp_socket.send(message.encode('utf-8'))
+                self.send_tcp(message.encode('utf-8'))
             except Exception:
                 pass
             
@@ -1143,14 +2637,16 @@ class ConferenceClient(QMainWindow):
         if not self.audio_enabled:
             try:
                 self.audio_in = pyaudio.PyAudio()
+                self.audio_ring.clear()
                 
                 try:
                     self.stream_in = self.audio_in.open(
                         format=pyaudio.paInt16,
                         channels=1,
-                        rate=16000,
+                        rate=AUDIO_RATE,
                         input=True,
-                        frames_per_buffer=2048
+                        frames_per_buffer=self.audio_frame_samples,
+                        stream_callback=self._audio_capture_callback
                     )
                 except OSError as e:
                     print(f"Default audio device failed: {e}")
@@ -1160,10 +2656,11 @@ class ConferenceClient(QMainWindow):
                             self.stream_in = self.audio_in.open(
                                 format=pyaudio.paInt16,
                                 channels=1,
-                                rate=16000,
+                                rate=AUDIO_RATE,
                                 input=True,
-                                frames_per_buffer=2048,
-                                input_device_index=i
+                                frames_per_buffer=self.audio_frame_samples,
+                                input_device_index=i,
+                                stream_callback=self._audio_capture_callback
                             )
                             print(f"Using audio device {i}")
                             break
@@ -1201,7 +2698,7 @@ class ConferenceClient(QMainWindow):
                 
                 message = json.dumps({'type': 'status_update', 'audio': True})
                 try:
-                    self.tcp_socket.send(message.encode('utf-8'))
+                    self.send_tcp(message.encode('utf-8'))
                 except Exception:
                     pass
                 
@@ -1236,21 +2733,28 @@ class ConferenceClient(QMainWindow):
             if self.stream_in:
                 self.stream_in.stop_stream()
                 self.stream_in.close()
+                self.stream_in = None
             if self.audio_in:
                 self.audio_in.terminate()
+                self.audio_in = None
+            self.audio_ring.clear()
             
             if self.username in self.participants:
                 self.participants[self.username]['audio'] = False
             
             message = json.dumps({'type': 'status_update', 'audio': False})
             try:
-                self.tcp_socket.send(message.encode('utf-8'))
+                self.send_tcp(message.encode('utf-8'))
             except Exception:
                 pass
     
     def toggle_screen_share(self):
         if not self.screen_share_enabled:
+            if not self.screen_socket:
+                QMessageBox.warning(self, "Screen Share", "The screen-share connection to the server is unavailable.")
+                return
             self.screen_share_enabled = True
+            self.screen_tiers = {'full'}
             self.screen_btn.setText("🖥️ Stop Sharing")
             self.screen_btn.setStyleSheet("""
                 QPushButton {
@@ -1279,15 +2783,18 @@ class ConferenceClient(QMainWindow):
             
             message = json.dumps({'type': 'screen_share', 'action': 'start', 'username': self.username})
             try:
-                self.tcp_socket.send(message.encode('utf-8'))
+                self.send_tcp(message.encode('utf-8'))
             except Exception:
                 pass
             
             screen_thread = threading.Thread(target=self.send_screen_share)
             screen_thread.daemon = True
             screen_thread.start()
+            self.last_cursor_sent = None
+            self.cursor_timer.start(16)
         else:
             self.screen_share_enabled = False
+            self.cursor_timer.stop()
             self.screen_btn.setText("🖥️ Share Screen")
             self.screen_btn.setStyleSheet("""
                 QPushButton {
@@ -1311,7 +2818,7 @@ class ConferenceClient(QMainWindow):
             
             message = json.dumps({'type': 'screen_share', 'action': 'stop', 'username': self.username})
             try:
-                self.tcp_socket.send(message.encode('utf-8'))
+                self.send_tcp(message.encode('utf-8'))
             except Exception:
                 pass
             
@@ -1321,6 +2828,40 @@ class ConferenceClient(QMainWindow):
             self.current_page = 0
             self.hide_screen_share()
     
+    def send_screen_cursor(self):
+        """Send the cursor position over the shared monitor as a tiny datagram: every tick while it
+        moves, once a second while it rests (for viewers who join late)."""
+        area = self.screen_capture_area
+        if not self.screen_share_enabled or area is None or not self.udp_socket:
+            return
+        pos = QCursor.pos()
+        screen = QGuiApplication.screenAt(pos)
+        # Qt reports logical pixels; the capture area is in physical ones
+        ratio = screen.devicePixelRatio() if screen else 1.0
+        left, top, width, height = area
+        x = (pos.x() * ratio - left) / width
+        y = (pos.y() * ratio - top) / height
+        cursor = (round(x, 4), round(y, 4), 0.0 <= x < 1.0 and 0.0 <= y < 1.0)
+        
+        now = time.time()
+        if cursor == self.last_cursor_sent and now - self.last_cursor_sent_at < 1.0:
+            return
+        self.last_cursor_sent = cursor
+        self.last_cursor_sent_at = now
+        
+        message = json.dumps({
+            'type': 'screen_cursor',
+            'username': self.username,
+            'x': cursor[0],
+            'y': cursor[1],
+            'visible': cursor[2],
+            'shape': 'arrow'
+        })
+        try:
+            self.udp_socket.sendto(message.encode('utf-8'), (self.server_host, self.udp_port))
+        except Exception:
+            pass
+    
     def send_video(self):
         while self.video_enabled and self.running:
             try:
@@ -1329,6 +2870,7 @@ class ConferenceClient(QMainWindow):
                     time.sleep(0.1)
                     continue
                 
+                capture_ts = time.time()
                 frame = cv2.resize(frame, (320, 240))
                 self.participants[self.username]['frame'] = frame
                 
@@ -1338,6 +2880,7 @@ class ConferenceClient(QMainWindow):
                 message = json.dumps({
                     'type': 'video_frame',
                     'username': self.username,
+                    'ts': capture_ts,
                     'frame': frame_data
                 })
                 
@@ -1349,20 +2892,45 @@ class ConferenceClient(QMainWindow):
                 time.sleep(0.1)
                 continue
     
+    def _audio_capture_callback(self, in_data, frame_count, time_info, status):
+        """PyAudio callback: runs on the audio thread, so only hand the frame off."""
+        if self.audio_enabled:
+            # Wall-clock capture time of the first sample in this frame
+            self.audio_ring.push((time.time() - frame_count / AUDIO_RATE, in_data))
+        return (None, pyaudio.paContinue)
+    
+    @staticmethod
+    def _audio_level(data):
+        """Frame level in dBov (-127 = silence, 0 = full scale) for the relay's speaker ranking."""
+        samples = np.frombuffer(data, dtype=np.int16).astype(np.float32)
+        if samples.size == 0:
+            return -127
+        rms = float(np.sqrt(np.mean(samples * samples)))
+        if rms < 1.0:
+            return -127
+        return max(-127, int(round(20 * np.log10(rms / 32768.0))))
+    
     def send_audio(self):
+        # Packetize each captured frame as soon as the callback delivers it
         while self.audio_enabled and self.running:
+            frame = self.audio_ring.pop()
+            if frame is None:
+                continue
+            capture_ts, data = frame
             try:
-                data = self.stream_in.read(2048, exception_on_overflow=False)
                 audio_data = base64.b64encode(data).decode('utf-8')
                 
                 message = json.dumps({
                     'type': 'audio_frame',
                     'username': self.username,
+                    'seq': self.audio_seq,
+                    'ts': capture_ts,
+                    'level': self._audio_level(data),
                     'audio': audio_data
                 })
+                self.audio_seq += 1
                 
                 self.udp_socket.sendto(message.encode('utf-8'), (self.server_host, self.udp_port))
-                time.sleep(0.05)
             except Exception as e:
                 print(f"Audio capture/send error: {e}")
                 self.audio_enabled = False
@@ -1381,126 +2949,46 @@ class ConferenceClient(QMainWindow):
                     pass
                 break
     
+    def wait_for_screen_window(self):
+        """Block while too many screen frames or bytes are unacknowledged.
+        Returns False once sharing has stopped."""
+        with self.screen_flow:
+            while self.screen_share_enabled and self.running and self.screen_in_flight and (
+                    len(self.screen_in_flight) >= self.screen_max_frames_in_flight
+                    or sum(self.screen_in_flight.values()) >= self.screen_max_bytes_in_flight):
+                self.screen_flow.wait(0.05)
+        return self.screen_share_enabled and self.running
+    
+    def send_screen_payload(self, header, payload):
+        with self.screen_flow:
+            self.screen_seq += 1
+            seq = self.screen_seq
+        
+        data = pack_frame({
+            'type': 'screen_share',
+            'username': self.username,
+            'seq': seq,
+            **header
+        }, payload)
+        
+        with self.screen_flow:
+            self.screen_in_flight[seq] = len(data)
+        with self.screen_send_lock:
+            self.screen_socket.sendall(data)
+    
+    def handle_screen_ack(self, seq):
+        with self.screen_flow:
+            for sent_seq in [s for s in self.screen_in_flight if s <= seq]:
+                del self.screen_in_flight[sent_seq]
+            self.screen_flow.notify_all()
+    
     def send_screen_share(self):
+        print(f"[{self.username}] Starting screen share")
+        with self.screen_flow:
+            self.screen_in_flight.clear()
+        pipeline = ScreenSharePipeline(self)
         try:
-            import platform
-            system = platform.system()
-            
-            print(f"[{self.username}] Starting screen share on {system}")
-            
-            if system == "Linux":
-                try:
-                    from PIL import ImageGrab
-                    print(f"[{self.username}] Using PIL ImageGrab for Linux")
-                    
-                    frame_count = 0
-                    
-                    while self.screen_share_enabled and self.running:
-                        try:
-                            screenshot = ImageGrab.grab()
-                            frame = np.array(screenshot)
-                            frame = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
-                            # Higher quality for TCP relay
-                            frame = cv2.resize(frame, (1280, 720))
-                            display_frame = frame.copy()
-                            self.shared_screen_frame = display_frame
-
-                            if self.current_page == 0:
-                                self.screen_share_frame_signal.emit(display_frame)
-
-                            _, buffer = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, 80])
-                            frame_data = base64.b64encode(buffer).decode('utf-8')
-                            
-                            message = json.dumps({
-                                'type': 'screen_share',
-                                'action': 'frame',
-                                'username': self.username,
-                                'frame': frame_data
-                            })
-                            
-                            try:
-                                self.tcp_socket.send(message.encode('utf-8'))
-                                frame_count += 1
-                                
-                                if frame_count % 50 == 0:
-                                    print(f"[INFO] Sent {frame_count} frames via TCP")
-                                    
-                            except socket.error as e:
-                                print(f"[ERROR] TCP send failed: {e}")
-                                break
-                            
-                            time.sleep(0.1)
-                            
-                        except Exception as e:
-                            print(f"[ERROR] PIL screen capture error: {e}")
-                            QMessageBox.critical(self, "Screen Share Error", 
-                                f"Linux screen capture failed: {e}\n\nTry: pip install pillow\nOr run: xhost +local:")
-                            self.screen_share_enabled = False
-                            break
-                    
-                    print(f"[INFO] Screen share stopped. Sent {frame_count} frames")
-                            
-                except Exception as e:
-                    print(f"[ERROR] Linux screen share init failed: {e}")
-                    QMessageBox.critical(self, "Error", f"Screen capture failed:\n{e}")
-                    self.screen_share_enabled = False
-                    return
-                    
-            else:
-                print(f"[{self.username}] Using mss for screen capture")
-                
-                with mss() as sct:
-                    try:
-                        monitor = sct.monitors[1]
-                    except:
-                        monitor = sct.monitors[0]
-                    
-                    frame_count = 0
-                    
-                    print(f"[INFO] Capturing monitor: {monitor}")
-                    
-                    while self.screen_share_enabled and self.running:
-                        try:
-                            screenshot = sct.grab(monitor)
-                            frame = np.array(screenshot)
-                            frame = cv2.cvtColor(frame, cv2.COLOR_BGRA2BGR)
-                            # Higher quality for TCP relay
-                            frame = cv2.resize(frame, (1280, 720))
-
-                            self.shared_screen_frame = frame.copy()
-                            if self.current_page == 0:
-                                self.screen_share_frame_signal.emit(frame.copy())
-
-                            _, buffer = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, 80])
-                            frame_data = base64.b64encode(buffer).decode('utf-8')
-                            
-                            message = json.dumps({
-                                'type': 'screen_share',
-                                'action': 'frame',
-                                'username': self.username,
-                                'frame': frame_data
-                            })
-                            
-                            try:
-                                self.tcp_socket.send(message.encode('utf-8'))
-                                frame_count += 1
-                                
-                                if frame_count % 50 == 0:
-                                    print(f"[INFO] Sent {frame_count} frames via TCP")
-                                    
-                            except socket.error as e:
-                                print(f"[ERROR] TCP send failed: {e}")
-                                break
-                            
-                            time.sleep(0.1)
-                            
-                        except Exception as e:
-                            print(f"[ERROR] Screen share error: {e}")
-                            time.sleep(0.5)
-                            continue
-                    
-                    print(f"[INFO] Screen share stopped. Sent {frame_count} frames")
-                        
+            pipeline.run()
         except Exception as e:
             print(f"[FATAL] Screen share failed: {e}")
             
@@ -1552,6 +3040,33 @@ class ConferenceClient(QMainWindow):
         
         layout.addWidget(recipient_group)
         
+        search_layout = QHBoxLayout()
+        search_entry = QLineEdit()
+        search_entry.setPlaceholderText("🔍 Search chat history...")
+        search_entry.setClearButtonEnabled(True)
+        search_entry.setStyleSheet("""
+            QLineEdit {
+                background: rgba(255, 255, 255, 0.15);
+                color: white;
+                border: 2px solid rgba(102, 126, 234, 0.5);
+                border-radius: 8px;
+                padding: 6px;
+                font-size: 11px;
+            }
+        """)
+        # Searching replaces the conversation with the matches; clearing the box brings it back
+        search_entry.returnPressed.connect(lambda: self.load_chat_history(search_entry.text().strip()))
+        search_entry.textChanged.connect(lambda text: self.load_chat_history('') if not text and chat_dialog.query else None)
+        search_layout.addWidget(search_entry)
+        
+        chat_dialog.more_btn = QPushButton("Load earlier")
+        chat_dialog.more_btn.setEnabled(False)
+        chat_dialog.more_btn.setStyleSheet("color: white; padding: 6px;")
+        chat_dialog.more_btn.clicked.connect(
+            lambda: self.request_chat_history(chat_dialog.oldest, chat_dialog.query))
+        search_layout.addWidget(chat_dialog.more_btn)
+        layout.addLayout(search_layout)
+        
         chat_display = QTextEdit()
         chat_display.setReadOnly(True)
         chat_display.setStyleSheet("""
@@ -1564,9 +3079,7 @@ class ConferenceClient(QMainWindow):
                 font-size: 11px;
             }
         """)
-        
-        for msg in self.chat_history:
-            chat_display.append(msg.strip())
+        chat_dialog.chat_display = chat_display
         
         layout.addWidget(chat_display)
         
@@ -1607,7 +3120,7 @@ class ConferenceClient(QMainWindow):
                         'message': msg
                     })
                     try:
-                        self.tcp_socket.send(message.encode('utf-8'))
+                        self.send_tcp(message.encode('utf-8'))
                         message_entry.clear()
                     except Exception as e:
                         QMessageBox.critical(self, "Error", str(e))
@@ -1639,15 +3152,71 @@ class ConferenceClient(QMainWindow):
         message_entry.returnPressed.connect(send_chat)
         layout.addWidget(message_frame)
         
-        self.chat_windows.append(chat_display)
-        chat_dialog.finished.connect(lambda: self.chat_windows.remove(chat_display) if chat_display in self.chat_windows else None)
+        # Messages shown, oldest first; only the pages the user scrolls back through are held.
+        # oldest is the id of the earliest message fetched from the history, where the next page ends.
+        chat_dialog.messages = []
+        chat_dialog.oldest = None
+        chat_dialog.query = ''
+        self.chat_dialog = chat_dialog
+        self.load_chat_history('')
         chat_dialog.exec()
+        self.chat_dialog = None
+    
+    def load_chat_history(self, query):
+        """Show the latest page of the conversation, or of the messages matching query."""
+        dialog = self.chat_dialog
+        if dialog is None:
+            return
+        dialog.query = query
+        dialog.messages = []
+        dialog.oldest = None
+        dialog.chat_display.clear()
+        dialog.more_btn.setEnabled(False)
+        self.request_chat_history(None, query)
+    
+    def request_chat_history(self, before, query=''):
+        request = {'type': 'chat_history', 'limit': self.chat_page_size, 'query': query}
+        if before is not None:
+            request['before'] = before
+        try:
+            self.send_tcp(json.dumps(request).encode('utf-8'))
+        except Exception as e:
+            print(f"Chat history request error: {e}")
+    
+    def handle_chat_history(self, message):
+        dialog = self.chat_dialog
+        if dialog is None or message.get('query', '') != dialog.query or message.get('before') != dialog.oldest:
+            return
+        first_page = dialog.oldest is None
+        # Live messages may already have arrived while this page was on its way
+        shown = {m.get('id') for m in dialog.messages}
+        page = [m for m in message.get('messages', []) if m['id'] not in shown]
+        if message.get('messages'):
+            dialog.oldest = message['messages'][0]['id']
+        dialog.messages = page + dialog.messages
+        dialog.chat_display.setPlainText('\n'.join(self.format_chat_message(m) for m in dialog.messages))
+        if first_page:
+            dialog.chat_display.moveCursor(QTextCursor.MoveOperation.End)
+        dialog.more_btn.setEnabled(bool(message.get('has_more')))
     
     def handle_chat_message(self, message):
+        dialog = self.chat_dialog
+        if dialog is None or dialog.query:
+            return
+        dialog.messages.append(message)
+        try:
+            dialog.chat_display.append(self.format_chat_message(message))
+        except:
+            pass
+    
+    def format_chat_message(self, message):
         from_user = message.get('from', 'Unknown')
         msg_text = message.get('message', '')
         recipient = message.get('recipient', 'everyone')
-        timestamp = time.strftime('%H:%M:%S', time.localtime(message.get('timestamp', time.time())))
+        sent_at = time.localtime(message.get('timestamp', time.time()))
+        # History can go back days: older messages show their date
+        day = '' if sent_at[:3] == time.localtime()[:3] else time.strftime('%b %d ', sent_at)
+        timestamp = day + time.strftime('%H:%M:%S', sent_at)
         
         if recipient == 'everyone':
             chat_msg = f"[{timestamp}] {from_user}: {msg_text}"
@@ -1656,28 +3225,82 @@ class ConferenceClient(QMainWindow):
                 chat_msg = f"[{timestamp}] You (to {recipient}): {msg_text}"
             else:
                 chat_msg = f"[{timestamp}] {from_user} (private): {msg_text}"
+        return chat_msg
+    
+    def open_file_catalog(self):
+        if self.catalog_dialog is not None:
+            self.catalog_dialog.raise_()
+            return
+        dialog = QDialog(self)
+        dialog.setWindowTitle("🗂️ Shared Files")
+        dialog.setGeometry(300, 300, 480, 400)
+        layout = QVBoxLayout(dialog)
         
-        self.chat_history.append(chat_msg + "\n")
+        dialog.file_list = QListWidget()
+        dialog.file_list.itemDoubleClicked.connect(lambda item: self.download_catalog_file(item))
+        layout.addWidget(dialog.file_list)
         
-        for chat_display in self.chat_windows:
-            try:
-                chat_display.append(chat_msg)
-            except:
-                pass
+        button_layout = QHBoxLayout()
+        download_btn = QPushButton("📥 Download")
+        download_btn.clicked.connect(lambda: self.download_catalog_file(dialog.file_list.currentItem()))
+        button_layout.addWidget(download_btn)
+        
+        dialog.more_btn = QPushButton("Load more")
+        dialog.more_btn.setEnabled(False)
+        dialog.more_btn.clicked.connect(lambda: self.request_file_catalog(dialog.file_list.count()))
+        button_layout.addWidget(dialog.more_btn)
+        
+        close_btn = QPushButton("Close")
+        close_btn.clicked.connect(dialog.close)
+        button_layout.addWidget(close_btn)
+        layout.addLayout(button_layout)
+        
+        dialog.finished.connect(lambda _: setattr(self, 'catalog_dialog', None))
+        self.catalog_dialog = dialog
+        dialog.show()
+        self.request_file_catalog(0)
+    
+    def request_file_catalog(self, offset):
+        try:
+            self.send_tcp(json.dumps({
+                'type': 'file_catalog',
+                'offset': offset,
+                'limit': self.catalog_page_size
+            }).encode('utf-8'))
+        except Exception as e:
+            print(f"File catalog request error: {e}")
+    
+    def handle_file_catalog(self, message):
+        dialog = self.catalog_dialog
+        if dialog is None or message.get('offset', 0) != dialog.file_list.count():
+            return
+        for share in message.get('files', []):
+            target = "" if share['recipient'] == 'everyone' else f" → {share['recipient']}"
+            shared_at = time.strftime('%H:%M', time.localtime(share['time']))
+            item = QListWidgetItem(f"{share['filename']} ({share['size'] / (1024 * 1024):.2f} MB)\n"
+                                   f"   {share['uploaded_by']}{target}, {shared_at}{' · direct' if share['direct'] else ''}")
+            item.setData(Qt.ItemDataRole.UserRole, share)
+            dialog.file_list.addItem(item)
+        dialog.more_btn.setEnabled(bool(message.get('has_more')))
+    
+    def download_catalog_file(self, item):
+        if item is None:
+            return
+        share = item.data(Qt.ItemDataRole.UserRole)
+        try:
+            self.send_tcp(json.dumps({
+                'type': 'file_download',
+                'hash': share['hash'],
+                'filename': share['filename']
+            }).encode('utf-8'))
+        except Exception as e:
+            QMessageBox.critical(self, "Error", f"Could not request file: {e}")
     
     def open_file_transfer(self):
         filepath, _ = QFileDialog.getOpenFileName(self, "Select file")
         if not filepath:
             return
         
-        try:
-            import os
-            if os.path.getsize(filepath) > 10 * 1024 * 1024:
-                QMessageBox.warning(self, "Warning", "File too large! Max 10MB")
-                return
-        except:
-            pass
-        
         file_dialog = QDialog(self)
         file_dialog.setWindowTitle("Share File")
         file_dialog.setGeometry(300, 300, 400, 300)
@@ -1712,37 +3335,17 @@ class ConferenceClient(QMainWindow):
                 recipient_buttons[username] = radio
         
         def send_file():
-            try:
-                with open(filepath, 'rb') as f:
-                    file_data = f.read()
-                
-                recipient = None
-                for name, radio in recipient_buttons.items():
-                    if radio.isChecked():
-                        recipient = name
-                        break
-                
-                # Always upload to server with recipient info
-                message = json.dumps({
-                    'type': 'file_upload',
-                    'recipient': recipient,
-                    'filename': filename,
-                    'size': file_size,
-                    'data': base64.b64encode(file_data).decode('utf-8')
-                })
-                
-                self.tcp_socket.send(message.encode('utf-8'))
-                
-                # Log activity
-                if recipient == 'everyone':
-                    self.log_activity(f"📁 Shared {filename} with everyone")
-                else:
-                    self.log_activity(f"📁 Shared {filename} with {recipient}")
-                
-                QMessageBox.information(self, "Success", f"File shared with {recipient}!")
-                file_dialog.accept()
-            except Exception as e:
-                QMessageBox.critical(self, "Error", str(e))
+            recipient = None
+            for name, radio in recipient_buttons.items():
+                if radio.isChecked():
+                    recipient = name
+                    break
+            
+            # Hashing and sending run in the upload workers, off the GUI thread
+            transfer_id = self.uploads.add(filepath, filename, recipient)
+            self.show_transfer_progress(transfer_id, self.uploads, "📤 Upload", f"Uploading {filename} ({size_mb:.2f} MB)")
+            self.log_activity(f"📁 Preparing {filename} for {recipient}")
+            file_dialog.accept()
         
         button_layout = QHBoxLayout()
         send_btn = QPushButton("Share")
@@ -1756,22 +3359,56 @@ class ConferenceClient(QMainWindow):
         layout.addLayout(button_layout)
         file_dialog.exec()
     
+    def handle_file_stored(self, message):
+        filename = message.get('filename', 'file')
+        recipient = message.get('recipient', 'everyone')
+        target = "everyone" if recipient == 'everyone' else recipient
+        self.log_activity(f"📁 Shared {filename} with {target}")
+    
+    def handle_file_uploaded(self, result):
+        self.close_transfer_progress(result['id'])
+        if result.get('cancelled'):
+            self.log_activity(f"📤 Cancelled upload of {result['filename']}")
+            return
+        if 'error' in result:
+            QMessageBox.critical(self, "Error", f"Could not upload {result['filename']}: {result['error']}")
+            return
+        if result['direct']:
+            self.log_activity(f"📤 Sharing {result['filename']} directly from this computer")
+            return
+        if not result['uploaded']:
+            self.log_activity(f"📤 {result['filename']} already on server, nothing uploaded")
+            return
+        if result.get('delta'):
+            self.log_activity(f"📤 Uploaded {result['filename']} as changes to the previous version: "
+                              f"sent {result['wire_bytes'] / 1024:.0f} KB of {result['size'] / (1024 * 1024):.1f} MB "
+                              f"in {result['seconds']:.1f} s")
+            return
+        megabytes = result['uploaded_bytes'] / (1024 * 1024)
+        rate = megabytes / max(result['seconds'], 1e-6)
+        sent = f", sent {result['wire_bytes'] / (1024 * 1024):.1f} MB {result['codec']}" if result['codec'] else ""
+        self.log_activity(f"📤 Uploaded {result['filename']}: {result['uploaded']}/{result['chunks']} chunks, "
+                          f"{megabytes:.1f} MB in {result['seconds']:.1f} s ({rate:.1f} MB/s{sent})")
+    
+    def handle_file_upload_request(self, message):
+        """A receiver couldn't connect to this machine: upload the file to the server for them."""
+        entry = self.peer_server.get(message.get('hash')) if self.peer_server else None
+        if entry is None or not os.path.exists(entry['path']):
+            print(f"Upload requested for unknown file {message.get('filename')}")
+            return
+        transfer_id = self.uploads.add(entry['path'], entry['filename'], entry['recipient'], relay=True)
+        self.show_transfer_progress(transfer_id, self.uploads, "📤 Upload",
+                                    f"Uploading {entry['filename']} for a participant who can't connect directly")
+    
     def handle_file_transfer(self, message):
         from_user = message.get('from', 'Unknown')
         filename = message.get('filename', 'file')
         
-        # Auto-accept and show save dialog
-        try:
-            file_data = base64.b64decode(message['data'])
-            save_path, _ = QFileDialog.getSaveFileName(self, f"Save file from {from_user}", filename)
-            
-            if save_path:
-                with open(save_path, 'wb') as f:
-                    f.write(file_data)
-                QMessageBox.information(self, "Success", f"File saved!")
-                self.log_activity(f"📥 Downloaded {filename} from {from_user}")
-        except Exception as e:
-            QMessageBox.critical(self, "Error", str(e))
+        # Auto-accept and show save dialog; decoding and writing happen in a download worker
+        save_path, _ = QFileDialog.getSaveFileName(self, f"Save file from {from_user}", filename)
+        if save_path:
+            transfer_id = self.downloads.save_inline(message, save_path)
+            self.show_transfer_progress(transfer_id, self.downloads, "📥 Download", f"Downloading {filename} from {from_user}")
     
     def handle_file_available(self, message):
         from_user = message.get('from', 'Unknown')
@@ -1795,13 +3432,60 @@ class ConferenceClient(QMainWindow):
             # Request download from server
             download_msg = json.dumps({
                 'type': 'file_download',
+                'hash': message.get('hash'),
                 'filename': filename
             })
             try:
-                self.tcp_socket.send(download_msg.encode('utf-8'))
+                self.send_tcp(download_msg.encode('utf-8'))
             except Exception as e:
                 QMessageBox.critical(self, "Error", f"Could not request file: {e}")
     
+    def handle_file_download_ready(self, message):
+        from_user = message.get('from', 'Unknown')
+        filename = message.get('filename', 'file')
+        save_path, _ = QFileDialog.getSaveFileName(self, f"Save file from {from_user}", filename)
+        if not save_path:
+            return
+        transfer_id = self.downloads.download(message, save_path)
+        self.show_transfer_progress(transfer_id, self.downloads, "📥 Download", f"Downloading {filename} from {from_user}")
+        self.log_activity(f"📥 Downloading {filename} from {from_user}")
+    
+    def show_transfer_progress(self, transfer_id, manager, title, text):
+        dialog = QProgressDialog(text, "Cancel", 0, 100, self)
+        dialog.setWindowTitle(title)
+        dialog.setWindowModality(Qt.WindowModality.NonModal)
+        dialog.setAutoClose(False)
+        dialog.setAutoReset(False)
+        dialog.setMinimumDuration(0)
+        dialog.canceled.connect(lambda: manager.cancel(transfer_id))
+        dialog.show()
+        self.transfer_dialogs[transfer_id] = dialog
+    
+    def close_transfer_progress(self, transfer_id):
+        dialog = self.transfer_dialogs.pop(transfer_id, None)
+        if dialog is not None:
+            dialog.close()
+    
+    def update_file_progress(self, progress):
+        dialog = self.transfer_dialogs.get(progress['id'])
+        if dialog is None:
+            return
+        size = progress['size']
+        dialog.setValue(int(progress['done'] * 100 / size) if size else 0)
+        dialog.setLabelText(f"{dialog.labelText().splitlines()[0]}\n"
+                            f"{progress['done'] / (1024 * 1024):.1f} of {size / (1024 * 1024):.1f} MB")
+    
+    def handle_file_downloaded(self, result):
+        self.close_transfer_progress(result['id'])
+        if result.get('cancelled'):
+            self.log_activity(f"📥 Cancelled download of {result['filename']}")
+            return
+        if 'error' in result:
+            QMessageBox.critical(self, "Error", f"Could not download {result['filename']}: {result['error']}")
+            return
+        rate = result['size'] / max(result['seconds'], 1e-6) / (1024 * 1024)
+        self.log_activity(f"📥 Downloaded {result['filename']} from {result['from']} ({rate:.1f} MB/s)")
+    
     def handle_server_shutdown(self):
         """Handle server shutdown notification"""
         # Stop running flag
@@ -1850,6 +3534,13 @@ class ConferenceClient(QMainWindow):
                 self.tcp_socket.close()
             except:
                 pass
+        if self.screen_socket:
+            try:
+                self.screen_socket.close()
+            except:
+                pass
+        if self.peer_server:
+            self.peer_server.close()
         if self.udp_socket:
             try:
                 self.udp_socket.close()
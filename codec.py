@@ -0,0 +1,246 @@
+import time
+import cv2
+import numpy as np
+
+TILE_SIZE = 64
+# imdecode flags for decoding at 1/1, 1/2, 1/4 and 1/8 size (JPEG scales while decoding)
+DECODE_FLAGS = {1: cv2.IMREAD_COLOR, 2: cv2.IMREAD_REDUCED_COLOR_2, 4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8}
+
+def decode_reduction(source_size, view_size):
+    """Largest reduction (1, 2, 4 or 8) that still decodes an image of source_size (width, height)
+    at no less than the size it is shown at when fitted into view_size."""
+    if not source_size or not view_size or min(view_size) <= 0:
+        return 1
+    scale = min(view_size[0] / source_size[0], view_size[1] / source_size[1])
+    for reduction in (8, 4, 2):
+        if scale * reduction <= 1.0:
+            return reduction
+    return 1
+
+def decode_image(data, reduction=1):
+    return cv2.imdecode(np.frombuffer(data, np.uint8), DECODE_FLAGS[reduction])
+
+def stack_tiles(frame, positions, tile_size):
+    """Copy the tiles at positions into one (n, tile_size, tile_size, 3) array.
+    Partial tiles at the right and bottom edges are padded by repeating their last row/column,
+    which adds no colours and no edges."""
+    tiles = np.empty((len(positions), tile_size, tile_size, 3), dtype=np.uint8)
+    for i, (x, y) in enumerate(positions):
+        tile = frame[y:y + tile_size, x:x + tile_size]
+        th, tw = tile.shape[:2]
+        if (th, tw) != (tile_size, tile_size):
+            tile = cv2.copyMakeBorder(tile, 0, tile_size - th, 0, tile_size - tw, cv2.BORDER_REPLICATE)
+        tiles[i] = tile
+    return tiles
+
+def count_colours(tiles):
+    """Number of distinct BGR colours in each tile of a stack."""
+    pixels = tiles.reshape(len(tiles), -1, 3)
+    packed = (pixels[..., 0].astype(np.uint32) | (pixels[..., 1].astype(np.uint32) << 8)
+              | (pixels[..., 2].astype(np.uint32) << 16))
+    packed.sort(axis=1)
+    return (packed[:, 1:] != packed[:, :-1]).sum(axis=1) + 1
+
+def edge_density(tiles, threshold=48):
+    """Fraction of pixels in each tile with a sharp step to their right or lower neighbour
+    (glyph and widget edges)."""
+    n, ts = tiles.shape[:2]
+    gray = cv2.cvtColor(tiles.reshape(n * ts, ts, 3), cv2.COLOR_BGR2GRAY).reshape(n, ts, ts).astype(np.int16)
+    edges = np.zeros(gray.shape, dtype=bool)
+    edges[:, :, :-1] |= np.abs(np.diff(gray, axis=2)) > threshold
+    edges[:, :-1, :] |= np.abs(np.diff(gray, axis=1)) > threshold
+    return edges.mean(axis=(1, 2))
+
+class TileEncoder:
+    """Screen-share encoder that only sends the tiles that changed since the previous frame.
+    Each tile is classified by content: text and UI (few colours, or many sharp edges) is sent as
+    lossless PNG, photos and video as JPEG. Viewers decode either with cv2.imdecode.
+    A keyframe is sent first, on request, every keyframe_interval seconds for recovery,
+    and whenever so much changed that a keyframe is cheaper than the tiles.
+    """
+    def __init__(self, tile_size=TILE_SIZE, quality=80, keyframe_interval=10.0, max_dirty_ratio=0.5,
+                 palette_colours=256, text_edge_density=0.12, text_max_colours=1024):
+        self.tile_size = tile_size
+        self.quality = quality
+        self.keyframe_interval = keyframe_interval
+        self.max_dirty_ratio = max_dirty_ratio
+        self.palette_colours = palette_colours
+        self.text_edge_density = text_edge_density
+        self.text_max_colours = text_max_colours
+        self.prev = None
+        self.last_keyframe = 0.0
+        self.keyframe_bytes = 0
+        self.force_keyframe = False
+
+    def request_keyframe(self):
+        self.force_keyframe = True
+
+    def encode(self, frame):
+        """Return (header, payload) for this frame, or None if nothing changed.
+        Tile payloads are the tile images back to back; the header lists [x, y, length] for each."""
+        height, width = frame.shape[:2]
+        now = time.time()
+
+        if (self.prev is None or self.prev.shape != frame.shape or self.force_keyframe
+                or now - self.last_keyframe >= self.keyframe_interval):
+            return self._keyframe(frame, now)
+
+        dirty = self.dirty_tiles(frame)
+        if not dirty.any():
+            return None
+        if dirty.mean() > self.max_dirty_ratio:
+            return self._keyframe(frame, now)
+
+        ts = self.tile_size
+        positions = [(int(col) * ts, int(row) * ts) for row, col in zip(*np.nonzero(dirty))]
+        tiles = []
+        chunks = []
+        for (x, y), text in zip(positions, self.classify(frame, positions)):
+            buffer = self.encode_image(frame[y:y + ts, x:x + ts], text)
+            if buffer is not None:
+                tiles.append([x, y, len(buffer)])
+                chunks.append(buffer)
+
+        payload = b''.join(chunks)
+        if len(payload) > self.keyframe_bytes:
+            # Lossless tiles of scrolled text can outweigh a whole-frame image
+            return self._keyframe(frame, now)
+        np.copyto(self.prev, frame)
+        return {'action': 'tiles', 'width': width, 'height': height, 'tiles': tiles}, payload
+
+    def classify(self, frame, positions):
+        """For each tile position, True for text/UI that should be sent losslessly,
+        False for photographic content."""
+        if not positions:
+            return []
+        tiles = stack_tiles(frame, positions, self.tile_size)
+        colours = count_colours(tiles)
+        # Anti-aliased text on gradients has many colours, but far more hard edges than a photo
+        text = (colours <= self.palette_colours) | (
+            (colours <= self.text_max_colours) & (edge_density(tiles) >= self.text_edge_density))
+        return text.tolist()
+
+    def encode_image(self, image, lossless):
+        if lossless:
+            ok, buffer = cv2.imencode('.png', image, [cv2.IMWRITE_PNG_COMPRESSION, 3])
+        else:
+            ok, buffer = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+        return buffer.tobytes() if ok else None
+
+    def dirty_tiles(self, frame):
+        """Boolean grid (rows x cols) of tiles whose pixels differ from the previous frame."""
+        ts = self.tile_size
+        height, width = frame.shape[:2]
+        rows, cols = -(-height // ts), -(-width // ts)
+
+        diff = cv2.absdiff(frame, self.prev).reshape(height, width * 3)
+        # Max-pool each band of tile rows, then each tile's columns (channels interleaved)
+        full_rows = height // ts
+        bands = np.zeros((rows, cols * ts * 3), dtype=np.uint8)
+        bands[:full_rows, :width * 3] = diff[:full_rows * ts].reshape(full_rows, ts, -1).max(axis=1)
+        if rows > full_rows:
+            bands[full_rows, :width * 3] = diff[full_rows * ts:].max(axis=0)
+        return bands.reshape(rows, cols, ts * 3).max(axis=2) > 0
+
+    def _keyframe(self, frame, now):
+        """Whole frame in the codec most of its tiles want, with the other tiles blanked out of it
+        and sent after it as overlay tiles. Payload is the base image followed by the tiles."""
+        height, width = frame.shape[:2]
+        ts = self.tile_size
+        positions = [(x, y) for y in range(0, height, ts) for x in range(0, width, ts)]
+        text = self.classify(frame, positions)
+        lossless = sum(text) * 2 >= len(text)
+
+        base = frame.copy()
+        tiles = []
+        chunks = []
+        for (x, y), tile_text in zip(positions, text):
+            if tile_text == lossless:
+                continue
+            buffer = self.encode_image(frame[y:y + ts, x:x + ts], tile_text)
+            if buffer is None:
+                continue
+            # Flat blocks cost almost nothing in either codec
+            base[y:y + ts, x:x + ts] = 0
+            tiles.append([x, y, len(buffer)])
+            chunks.append(buffer)
+
+        buffer = self.encode_image(base, lossless)
+        if buffer is None:
+            return None
+        np.copyto(base, frame)
+        self.prev = base
+        self.last_keyframe = now
+        self.force_keyframe = False
+        header = {'action': 'frame', 'keyframe': True, 'width': width, 'height': height}
+        if tiles:
+            header['tiles'] = tiles
+        payload = buffer + b''.join(chunks)
+        self.keyframe_bytes = len(payload)
+        return header, payload
+
+class TileCanvas:
+    """Viewer-side persistent canvas that keyframes replace and tile updates patch in place.
+    Updates stay compressed until render(), so a canvas that isn't on screen costs no decoding,
+    and a canvas shown small can be decoded at 1/2, 1/4 or 1/8 size.
+    """
+    def __init__(self):
+        self.canvas = None
+        # Full-resolution (width, height) of the current keyframe, and the reduction it decodes at
+        self.size = None
+        self.reduction = 1
+        self.next_reduction = 1
+        self.pending = []
+
+    def reset(self):
+        self.canvas = None
+        self.size = None
+        self.pending = []
+
+    def set_reduction(self, reduction):
+        """Decode at 1/reduction size, starting with the next keyframe."""
+        self.next_reduction = reduction
+
+    def apply(self, header, payload):
+        """Queue a 'frame' or 'tiles' update. Returns False if tiles arrive before any keyframe.
+        A keyframe supersedes everything queued before it."""
+        action = header.get('action')
+        if action == 'frame':
+            self.pending = [(header, payload)]
+            self.size = (header.get('width'), header.get('height'))
+            self.reduction = self.next_reduction
+            return True
+
+        if action == 'tiles':
+            if self.size is None or self.size != (header['width'], header['height']):
+                return False
+            self.pending.append((header, payload))
+            return True
+        return False
+
+    def render(self):
+        """Decode queued updates in order. Returns the canvas, or None before the first keyframe."""
+        pending, self.pending = self.pending, []
+        for header, payload in pending:
+            if header['action'] == 'frame':
+                # Keyframe payload: base image, then any overlay tiles listed in the header
+                tiles = header.get('tiles', [])
+                base_length = len(payload) - sum(length for _, _, length in tiles)
+                self.canvas = decode_image(payload[:base_length], self.reduction)
+                if self.canvas is not None:
+                    self.patch(tiles, payload[base_length:])
+            elif self.canvas is not None:
+                self.patch(header['tiles'], payload)
+        return self.canvas
+
+    def patch(self, tiles, payload):
+        reduction = self.reduction
+        offset = 0
+        for x, y, length in tiles:
+            tile = decode_image(payload[offset:offset + length], reduction)
+            offset += length
+            if tile is None:
+                continue
+            x, y = x // reduction, y // reduction
+            region = self.canvas[y:y + tile.shape[0], x:x + tile.shape[1]]
+            region[...] = tile[:region.shape[0], :region.shape[1]]
@@ -0,0 +1,130 @@
+import hashlib
+import os
+import struct
+import numpy as np
+
+# Block-level delta transfer (rsync-style) between a new version of a file and a stored base.
+# The holder of the base sends a signature, a weak and a strong checksum per block. The sender
+# of the new version rolls the weak checksum over every byte offset, confirms candidate matches
+# with the strong checksum and describes the file as copies of base blocks plus literal bytes.
+# The weak checksum is rsync's: a = sum of bytes, b = sum of (block_size - i) * byte_i, both mod 2^16.
+# It is computed for every offset of a segment at once with numpy; uint32 arithmetic wraps mod 2^32,
+# which leaves the low 16 bits exact.
+BLOCK_ENTRY = struct.Struct('!I16s')
+# Candidate lookup table indexed by the low bits of the weak checksum
+CANDIDATE_BITS = 24
+
+def block_size_for(size):
+    """Block size for a base of this many bytes: about sqrt(size), a power of two from 2 KiB to 64 KiB,
+    so blocks never straddle the store's 256 KiB chunks."""
+    block_size = 2048
+    while block_size < 65536 and block_size * block_size < size:
+        block_size *= 2
+    return block_size
+
+def strong_checksum(block):
+    return hashlib.blake2b(block, digest_size=16).digest()
+
+def block_checksums(data, block_size):
+    """Weak checksums of the whole blocks of data, one per block."""
+    blocks = np.frombuffer(data, dtype=np.uint8)[:len(data) // block_size * block_size].reshape(-1, block_size)
+    a = blocks.sum(axis=1, dtype=np.uint32)
+    b = (blocks * np.arange(block_size, 0, -1, dtype=np.uint32)).sum(axis=1, dtype=np.uint32)
+    return (b << 16) | (a & 0xFFFF)
+
+def signature(paths, block_size):
+    """Packed signature of the concatenation of files whose sizes are multiples of block_size, all but
+    the last. A trailing partial block is left out: it could only match at the very end of the new
+    version, and goes as a literal instead."""
+    entries = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            data = f.read()
+        for index, weak in enumerate(block_checksums(data, block_size).tolist()):
+            block = data[index * block_size:(index + 1) * block_size]
+            entries.append(BLOCK_ENTRY.pack(weak, strong_checksum(block)))
+    return b''.join(entries)
+
+def unpack_signature(data):
+    """{weak: [(block_index, strong)]} from a packed signature."""
+    table = {}
+    for index, (weak, strong) in enumerate(BLOCK_ENTRY.iter_unpack(data)):
+        table.setdefault(weak, []).append((index, strong))
+    return table
+
+def rolling_checksums(data, block_size):
+    """Weak checksum of every block_size window of data, as a uint32 array indexed by window start."""
+    x = np.frombuffer(data, dtype=np.uint8)
+    if len(x) < block_size:
+        return np.zeros(0, dtype=np.uint32)
+    # sums[m] = x[0] + ... + x[m-1]; b for the window at k is sums[k+1] + ... + sums[k+B] - B * sums[k]
+    sums = np.zeros(len(x) + 1, dtype=np.uint32)
+    np.cumsum(x, dtype=np.uint32, out=sums[1:])
+    sums_of_sums = np.zeros(len(x) + 1, dtype=np.uint32)
+    np.cumsum(sums[1:], out=sums_of_sums[1:])
+    b = sums_of_sums[block_size:] - sums_of_sums[:-block_size]
+    b -= np.uint32(block_size) * sums[:-block_size]
+    a = sums[block_size:] - sums[:-block_size]
+    b <<= 16
+    a &= 0xFFFF
+    b |= a
+    return b
+
+def delta_ops(path, packed_signature, block_size, segment_size=4 * 1024 * 1024):
+    """Describe the file at path against a base's signature. Yields ('copy', first_block, count)
+    and ('literal', offset, length) in file order; literal bytes are read back from path when sent.
+    The file is scanned in segments, so memory use doesn't grow with its size."""
+    table = unpack_signature(packed_signature)
+    candidates = np.zeros(1 << CANDIDATE_BITS, dtype=bool)
+    if table:
+        candidates[np.array(list(table), dtype=np.uint32) & ((1 << CANDIDATE_BITS) - 1)] = True
+    file_size = os.path.getsize(path)
+    # Everything before pos has been described
+    pos = 0
+    copy = None
+
+    def flush_copy():
+        nonlocal copy
+        if copy:
+            yield ('copy', copy[0], copy[1])
+            copy = None
+
+    with open(path, 'rb') as f:
+        segment_start = 0
+        while segment_start < file_size:
+            f.seek(segment_start)
+            data = f.read(segment_size + block_size - 1)
+            weak = rolling_checksums(data, block_size)
+            limit = min(segment_size, len(weak))
+            for offset in np.nonzero(candidates[weak[:limit] & ((1 << CANDIDATE_BITS) - 1)])[0].tolist():
+                if segment_start + offset < pos:
+                    continue
+                entries = table.get(int(weak[offset]))
+                if not entries:
+                    continue
+                strong = strong_checksum(data[offset:offset + block_size])
+                match = next((index for index, entry_strong in entries if entry_strong == strong), None)
+                if match is None:
+                    continue
+                if segment_start + offset > pos:
+                    yield from flush_copy()
+                    yield ('literal', pos, segment_start + offset - pos)
+                if copy and copy[0] + copy[1] == match:
+                    copy[1] += 1
+                else:
+                    yield from flush_copy()
+                    copy = [match, 1]
+                pos = segment_start + offset + block_size
+            segment_end = min(segment_start + segment_size, file_size)
+            if pos < segment_end:
+                yield from flush_copy()
+                yield ('literal', pos, segment_end - pos)
+                pos = segment_end
+            segment_start = max(segment_end, pos)
+    yield from flush_copy()
+
+def delta_cost(ops, block_size):
+    """(literal bytes, copied bytes) of a list of delta ops."""
+    literal = sum(op[2] for op in ops if op[0] == 'literal')
+    copied = sum(op[2] * block_size for op in ops if op[0] == 'copy')
+    return literal, copied
@@ -0,0 +1,46 @@
+import json
+import struct
+
+# Binary framing used on data connections (screen share):
+#   !II prefix (header length, payload length) | JSON header | raw payload
+# Relays only parse the small JSON header and forward the frame bytes untouched.
+FRAME_PREFIX = struct.Struct('!II')
+MAX_HEADER_SIZE = 1024 * 1024
+MAX_PAYLOAD_SIZE = 64 * 1024 * 1024
+
+def pack_frame(header, payload=b''):
+    header_bytes = json.dumps(header).encode('utf-8')
+    return FRAME_PREFIX.pack(len(header_bytes), len(payload)) + header_bytes + bytes(payload)
+
+def recv_into_exact(sock, view):
+    """Fill a memoryview from the socket. Returns False if the peer closed first."""
+    received = 0
+    while received < len(view):
+        count = sock.recv_into(view[received:])
+        if count == 0:
+            return False
+        received += count
+    return True
+
+def read_frame(sock):
+    """Read one frame into a single buffer.
+    Returns (header, payload, frame) where payload and frame are read-only memoryviews into that
+    buffer, or (None, None, None) when the connection closes.
+    """
+    prefix = bytearray(FRAME_PREFIX.size)
+    if not recv_into_exact(sock, memoryview(prefix)):
+        return None, None, None
+    header_size, payload_size = FRAME_PREFIX.unpack(prefix)
+    if header_size > MAX_HEADER_SIZE or payload_size > MAX_PAYLOAD_SIZE:
+        raise ValueError(f"Frame too large ({header_size} + {payload_size} bytes)")
+
+    buffer = bytearray(FRAME_PREFIX.size + header_size + payload_size)
+    buffer[:FRAME_PREFIX.size] = prefix
+    view = memoryview(buffer)
+    if not recv_into_exact(sock, view[FRAME_PREFIX.size:]):
+        return None, None, None
+
+    header_end = FRAME_PREFIX.size + header_size
+    header = json.loads(bytes(view[FRAME_PREFIX.size:header_end]).decode('utf-8'))
+    frame = view.toreadonly()
+    return header, frame[header_end:], frame
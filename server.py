@@ -1,10 +1,553 @@
+import os
 import socket
 import threading
 import json
 import time
+import hashlib
+import secrets
+import tempfile
+import heapq
+import shutil
+from collections import deque, OrderedDict
+from protocol import pack_frame, read_frame
+from transfer import hash_bytes, split_chunks, choose_compression, decompress_chunk, send_stream, CHUNK_SIZE, COMPRESSION_CODECS, COMPRESSION_SAMPLE
+from delta import block_size_for, signature
+from chatlog import ChatLog
+
+# Screen-share viewports a viewer can declare. The presenter encodes 'full' and 'thumb' streams
+# only while some viewer wants them; 'hidden' viewers get nothing until they switch back.
+SCREEN_TIERS = ('full', 'thumb', 'hidden')
+# Seconds a transfer token stays valid for opening its data connection
+TRANSFER_TOKEN_TTL = 60.0
+
+class ScreenViewer:
+    """Outbound queue and sender thread for one screen-share connection.
+    Each viewer drains at its own pace: when one falls behind, its stale tile updates are dropped and it
+    waits for the next keyframe instead of stalling the presenter or the other viewers.
+    """
+    def __init__(self, sock, username, max_pending=8):
+        self.sock = sock
+        self.username = username
+        self.tier = 'full'
+        self.max_pending = max_pending
+        # (data, is_control) pairs; control messages are never dropped
+        self.pending = deque()
+        self.ready = threading.Condition()
+        # Viewers that join mid-share start from the next keyframe
+        self.needs_keyframe = True
+        self.last_keyframe_request = 0.0
+        self.running = True
+    
+    def enqueue(self, data, keyframe=False):
+        """Queue data for this viewer. Returns False if the viewer is congested and needs a keyframe."""
+        with self.ready:
+            if keyframe:
+                # A keyframe supersedes everything still queued
+                self.pending = deque(item for item in self.pending if item[1])
+                self.pending.append((data, False))
+                self.needs_keyframe = False
+                self.ready.notify()
+                return True
+            elif self.needs_keyframe:
+                return False
+            elif len(self.pending) >= self.max_pending:
+                self.pending = deque(item for item in self.pending if item[1])
+                self.needs_keyframe = True
+                return False
+            else:
+                self.pending.append((data, False))
+            self.ready.notify()
+            return True
+    
+    def set_tier(self, tier):
+        """Switch viewport tier. Queued frames of the old tier are dropped and the viewer waits for a
+        keyframe of the new one. Returns False if the tier didn't change."""
+        with self.ready:
+            if tier == self.tier:
+                return False
+            self.tier = tier
+            self.pending = deque(item for item in self.pending if item[1])
+            self.needs_keyframe = True
+            return True
+    
+    def send_control(self, data):
+        with self.ready:
+            self.pending.append((data, True))
+            self.ready.notify()
+    
+    def run(self):
+        while self.running:
+            with self.ready:
+                while not self.pending and self.running:
+                    self.ready.wait(1.0)
+                if not self.running:
+                    break
+                data, _ = self.pending.popleft()
+            try:
+                self.sock.sendall(data)
+            except Exception as e:
+                print(f"Screen channel send to {self.username} failed: {e}")
+                self.stop()
+    
+    def stop(self):
+        with self.ready:
+            self.running = False
+            self.ready.notify_all()
+
+class QuotaError(ValueError):
+    pass
+
+def share_visible(share, username):
+    """Whether a share is listed for username: shared with everyone, with them, or by them."""
+    return share['recipient'] in ('everyone', username) or share['uploaded_by'] == username
+
+def message_int(message, key, default, low, high=None):
+    """An integer field of a client request, clamped to [low, high]; default if missing or not a number."""
+    try:
+        value = int(message.get(key, default))
+    except (TypeError, ValueError, OverflowError):
+        value = default
+    value = max(low, value)
+    return min(value, high) if high is not None else value
+
+class FileStore:
+    """Content-addressed file storage on disk, bounded in size.
+    Contents are stored once per SHA-256, as chunk files that are themselves deduplicated by hash
+    (root/ab/abcdef...); shares (filename, uploader, recipient) are metadata entries pointing at a
+    content hash. Chunk files are written outside the lock, under their final name via os.replace,
+    then checked again under the lock before they are recorded, in case eviction removed a chunk
+    that was already stored.
+    
+    Contents are kept in least-recently-used order. When the store exceeds max_bytes the least
+    recently shared or downloaded contents are evicted, contents untouched for ttl seconds expire,
+    and each user may own at most user_quota bytes of content (the first uploader owns it; re-sharing
+    stored content is free). Uploads in progress count against their owner's quota and the store
+    from the moment they start. Evicting a content removes its shares.
+    """
+    def __init__(self, root, max_bytes=4 * 1024 ** 3, user_quota=1024 ** 3, ttl=24 * 3600):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.user_quota = user_quota
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # {chunk_hash: size}
+        self.chunks = {}
+        # Number of stored contents using each chunk: {chunk_hash: count}
+        self.chunk_refs = {}
+        # LRU order, oldest first: {file_hash: {'chunks': [chunk_hash], 'size', 'owner', 'accessed', 'readers'}}
+        self.blobs = OrderedDict()
+        # Uploads in progress: {file_hash: {'chunks': [chunk_hash], 'size', 'owner', 'started', 'waiting': [share]}}
+        self.uploads = {}
+        # {share_id: {'id', 'hash', 'filename', 'size', 'uploaded_by', 'recipient', 'time'}}
+        self.shares = {}
+        # Catalog index, share ids in ascending order per audience ('everyone' or a username)
+        self.share_index = {}
+        self.next_share_id = 1
+        # Bytes of content owned per user: {username: bytes}
+        self.usage = {}
+        # Bytes reserved by uploads in progress, per owner and in total
+        self.reserved = {}
+        self.reserved_bytes = 0
+        self.metrics = {'hits': 0, 'misses': 0, 'evictions': 0, 'evicted_bytes': 0, 'expired': 0, 'rejected': 0}
+    
+    def chunk_path(self, chunk_hash):
+        return os.path.join(self.root, chunk_hash[:2], chunk_hash)
+    
+    def _write_chunk(self, chunk_hash, data):
+        path = self.chunk_path(chunk_hash)
+        if os.path.exists(path):
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+    
+    def has(self, file_hash):
+        with self.lock:
+            return file_hash in self.blobs
+    
+    def begin_upload(self, file_hash, chunk_hashes, size, share):
+        """Start (or join) an upload; share is published once the content is complete.
+        Returns (indexes of the chunks the store still needs, shares that can be published now).
+        Raises QuotaError if the content can't fit in the store or the uploader's quota."""
+        with self.lock:
+            self._expire()
+            if file_hash in self.blobs:
+                self._touch(file_hash)
+                return [], [share]
+            upload = self.uploads.get(file_hash)
+            if upload is None:
+                owner = share['uploaded_by']
+                self._check_quota(owner, size)
+                upload = {'chunks': list(chunk_hashes), 'size': size, 'owner': owner, 'started': time.time(), 'waiting': []}
+                self.uploads[file_hash] = upload
+                self._reserve(owner, size)
+            upload['waiting'].append(share)
+            if upload.get('finishing'):
+                # Published along with the upload that is being verified
+                return [], []
+            # Each distinct missing chunk is requested once, even if it repeats within the file
+            missing = []
+            requested = set()
+            for index, chunk_hash in enumerate(upload['chunks']):
+                if chunk_hash not in self.chunks and chunk_hash not in requested:
+                    requested.add(chunk_hash)
+                    missing.append(index)
+            if missing:
+                return missing, []
+            # Every chunk is already stored as part of other files
+            upload['finishing'] = True
+        return [], self._finish_upload(file_hash, upload)
+    
+    def put_chunk(self, file_hash, index, data):
+        """Store one chunk of an upload. Returns the waiting shares once the file is complete,
+        otherwise None. Raises ValueError for data that doesn't match the offered hashes."""
+        with self.lock:
+            upload = self.uploads.get(file_hash)
+            if upload is None:
+                return None
+            if not 0 <= index < len(upload['chunks']):
+                raise ValueError(f"chunk {index} of {file_hash[:12]} out of range")
+            chunk_hash = upload['chunks'][index]
+        if hash_bytes(data) != chunk_hash:
+            raise ValueError(f"chunk {index} of {file_hash[:12]} does not match its hash")
+        self._write_chunk(chunk_hash, data)
+        
+        with self.lock:
+            # The file may have existed already and been evicted since; write it again if so
+            self._write_chunk(chunk_hash, data)
+            self.chunks[chunk_hash] = len(data)
+            if (self.uploads.get(file_hash) is not upload or upload.get('finishing')
+                    or any(h not in self.chunks for h in upload['chunks'])):
+                return None
+            upload['finishing'] = True
+        return self._finish_upload(file_hash, upload)
+    
+    def _finish_upload(self, file_hash, upload):
+        """Check the assembled content against its hash, then make it available.
+        The upload stays listed while this runs so eviction leaves its chunks alone."""
+        content_hash = hashlib.sha256()
+        size = 0
+        for chunk_hash in upload['chunks']:
+            with open(self.chunk_path(chunk_hash), 'rb') as f:
+                data = f.read()
+            content_hash.update(data)
+            size += len(data)
+        with self.lock:
+            del self.uploads[file_hash]
+            self._reserve(upload['owner'], -upload['size'])
+            if content_hash.hexdigest() != file_hash or size != upload['size']:
+                self._drop_unused_chunks(upload['chunks'])
+                raise ValueError(f"upload {file_hash[:12]} does not match its hash")
+            self._add_blob(file_hash, upload['chunks'], size, upload['owner'])
+            return upload['waiting']
+    
+    def put_bytes(self, data, owner):
+        """Store a whole file received in one piece. Returns its hash."""
+        file_hash = hash_bytes(data)
+        with self.lock:
+            if file_hash in self.blobs:
+                self._touch(file_hash)
+                return file_hash
+            self._check_quota(owner, len(data))
+        chunk_hashes = []
+        for chunk in split_chunks(data):
+            chunk_hash = hash_bytes(chunk)
+            self._write_chunk(chunk_hash, chunk)
+            chunk_hashes.append(chunk_hash)
+        with self.lock:
+            for chunk_hash, chunk in zip(chunk_hashes, split_chunks(data)):
+                # Rewrites chunks that other contents' eviction removed after the writes above
+                self._write_chunk(chunk_hash, chunk)
+                self.chunks[chunk_hash] = len(chunk)
+            if file_hash not in self.blobs:
+                self._add_blob(file_hash, chunk_hashes, len(data), owner)
+        return file_hash
+    
+    def _check_quota(self, owner, size):
+        """Raise QuotaError if size more bytes don't fit in owner's quota, or in the store next to
+        the uploads in progress. Caller holds the lock."""
+        if self.reserved_bytes + size > self.max_bytes:
+            self.metrics['rejected'] += 1
+            raise QuotaError(f"the file store can't take {size / 2 ** 20:.1f} MB more while "
+                             f"{self.reserved_bytes / 2 ** 20:.0f} MB of uploads are in progress")
+        used = self.usage.get(owner, 0) + self.reserved.get(owner, 0)
+        if used + size > self.user_quota:
+            self.metrics['rejected'] += 1
+            raise QuotaError(f"{owner} has {used / 2 ** 20:.0f} MB of "
+                             f"{self.user_quota / 2 ** 20:.0f} MB stored or uploading; {size / 2 ** 20:.1f} MB more doesn't fit")
+    
+    def _reserve(self, owner, size):
+        """Reserve (or, negative, release) upload bytes for owner. Caller holds the lock."""
+        self.reserved_bytes += size
+        self.reserved[owner] = self.reserved.get(owner, 0) + size
+        if self.reserved[owner] <= 0:
+            del self.reserved[owner]
+    
+    def _drop_upload(self, file_hash):
+        """Abandon an upload in progress, releasing its reservation and chunks. Caller holds the lock."""
+        upload = self.uploads.pop(file_hash)
+        self._reserve(upload['owner'], -upload['size'])
+        self._drop_unused_chunks(upload['chunks'])
+    
+    def _add_blob(self, file_hash, chunk_hashes, size, owner):
+        """Caller holds the lock."""
+        if file_hash in self.blobs:
+            self._touch(file_hash)
+            return
+        self.blobs[file_hash] = {'chunks': chunk_hashes, 'size': size, 'owner': owner,
+                                 'accessed': time.time(), 'readers': 0}
+        for chunk_hash in set(chunk_hashes):
+            self.chunk_refs[chunk_hash] = self.chunk_refs.get(chunk_hash, 0) + 1
+        self.usage[owner] = self.usage.get(owner, 0) + size
+        self._evict(keep=file_hash)
+    
+    def _touch(self, file_hash):
+        """Mark content as just used. Caller holds the lock."""
+        self.blobs[file_hash]['accessed'] = time.time()
+        self.blobs.move_to_end(file_hash)
+    
+    def _evict(self, keep=None):
+        """Drop least recently used contents until the store fits in max_bytes. Contents being
+        downloaded are skipped. Caller holds the lock."""
+        stored = sum(self.chunks.values())
+        for file_hash in list(self.blobs):
+            if stored <= self.max_bytes:
+                break
+            blob = self.blobs[file_hash]
+            if file_hash == keep or blob['readers']:
+                continue
+            stored -= self._remove_blob(file_hash)
+            self.metrics['evictions'] += 1
+            self.metrics['evicted_bytes'] += blob['size']
+            print(f"Evicted {file_hash[:12]} ({blob['size']} bytes) from the file store")
+    
+    def _expire(self):
+        """Drop contents nobody shared or downloaded within ttl, and abandoned uploads.
+        Caller holds the lock."""
+        cutoff = time.time() - self.ttl
+        # LRU order: the first content that isn't stale ends the scan
+        for file_hash in list(self.blobs):
+            blob = self.blobs[file_hash]
+            if blob['accessed'] >= cutoff:
+                break
+            if blob['readers']:
+                continue
+            self._remove_blob(file_hash)
+            self.metrics['expired'] += 1
+        for file_hash, upload in list(self.uploads.items()):
+            if upload['started'] < cutoff and not upload.get('finishing'):
+                self._drop_upload(file_hash)
+    
+    def _remove_blob(self, file_hash):
+        """Remove content, its shares and the chunks no other content uses. Returns the bytes freed.
+        Caller holds the lock."""
+        blob = self.blobs.pop(file_hash)
+        self.usage[blob['owner']] = self.usage.get(blob['owner'], 0) - blob['size']
+        if self.usage[blob['owner']] <= 0:
+            del self.usage[blob['owner']]
+        for share_id in [i for i, share in self.shares.items() if share['hash'] == file_hash and not share.get('peer')]:
+            self._remove_share(share_id)
+        for chunk_hash in set(blob['chunks']):
+            self.chunk_refs[chunk_hash] -= 1
+            if not self.chunk_refs[chunk_hash]:
+                del self.chunk_refs[chunk_hash]
+        return self._drop_unused_chunks(blob['chunks'])
+    
+    def _drop_unused_chunks(self, chunk_hashes):
+        """Delete chunk files no stored content or upload in progress uses. Caller holds the lock."""
+        pending = {h for upload in self.uploads.values() for h in upload['chunks']}
+        freed = 0
+        for chunk_hash in set(chunk_hashes):
+            if chunk_hash in self.chunk_refs or chunk_hash in pending or chunk_hash not in self.chunks:
+                continue
+            freed += self.chunks.pop(chunk_hash)
+            try:
+                os.remove(self.chunk_path(chunk_hash))
+            except OSError:
+                pass
+        return freed
+    
+    def add_share(self, share):
+        """Record a share. Shares with 'peer' set are served by the sharer and need no stored content;
+        'relay' shares back a peer share that is already listed and stay out of the catalog."""
+        with self.lock:
+            share['id'] = self.next_share_id
+            if not share.get('peer'):
+                share['size'] = self.blobs[share['hash']]['size']
+                self._touch(share['hash'])
+            share['time'] = time.time()
+            self.next_share_id += 1
+            self.shares[share['id']] = share
+            if not share.get('relay'):
+                audiences = {'everyone'} if share['recipient'] == 'everyone' else {share['recipient'], share['uploaded_by']}
+                for audience in audiences:
+                    self.share_index.setdefault(audience, []).append(share['id'])
+        return share
+    
+    def _remove_share(self, share_id):
+        """Caller holds the lock."""
+        share = self.shares.pop(share_id)
+        for audience in ('everyone', share['recipient'], share['uploaded_by']):
+            ids = self.share_index.get(audience)
+            if ids and share_id in ids:
+                ids.remove(share_id)
+                if not ids:
+                    del self.share_index[audience]
+    
+    def remove_peer_shares(self, username):
+        """Drop the shares a disconnecting user was serving from their own machine."""
+        with self.lock:
+            for share_id in [i for i, share in self.shares.items() if share.get('peer') and share['uploaded_by'] == username]:
+                self._remove_share(share_id)
+    
+    def remove_uploads(self, username):
+        """Abandon a disconnecting user's unfinished uploads that no one else is waiting on."""
+        with self.lock:
+            for file_hash, upload in list(self.uploads.items()):
+                if (upload['owner'] == username and not upload.get('finishing')
+                        and all(share['uploaded_by'] == username for share in upload['waiting'])):
+                    self._drop_upload(file_hash)
+    
+    def find_share(self, file_hash=None, filename=None, username=None):
+        """Most recent share of stored content by hash (or, for older clients, by filename),
+        among those username can see when given."""
+        with self.lock:
+            self._expire()
+            for share in reversed(list(self.shares.values())):
+                if share.get('peer') or (username is not None and not share_visible(share, username)):
+                    continue
+                if (file_hash and share['hash'] == file_hash) or (not file_hash and share['filename'] == filename):
+                    return dict(share)
+            self.metrics['misses'] += 1
+        return None
+    
+    def delta_base(self, file_hash, filename, username, base_hash=None):
+        """Stored content to send a new version of a file as a delta against: the version the client
+        names, else the latest stored share of the same filename the user can see. None if there is none."""
+        with self.lock:
+            if base_hash and base_hash != file_hash and base_hash in self.blobs:
+                if any(share['hash'] == base_hash and share_visible(share, username) for share in self.shares.values()):
+                    return base_hash
+            for share in reversed(list(self.shares.values())):
+                if (share['filename'] == filename and share['hash'] != file_hash and share['hash'] in self.blobs
+                        and share_visible(share, username)):
+                    return share['hash']
+        return None
+    
+    def catalog(self, username, offset=0, limit=50):
+        """One page of the shares a user can see, newest first. Returns (shares, has_more).
+        Walks the per-audience indexes from the newest end, so a page costs offset + limit steps."""
+        with self.lock:
+            self._expire()
+            ids = heapq.merge(reversed(self.share_index.get('everyone', [])),
+                              reversed(self.share_index.get(username, [])), reverse=True)
+            page = []
+            last = None
+            for share_id in ids:
+                if share_id == last:
+                    continue
+                last = share_id
+                if offset:
+                    offset -= 1
+                    continue
+                if len(page) == limit:
+                    return page, True
+                share = self.shares[share_id]
+                page.append({key: share[key] for key in ('id', 'hash', 'filename', 'size', 'uploaded_by', 'recipient', 'time')})
+                page[-1]['direct'] = bool(share.get('peer'))
+            return page, False
+    
+    def chunk_paths(self, file_hash):
+        """Paths of the chunk files making up a stored file, in order, or None.
+        The content is pinned against eviction until release(file_hash)."""
+        with self.lock:
+            blob = self.blobs.get(file_hash)
+            if blob is None:
+                self.metrics['misses'] += 1
+                return None
+            self.metrics['hits'] += 1
+            blob['readers'] += 1
+            self._touch(file_hash)
+            return [self.chunk_path(chunk_hash) for chunk_hash in blob['chunks']]
+    
+    def release(self, file_hash):
+        with self.lock:
+            blob = self.blobs.get(file_hash)
+            if blob is not None:
+                blob['readers'] -= 1
+    
+    def stats(self):
+        with self.lock:
+            self._expire()
+            logical = sum(self.blobs[share['hash']]['size'] for share in self.shares.values()
+                          if share['hash'] in self.blobs and not share.get('relay') and not share.get('peer'))
+            return dict(self.metrics, **{
+                'shares': len(self.shares),
+                'files': len(self.blobs),
+                'chunks': len(self.chunks),
+                'stored_bytes': sum(self.chunks.values()),
+                'max_bytes': self.max_bytes,
+                'shared_bytes': logical,
+                'users': len(self.usage)
+            })
+
+class DeltaAssembler:
+    """Rebuilds an upload sent as a delta against a stored base: copies of base blocks and literal
+    bytes are appended in file order and stored chunk by chunk as each chunk fills up.
+    Block sizes divide CHUNK_SIZE, so a base block never spans two chunk files."""
+    def __init__(self, store, file_hash, base_paths, block_size):
+        self.store = store
+        self.file_hash = file_hash
+        self.base_paths = base_paths
+        self.block_size = block_size
+        self.buffer = bytearray()
+        self.index = 0
+        self.stored = 0
+    
+    def copy(self, first_block, count):
+        offset = first_block * self.block_size
+        end = offset + count * self.block_size
+        if first_block < 0 or count < 1 or end > len(self.base_paths) * CHUNK_SIZE:
+            raise ValueError(f"copy of blocks {first_block}+{count} is outside the base")
+        waiting = None
+        while offset < end:
+            chunk_index, chunk_offset = divmod(offset, CHUNK_SIZE)
+            length = min(end - offset, CHUNK_SIZE - chunk_offset)
+            with open(self.base_paths[chunk_index], 'rb') as f:
+                f.seek(chunk_offset)
+                data = f.read(length)
+            if len(data) != length:
+                raise ValueError(f"copy of blocks {first_block}+{count} is outside the base")
+            waiting = self.literal(data) or waiting
+            offset += length
+        return waiting
+    
+    def literal(self, data):
+        self.buffer += data
+        waiting = None
+        while len(self.buffer) >= CHUNK_SIZE:
+            waiting = self._store(bytes(self.buffer[:CHUNK_SIZE])) or waiting
+            del self.buffer[:CHUNK_SIZE]
+        return waiting
+    
+    def finish(self):
+        if self.buffer:
+            return self._store(bytes(self.buffer))
+        return None
+    
+    def _store(self, chunk):
+        waiting = self.store.put_chunk(self.file_hash, self.index, chunk)
+        self.index += 1
+        self.stored += 1
+        return waiting
 
 class ConferenceServer:
-    def __init__(self, tcp_port=5555, udp_port=5556):
+    def __init__(self, tcp_port=5555, udp_port=5556, top_speakers=4, video_rate_limit=1000000, file_store_dir=None,
+                 file_store_bytes=4 * 1024 ** 3, file_user_quota=1024 ** 3, file_ttl=24 * 3600,
+                 chat_log_path=None, chat_room='main'):
         self.tcp_port = tcp_port
         self.udp_port = udp_port
         
@@ -14,13 +557,60 @@ class ConferenceServer:
         self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         
+        # Control connections: {socket: {'username', 'address', 'video', 'audio', 'send_lock'}}
         self.clients = {}
+        # Routing index, kept in step with clients: {username: socket}
+        self.user_sockets = {}
         self.username_to_udp = {}
+        # Dedicated screen-share connections: {username: ScreenViewer}
+        self.screen_viewers = {}
+        # Active presenter and their latest screen state per tier for late joiners:
+        # {tier: {'keyframe': bytes, 'tiles': {(x, y): tile}, 'width': int, 'height': int, 'username': str}}
+        self.screen_presenter = None
+        self.screen_cache = {}
         self.running = True
         self.lock = threading.Lock()
         
-        # File storage: {filename: {'data': bytes, 'size': int, 'uploaded_by': str}}
-        self.files = {}
+        # Shared files, stored on disk by content hash with chunk-level dedup
+        # Without a configured directory the store lives in a temp directory removed by stop()
+        self.owned_file_store = file_store_dir is None
+        self.file_store = FileStore(file_store_dir or tempfile.mkdtemp(prefix='conference-files-'),
+                                    max_bytes=file_store_bytes, user_quota=file_user_quota, ttl=file_ttl)
+        # One-time tokens for file data connections: {token: {'username', 'hash', 'action', 'expires'}}
+        self.transfer_tokens = {}
+        # Files served straight from the sharer's machine; the server only brokers address and token:
+        # {file_hash: {'hash', 'filename', 'size', 'uploaded_by', 'recipient', 'host', 'port', 'token'}}
+        self.peer_shares = {}
+        # Downloads waiting for a peer-shared file to be uploaded after a failed direct connection:
+        # {file_hash: [requester_socket]}
+        self.relay_requests = {}
+        
+        # Chat history on disk, paged back to clients that join late or reconnect. Without a
+        # configured path it only lasts as long as the server, in a temp directory removed by stop()
+        self.owned_chat_dir = None if chat_log_path else tempfile.mkdtemp(prefix='conference-chat-')
+        self.chat_log = ChatLog(chat_log_path or os.path.join(self.owned_chat_dir, 'chat_history.db'), chat_room)
+        
+        # Active speaker detection: {username: {'level': smoothed dBov, 'updated': time}}
+        self.speaker_levels = {}
+        self.speaker_ranking = []
+        self.dominant_speaker = None
+        self.dominant_since = 0.0
+        self.top_speakers = top_speakers
+        # Ranking last sent to clients, and when
+        self.sent_ranking = []
+        self.ranking_sent_at = 0.0
+        self.ranking_interval = 0.5
+        # Per-sender video token buckets: {username: {'tokens': bytes, 'updated': time}}
+        self.video_rate_limit = video_rate_limit
+        self.video_buckets = {}
+        
+        # Media relay queues, drained in priority order: audio, then screen-share cursor, then video
+        self.media_queues = {'audio': deque(maxlen=512), 'cursor': deque(maxlen=64), 'video': deque(maxlen=256)}
+        self.media_ready = threading.Condition()
+        self.media_stats = {
+            media_class: {'forwarded': 0, 'dropped': 0, 'rate_limited': 0, 'delay_avg_ms': 0.0, 'delay_max_ms': 0.0}
+            for media_class in self.media_queues
+        }
         
     def start(self):
         self.tcp_socket.bind(('0.0.0.0', self.tcp_port))
@@ -34,6 +624,10 @@ class ConferenceServer:
         udp_thread.daemon = True
         udp_thread.start()
         
+        media_thread = threading.Thread(target=self.forward_media)
+        media_thread.daemon = True
+        media_thread.start()
+        
         while self.running:
             try:
                 client_socket, address = self.tcp_socket.accept()
@@ -46,56 +640,205 @@ class ConferenceServer:
                     print(f"Error accepting TCP connection: {e}")
     
     def handle_udp(self):
+        # Receive only: media datagrams are classified and queued so the forwarder can send audio first
         while self.running:
             try:
                 data, addr = self.udp_socket.recvfrom(131072)
+                media_class = self.classify_datagram(data)
+                if media_class:
+                    self.enqueue_media(media_class, data, addr)
+                    continue
+                
+                message = json.loads(data.decode('utf-8'))
+                username = message.get('username')
+                
+                if username:
+                    with self.lock:
+                        self.username_to_udp[username] = addr
+                    
+            except json.JSONDecodeError:
+                continue
+            except Exception as e:
+                if self.running:
+                    print(f"UDP error: {e}")
+    
+    @staticmethod
+    def classify_datagram(data):
+        """Classify a media datagram from its header without parsing the payload.
+        Clients serialize 'type' first, so it always sits in the first few bytes."""
+        header = data[:48]
+        if b'"audio_frame"' in header:
+            return 'audio'
+        if b'"video_frame"' in header:
+            return 'video'
+        if b'"screen_cursor"' in header:
+            return 'cursor'
+        return None
+    
+    def enqueue_media(self, media_class, data, addr):
+        queue = self.media_queues[media_class]
+        with self.media_ready:
+            if len(queue) == queue.maxlen:
+                self.media_stats[media_class]['dropped'] += 1
+            queue.append((data, addr, time.time()))
+            self.media_ready.notify()
+    
+    def forward_media(self):
+        queues = list(self.media_queues.items())
+        while self.running:
+            with self.media_ready:
+                while not any(queue for _, queue in queues) and self.running:
+                    self.media_ready.wait(0.5)
+                for media_class, queue in queues:
+                    if queue:
+                        data, addr, enqueued = queue.popleft()
+                        break
+                else:
+                    continue
+            
+            try:
+                delay_ms = (time.time() - enqueued) * 1000
+                stats = self.media_stats[media_class]
+                stats['delay_avg_ms'] += 0.05 * (delay_ms - stats['delay_avg_ms'])
+                stats['delay_max_ms'] = max(stats['delay_max_ms'], delay_ms)
+                
                 message = json.loads(data.decode('utf-8'))
-                msg_type = message.get('type')
                 username = message.get('username')
                 
                 if username:
                     with self.lock:
                         self.username_to_udp[username] = addr
                 
-                if msg_type in ['video_frame', 'audio_frame']:
+                if media_class == 'audio':
+                    self.broadcast_udp_exclude_sender(data, addr, username)
+                    stats['forwarded'] += 1
+                    if 'level' in message:
+                        self.update_speaker_level(username, message['level'])
+                elif media_class == 'cursor':
+                    # A few dozen bytes at up to 60 Hz: never rate limited
                     self.broadcast_udp_exclude_sender(data, addr, username)
+                    stats['forwarded'] += 1
+                elif self.allow_video(username, len(data)):
+                    self.broadcast_udp_exclude_sender(data, addr, username)
+                    stats['forwarded'] += 1
+                else:
+                    stats['rate_limited'] += 1
                     
             except json.JSONDecodeError:
                 continue
             except Exception as e:
                 if self.running:
-                    print(f"UDP error: {e}")
+                    print(f"Media relay error: {e}")
+    
+    def get_media_stats(self):
+        with self.media_ready:
+            stats = {media_class: dict(values) for media_class, values in self.media_stats.items()}
+            for media_class, queue in self.media_queues.items():
+                stats[media_class]['queued'] = len(queue)
+        return stats
+    
+    def update_speaker_level(self, username, level):
+        """Smooth the per-frame audio level from the media header and re-rank speakers."""
+        now = time.time()
+        level = max(-127.0, min(0.0, float(level)))
+        with self.lock:
+            entry = self.speaker_levels.get(username)
+            if entry is None:
+                entry = {'level': -127.0, 'updated': now}
+                self.speaker_levels[username] = entry
+            # Rise fast, fall slowly so short pauses between words don't drop a speaker
+            alpha = 0.3 if level > entry['level'] else 0.05
+            entry['level'] += alpha * (level - entry['level'])
+            entry['updated'] = now
+            
+            active = [(u, e['level']) for u, e in self.speaker_levels.items()
+                      if now - e['updated'] < 1.0 and e['level'] > -60.0]
+            active.sort(key=lambda item: item[1], reverse=True)
+            ranking = [u for u, _ in active[:self.top_speakers]]
+            
+            dominant = self.dominant_speaker
+            levels = dict(active)
+            if active:
+                loudest, loudest_level = active[0]
+                current_level = levels.get(dominant)
+                if current_level is None:
+                    dominant = loudest
+                elif loudest != dominant and loudest_level > current_level + 6.0 and now - self.dominant_since > 1.0:
+                    dominant = loudest
+            
+            dominant_changed = dominant != self.dominant_speaker
+            self.speaker_ranking = ranking
+            if dominant_changed:
+                self.dominant_speaker = dominant
+                self.dominant_since = now
+            # A new dominant speaker goes out at once; ranking-only changes at most every
+            # ranking_interval, so levels crossing back and forth don't flood the clients
+            notify = dominant_changed or (ranking != self.sent_ranking
+                                          and now - self.ranking_sent_at >= self.ranking_interval)
+            if notify:
+                self.sent_ranking = ranking
+                self.ranking_sent_at = now
+        
+        if notify:
+            self.broadcast_active_speaker()
+        
+    def broadcast_active_speaker(self):
+        with self.lock:
+            message = json.dumps({
+                'type': 'active_speaker',
+                'username': self.dominant_speaker,
+                'ranking': list(self.speaker_ranking)
+            }).encode('utf-8')
+        self.broadcast(message)
+    
+    def allow_video(self, username, size):
+        """Per-sender token bucket. Top speakers get the full video_rate_limit (bytes/s); once the room
+        has more video senders than top speaker slots, everyone else gets a quarter of it."""
+        now = time.time()
+        with self.lock:
+            bucket = self.video_buckets.get(username)
+            if bucket is None:
+                bucket = {'tokens': self.video_rate_limit * 0.5, 'updated': now}
+                self.video_buckets[username] = bucket
+            
+            senders = sum(1 for b in self.video_buckets.values() if now - b['updated'] < 2.0)
+            rate = self.video_rate_limit
+            if senders > self.top_speakers and username not in self.speaker_ranking:
+                rate /= 4
+            
+            bucket['tokens'] = min(rate * 0.5, bucket['tokens'] + (now - bucket['updated']) * rate)
+            bucket['updated'] = now
+            if bucket['tokens'] < size:
+                return False
+            bucket['tokens'] -= size
+            return True
     
     def broadcast_udp_exclude_sender(self, data, sender_addr, sender_username):
         with self.lock:
-            for username, udp_addr in list(self.username_to_udp.items()):
-                if username != sender_username:
-                    try:
-                        self.udp_socket.sendto(data, udp_addr)
-                    except Exception as e:
-                        print(f"Error sending UDP to {username}: {e}")
+            targets = [(username, udp_addr) for username, udp_addr in self.username_to_udp.items() if username != sender_username]
+        for username, udp_addr in targets:
+            try:
+                self.udp_socket.sendto(data, udp_addr)
+            except Exception as e:
+                print(f"Error sending UDP to {username}: {e}")
     
     def broadcast_screen_share_udp(self, data, sender_username):
         with self.lock:
-            for username, udp_addr in list(self.username_to_udp.items()):
-                if username != sender_username:
-                    try:
-                        self.udp_socket.sendto(data, udp_addr)
-                    except Exception as e:
-                        print(f"Error sending screen share UDP to {username}: {e}")
+            targets = [(username, udp_addr) for username, udp_addr in self.username_to_udp.items() if username != sender_username]
+        for username, udp_addr in targets:
+            try:
+                self.udp_socket.sendto(data, udp_addr)
+            except Exception as e:
+                print(f"Error sending screen share UDP to {username}: {e}")
 
     def broadcast_screen_share_tcp(self, data, sender_username):
         """Relay screen-share messages reliably to all clients over TCP."""
-        with self.lock:
-            for client_socket, info in list(self.clients.items()):
-                if info.get('username') != sender_username:
-                    try:
-                        client_socket.send(data)
-                    except Exception as e:
-                        print(f"Error sending screen share TCP to {info.get('username')}: {e}")
+        self.broadcast(data, exclude={sender_username})
                 
     def handle_tcp_client(self, client_socket, address):
         username = None
+        screen_channel = False
+        data_channel = False
         try:
             client_socket.settimeout(60.0)
             
@@ -103,13 +846,27 @@ class ConferenceServer:
             msg = json.loads(data)
             username = msg['username']
             
+            if msg.get('channel') == 'screen':
+                # Screen-share frames get their own connection so they never queue behind control traffic
+                screen_channel = True
+                self.handle_screen_channel(client_socket, username)
+                return
+            
+            if msg.get('channel') == 'data':
+                # File contents are streamed raw on a short-lived connection of their own
+                data_channel = True
+                self.handle_data_channel(client_socket, username, msg.get('token'), msg.get('codecs', []))
+                return
+            
             with self.lock:
                 self.clients[client_socket] = {
                     'username': username,
                     'address': address,
                     'video': False,
-                    'audio': False
+                    'audio': False,
+                    'send_lock': threading.Lock()
                 }
+                self.user_sockets[username] = client_socket
             
             print(f"User {username} connected from {address}")
             
@@ -117,13 +874,21 @@ class ConferenceServer:
                 'type': 'connection_info',
                 'udp_port': self.udp_port
             })
-            client_socket.send(response.encode('utf-8'))
+            self.send_to(client_socket, response.encode('utf-8'))
             
             time.sleep(0.1)
             
             self.send_participant_list(client_socket)
             self.broadcast_participant_update()
             
+            with self.lock:
+                presenter = self.screen_presenter
+            if presenter and presenter != username:
+                # Late joiner: announce the active presentation; the frame follows on the screen channel
+                self.send_to(client_socket, json.dumps({
+                    'type': 'screen_share', 'action': 'start', 'username': presenter
+                }).encode('utf-8'))
+            
             buffer = ""
             
             while self.running:
@@ -144,10 +909,18 @@ class ConferenceServer:
                             
                             if msg_type == 'chat':
                                 self.route_chat(client_socket, message)
+                            elif msg_type == 'chat_history':
+                                self.handle_chat_history(client_socket, message)
                             elif msg_type == 'file_transfer':
                                 self.route_file(client_socket, message)
                             elif msg_type == 'file_upload':
                                 self.handle_file_upload(client_socket, message)
+                            elif msg_type == 'file_offer':
+                                self.handle_file_offer(client_socket, message)
+                            elif msg_type == 'file_chunk':
+                                self.handle_file_chunk(client_socket, message)
+                            elif msg_type == 'file_catalog':
+                                self.handle_file_catalog(client_socket, message)
                             elif msg_type == 'file_download':
                                 self.handle_file_download(client_socket, message)
                             elif msg_type == 'status_update':
@@ -155,18 +928,14 @@ class ConferenceServer:
                             elif msg_type == 'screen_share':
                                 self.handle_screen_share(client_socket, message)
                             elif msg_type == 'ping':
-                                try:
-                                    client_socket.send(json.dumps({'type': 'pong'}).encode('utf-8'))
-                                except:
+                                if not self.send_to(client_socket, json.dumps({'type': 'pong'}).encode('utf-8')):
                                     break
                                     
                         except json.JSONDecodeError:
                             break
                         
                 except socket.timeout:
-                    try:
-                        client_socket.send(json.dumps({'type': 'ping'}).encode('utf-8'))
-                    except:
+                    if not self.send_to(client_socket, json.dumps({'type': 'ping'}).encode('utf-8')):
                         print(f"Client {username} connection lost (timeout)")
                         break
                     continue
@@ -183,9 +952,17 @@ class ConferenceServer:
         except Exception as e:
             print(f"Error with client {address}: {e}")
         finally:
-            self.remove_client(client_socket, username)
-            time.sleep(0.2)
-            self.broadcast_participant_update()
+            if screen_channel:
+                self.remove_screen_viewer(client_socket, username)
+            elif data_channel:
+                try:
+                    client_socket.close()
+                except:
+                    pass
+            else:
+                self.remove_client(client_socket, username)
+                time.sleep(0.2)
+                self.broadcast_participant_update()
             
     def handle_screen_share(self, sender_socket, message):
         with self.lock:
@@ -195,15 +972,187 @@ class ConferenceServer:
         
         if action in ['start', 'stop']:
             print(f"Screen share {action} from {sender_username}")
+            with self.lock:
+                if action == 'start':
+                    self.screen_presenter = sender_username
+                    self.screen_cache = {}
+                elif self.screen_presenter == sender_username:
+                    self.screen_presenter = None
+                    self.screen_cache = {}
             data = json.dumps(message).encode('utf-8')
-            # Broadcast over TCP for higher reliability and larger frames
+            # Start/stop are control-plane events and go to every control connection
             self.broadcast_screen_share_tcp(data, sender_username)
+            if action == 'start':
+                self.update_screen_tiers()
+    
+    def handle_screen_channel(self, client_socket, username):
+        viewer = ScreenViewer(client_socket, username)
+        with self.lock:
+            old_viewer = self.screen_viewers.get(username)
+            self.screen_viewers[username] = viewer
+        if old_viewer:
+            old_viewer.stop()
         
-        elif action == 'frame':
-            data = json.dumps(message).encode('utf-8')
-            # Broadcast frames over TCP
-            self.broadcast_screen_share_tcp(data, sender_username)
+        print(f"Screen channel opened for {username}")
+        sender_thread = threading.Thread(target=viewer.run)
+        sender_thread.daemon = True
+        sender_thread.start()
+        # The client waits for this before sending binary frames
+        viewer.send_control(pack_frame({'type': 'screen_share', 'action': 'ready'}))
+        self.replay_screen_cache(viewer)
+        self.update_screen_tiers()
+        
+        client_socket.settimeout(None)
+        while self.running and viewer.running:
+            header, payload, frame = read_frame(client_socket)
+            if header is None:
+                break
             
+            action = header.get('action')
+            if action == 'sync':
+                self.replay_screen_cache(viewer)
+            elif action == 'viewport':
+                tier = header.get('tier')
+                if tier in SCREEN_TIERS and viewer.set_tier(tier):
+                    # Catch up from the cache in the new tier; a hidden viewer receives nothing until it returns
+                    self.replay_screen_cache(viewer)
+                    self.update_screen_tiers()
+            elif action in ['frame', 'tiles']:
+                self.relay_screen_data(header, payload, frame, username)
+                if 'seq' in header:
+                    # Ack receipt so the presenter only captures again once the link has drained
+                    viewer.send_control(pack_frame({'type': 'screen_share', 'action': 'ack', 'seq': header['seq']}))
+    
+    def relay_screen_data(self, header, payload, frame, sender_username):
+        """Fan a keyframe or tile update out to every other screen channel viewing its tier.
+        Only the header is inspected; every viewer sends the same read-only view of the received frame."""
+        keyframe = header.get('action') == 'frame'
+        tier = header.get('tier', 'full')
+        self.update_screen_cache(tier, header, payload, frame, sender_username)
+        
+        with self.lock:
+            viewers = [v for u, v in self.screen_viewers.items() if u != sender_username and v.tier == tier]
+            presenter = self.screen_viewers.get(sender_username)
+            have_cache = tier in self.screen_cache
+        
+        congested = []
+        for viewer in viewers:
+            if not viewer.enqueue(frame, keyframe):
+                congested.append(viewer)
+        
+        if have_cache:
+            # Catch lagging or newly joined viewers up from the cache; the presenter isn't involved
+            for viewer in congested:
+                self.replay_screen_cache(viewer)
+        elif congested and presenter and time.time() - presenter.last_keyframe_request > 1.0:
+            # No keyframe seen yet; ask the presenter for one
+            presenter.last_keyframe_request = time.time()
+            presenter.send_control(pack_frame({'type': 'screen_share', 'action': 'keyframe_request', 'tier': tier}))
+    
+    def update_screen_tiers(self):
+        """Tell the presenter which tiers its viewers currently want, and drop the cache of any tier
+        nobody wants (it would be stale by the time someone switches back)."""
+        with self.lock:
+            presenter = self.screen_viewers.get(self.screen_presenter) if self.screen_presenter else None
+            tiers = sorted({v.tier for u, v in self.screen_viewers.items()
+                            if u != self.screen_presenter and v.tier != 'hidden'})
+            for tier in list(self.screen_cache):
+                if tier not in tiers:
+                    del self.screen_cache[tier]
+        if presenter:
+            presenter.send_control(pack_frame({'type': 'screen_share', 'action': 'tiers', 'tiers': tiers}))
+    
+    def update_screen_cache(self, tier, header, payload, frame, sender_username):
+        """Keep the presenter's latest keyframe plus every tile updated since, per tier, so the current
+        screen can be rebuilt for a late joiner without a new capture. Tiles are kept as views into their frames."""
+        with self.lock:
+            cache = self.screen_cache.get(tier)
+            if header.get('action') == 'frame':
+                self.screen_cache[tier] = {
+                    'username': sender_username,
+                    'keyframe': frame,
+                    'tiles': {},
+                    'width': header.get('width'),
+                    'height': header.get('height')
+                }
+            elif cache and cache['username'] == sender_username:
+                if (header.get('width'), header.get('height')) != (cache['width'], cache['height']):
+                    return
+                offset = 0
+                for x, y, length in header.get('tiles', []):
+                    cache['tiles'][(x, y)] = payload[offset:offset + length]
+                    offset += length
+    
+    def replay_screen_cache(self, viewer):
+        with self.lock:
+            cache = self.screen_cache.get(viewer.tier)
+            if not cache or cache['username'] == viewer.username:
+                return
+            keyframe = cache['keyframe']
+            tiles = list(cache['tiles'].items())
+            width, height = cache['width'], cache['height']
+        
+        viewer.enqueue(keyframe, keyframe=True)
+        if tiles:
+            viewer.enqueue(pack_frame({
+                'type': 'screen_share',
+                'action': 'tiles',
+                'tier': viewer.tier,
+                'username': cache['username'],
+                'width': width,
+                'height': height,
+                'tiles': [[x, y, len(tile)] for (x, y), tile in tiles]
+            }, b''.join(tile for _, tile in tiles)))
+    
+    def remove_screen_viewer(self, client_socket, username):
+        with self.lock:
+            viewer = self.screen_viewers.get(username)
+            if viewer and viewer.sock is client_socket:
+                del self.screen_viewers[username]
+            else:
+                viewer = None
+        if viewer:
+            viewer.stop()
+            print(f"Screen channel closed for {username}")
+            self.update_screen_tiers()
+        try:
+            client_socket.close()
+        except:
+            pass
+            
+    def send_to(self, client_socket, data):
+        """Send one message on a client's control connection. Returns False if it is gone.
+        Holds only that connection's send lock, never the server lock: messages sent from different
+        threads don't interleave on the wire, and a slow client doesn't hold up routing to the others."""
+        # A single dict lookup is atomic, so this needs no server lock
+        info = self.clients.get(client_socket)
+        if info is None:
+            return False
+        try:
+            with info['send_lock']:
+                client_socket.sendall(data)
+            return True
+        except OSError:
+            return False
+    
+    def send_to_user(self, username, data):
+        """Unicast by username, a lookup in the routing index whatever the size of the room."""
+        with self.lock:
+            client_socket = self.user_sockets.get(username)
+        return client_socket is not None and self.send_to(client_socket, data)
+    
+    def send_to_users(self, usernames, data):
+        """Multicast to the connected users among usernames. Returns how many it reached."""
+        with self.lock:
+            sockets = [self.user_sockets[username] for username in set(usernames) if username in self.user_sockets]
+        return sum(1 for client_socket in sockets if self.send_to(client_socket, data))
+    
+    def broadcast(self, data, exclude=()):
+        """Send to every client except the usernames in exclude. Returns how many it reached."""
+        with self.lock:
+            sockets = [s for s, info in self.clients.items() if info['username'] not in exclude]
+        return sum(1 for client_socket in sockets if self.send_to(client_socket, data))
+    
     def send_participant_list(self, client_socket):
         participants = []
         with self.lock:
@@ -219,10 +1168,7 @@ class ConferenceServer:
             'participants': participants
         })
         
-        try:
-            client_socket.send(message.encode('utf-8'))
-        except:
-            pass
+        self.send_to(client_socket, message.encode('utf-8'))
             
     def broadcast_participant_update(self):
         participants = []
@@ -239,12 +1185,7 @@ class ConferenceServer:
             'participants': participants
         })
         
-        with self.lock:
-            for client_socket in list(self.clients.keys()):
-                try:
-                    client_socket.send(message.encode('utf-8'))
-                except:
-                    pass
+        self.broadcast(message.encode('utf-8'))
                     
     def route_chat(self, sender_socket, message):
         with self.lock:
@@ -262,27 +1203,48 @@ class ConferenceServer:
             'recipient': recipient,
             'timestamp': time.time()
         }
+        try:
+            response['id'] = self.chat_log.append(sender_username, recipient, chat_message, response['timestamp'])['id']
+        except Exception as e:
+            print(f"Error logging chat: {e}")
         
         data = json.dumps(response).encode('utf-8')
         
         if recipient == 'everyone':
-            with self.lock:
-                for client_socket in list(self.clients.keys()):
-                    try:
-                        client_socket.send(data)
-                        print(f"Sent chat to {self.clients[client_socket]['username']}")
-                    except Exception as e:
-                        print(f"Error sending chat: {e}")
+            delivered = self.broadcast(data)
+            print(f"Sent chat to {delivered} participants")
         else:
-            with self.lock:
-                for client_socket, info in self.clients.items():
-                    if info['username'] == recipient or client_socket == sender_socket:
-                        try:
-                            client_socket.send(data)
-                            print(f"Sent private chat to {info['username']}")
-                        except Exception as e:
-                            print(f"Error sending private chat: {e}")
-                        
+            # The sender gets their own copy of a private message, unless they sent it to themselves
+            delivered = self.send_to_user(recipient, data)
+            if recipient != sender_username:
+                self.send_to(sender_socket, data)
+            print(f"Sent private chat to {recipient}" if delivered else f"Private chat recipient {recipient} not connected")
+    
+    def handle_chat_history(self, requester_socket, message):
+        """One page of the chat history this client can see, older than message id 'before' (the latest
+        page without it), optionally filtered by a search query or a participant."""
+        with self.lock:
+            username = self.clients.get(requester_socket, {}).get('username', 'Unknown')
+        before = message.get('before')
+        # A 'before' that isn't an id reads as 0, which no message is older than: an empty page
+        before_id = message_int(message, 'before', 0, 0) if before is not None else None
+        limit = message_int(message, 'limit', 50, 1, 200)
+        query = message.get('query')
+        query = query.strip() if isinstance(query, str) else ''
+        try:
+            messages, has_more = self.chat_log.history(username, before_id, limit, query or None, message.get('participant'))
+        except Exception as e:
+            print(f"Error reading chat history: {e}")
+            messages, has_more = [], False
+        if not self.send_to(requester_socket, json.dumps({
+            'type': 'chat_history',
+            'before': before,
+            'query': query,
+            'messages': messages,
+            'has_more': has_more
+        }).encode('utf-8')):
+            print(f"Error sending chat history to {username}")
+    
     def route_file(self, sender_socket, message):
         with self.lock:
             sender_username = self.clients.get(sender_socket, {}).get('username', 'Unknown')
@@ -292,96 +1254,346 @@ class ConferenceServer:
         data = json.dumps(message).encode('utf-8')
         
         if recipient == 'everyone':
-            with self.lock:
-                for client_socket in list(self.clients.keys()):
-                    if client_socket != sender_socket:
-                        try:
-                            client_socket.send(data)
-                        except:
-                            pass
+            self.broadcast(data, exclude={sender_username})
         else:
-            with self.lock:
-                for client_socket, info in self.clients.items():
-                    if info['username'] == recipient:
-                        try:
-                            client_socket.send(data)
-                        except:
-                            pass
+            self.send_to_user(recipient, data)
     
     def handle_file_upload(self, sender_socket, message):
+        """Whole file in one message (older clients); stored by content like any other upload."""
         import base64
         with self.lock:
             sender_username = self.clients.get(sender_socket, {}).get('username', 'Unknown')
         
-        filename = message.get('filename')
-        file_size = message.get('size', 0)
-        recipient = message.get('recipient', 'everyone')
-        
         try:
-            file_data = base64.b64decode(message['data'])
-            
-            # Store file
-            with self.lock:
-                self.files[filename] = {
-                    'data': file_data,
-                    'size': file_size,
-                    'uploaded_by': sender_username
-                }
-            
-            print(f"File {filename} uploaded by {sender_username} for {recipient} ({file_size} bytes)")
-            
-            # Notify recipients
-            notification = json.dumps({
-                'type': 'file_available',
-                'from': sender_username,
-                'filename': filename,
-                'size': file_size
-            }).encode('utf-8')
-            
-            with self.lock:
-                if recipient == 'everyone':
-                    # Notify all except sender
-                    for client_socket, info in self.clients.items():
-                        if info['username'] != sender_username:
-                            try:
-                                client_socket.send(notification)
-                            except:
-                                pass
-                else:
-                    # Notify only the specified recipient
-                    for client_socket, info in self.clients.items():
-                        if info['username'] == recipient:
-                            try:
-                                client_socket.send(notification)
-                            except:
-                                pass
+            file_hash = self.file_store.put_bytes(base64.b64decode(message['data']), sender_username)
+            self.publish_share(sender_socket, {
+                'hash': file_hash,
+                'filename': message.get('filename'),
+                'uploaded_by': sender_username,
+                'recipient': message.get('recipient', 'everyone')
+            })
         except Exception as e:
             print(f"Error handling file upload: {e}")
     
-    def handle_file_download(self, requester_socket, message):
+    def handle_file_offer(self, sender_socket, message):
+        """First step of an upload: the client names the content by hash and lists its chunk hashes.
+        Content the store already has is shared at once; otherwise only the missing chunks are requested."""
+        with self.lock:
+            sender_username = self.clients.get(sender_socket, {}).get('username', 'Unknown')
+        
+        file_hash = message.get('hash')
+        share = {
+            'hash': file_hash,
+            'filename': message.get('filename'),
+            'uploaded_by': sender_username,
+            'recipient': message.get('recipient', 'everyone'),
+            'socket': sender_socket
+        }
+        if message.get('relay'):
+            # Upload on behalf of receivers whose direct connection failed; no new announcement
+            share['relay'] = True
+        elif message.get('peer'):
+            self.handle_peer_offer(sender_socket, message, share)
+            return
+        try:
+            missing, ready = self.file_store.begin_upload(file_hash, message.get('chunks', []), message.get('size', 0), share)
+        except Exception as e:
+            print(f"Error starting upload of {file_hash}: {e}")
+            self.send_to(sender_socket, json.dumps({
+                'type': 'file_offer_reply', 'hash': file_hash, 'missing': [], 'error': str(e)
+            }).encode('utf-8'))
+            return
+        reply = {'type': 'file_offer_reply', 'hash': file_hash, 'missing': missing}
+        if missing:
+            # Missing chunks go up on a data connection opened with this token, as a delta
+            # against an earlier version of the file when the store has one
+            base = self.file_store.delta_base(file_hash, share['filename'], sender_username, message.get('base'))
+            reply['token'] = self.issue_transfer_token(sender_username, file_hash, 'upload', base)
+            if base:
+                reply['base'] = base
+        self.send_to(sender_socket, json.dumps(reply).encode('utf-8'))
+        if ready:
+            print(f"File {share['filename']} from {sender_username} already stored, sharing without upload")
+        for waiting in ready:
+            self.publish_share(waiting['socket'], waiting)
+    
+    def handle_peer_offer(self, sender_socket, message, share):
+        """Share served by the sender itself: record where receivers can fetch it and announce it.
+        Nothing is uploaded unless a receiver can't reach the sender (see handle_file_download)."""
+        with self.lock:
+            host = self.clients.get(sender_socket, {}).get('address', ('', 0))[0]
+            share.update({
+                'size': message.get('size', 0),
+                'host': host,
+                'port': message['peer'].get('port'),
+                'token': message['peer'].get('token'),
+                'peer': True
+            })
+            self.peer_shares[share['hash']] = {k: v for k, v in share.items() if k != 'socket'}
+        self.send_to(sender_socket, json.dumps({
+            'type': 'file_offer_reply',
+            'hash': share['hash'],
+            'missing': [],
+            'direct': True
+        }).encode('utf-8'))
+        self.publish_share(sender_socket, share)
+    
+    def handle_file_chunk(self, sender_socket, message):
         import base64
-        filename = message.get('filename')
+        file_hash = message.get('hash')
+        try:
+            waiting = self.file_store.put_chunk(file_hash, message.get('index', -1), base64.b64decode(message['data']))
+        except Exception as e:
+            print(f"Error storing chunk of {file_hash}: {e}")
+            return
+        for share in waiting or []:
+            self.publish_share(share['socket'], share)
+    
+    def publish_share(self, sender_socket, share):
+        """Record a share of stored content and tell the uploader and the recipients about it."""
+        share.pop('socket', None)
+        share = self.file_store.add_share(share)
+        if share.get('relay'):
+            self.serve_relay_requests(share['hash'])
+            return
+        sender_username = share['uploaded_by']
+        recipient = share['recipient']
+        print(f"File {share['filename']} shared by {sender_username} for {recipient} "
+              f"({share['size']} bytes, {share['hash'][:12]}{', direct' if share.get('peer') else ''})")
         
+        stored = json.dumps({
+            'type': 'file_stored',
+            'hash': share['hash'],
+            'filename': share['filename'],
+            'recipient': recipient
+        }).encode('utf-8')
+        notification = json.dumps({
+            'type': 'file_available',
+            'from': sender_username,
+            'filename': share['filename'],
+            'hash': share['hash'],
+            'size': share['size']
+        }).encode('utf-8')
+        
+        self.send_to(sender_socket, stored)
+        if recipient == 'everyone':
+            self.broadcast(notification, exclude={sender_username})
+        elif recipient != sender_username:
+            self.send_to_user(recipient, notification)
+    
+    def handle_file_catalog(self, requester_socket, message):
+        """One page of the files shared with this client, newest first (late joiners browse these)."""
         with self.lock:
-            if filename in self.files:
-                file_info = self.files[filename]
-                file_data = file_info['data']
-                
-                # Send file to requester
-                response = json.dumps({
-                    'type': 'file_transfer',
-                    'from': 'Server',
-                    'filename': filename,
-                    'data': base64.b64encode(file_data).decode('utf-8')
-                }).encode('utf-8')
-                
+            username = self.clients.get(requester_socket, {}).get('username', 'Unknown')
+        offset = message_int(message, 'offset', 0, 0)
+        limit = message_int(message, 'limit', 50, 1, 200)
+        files, has_more = self.file_store.catalog(username, offset, limit)
+        if not self.send_to(requester_socket, json.dumps({
+            'type': 'file_catalog',
+            'offset': offset,
+            'files': files,
+            'has_more': has_more
+        }).encode('utf-8')):
+            print(f"Error sending file catalog to {username}")
+    
+    def issue_transfer_token(self, username, file_hash, action, base=None):
+        token = secrets.token_hex(16)
+        now = time.time()
+        with self.lock:
+            self.transfer_tokens = {t: info for t, info in self.transfer_tokens.items() if info['expires'] > now}
+            self.transfer_tokens[token] = {
+                'username': username,
+                'hash': file_hash,
+                'action': action,
+                'base': base,
+                'expires': now + TRANSFER_TOKEN_TTL
+            }
+        return token
+    
+    def handle_file_download(self, requester_socket, message):
+        """Point the client at the sharer for a direct download, or hand out a one-time token for
+        fetching the content from the store on a data connection."""
+        file_hash = message.get('hash')
+        with self.lock:
+            username = self.clients.get(requester_socket, {}).get('username', 'Unknown')
+            peer = self.peer_shares.get(file_hash) if file_hash else None
+        if peer and not share_visible(peer, username):
+            # Someone else's private share: as if it didn't exist
+            peer = None
+        
+        if peer and not message.get('relay'):
+            if not self.send_to(requester_socket, json.dumps({
+                'type': 'file_download_ready',
+                'filename': message.get('filename') or peer['filename'],
+                'hash': file_hash,
+                'size': peer['size'],
+                'from': peer['uploaded_by'],
+                'peer': {'host': peer['host'], 'port': peer['port']},
+                'token': peer['token']
+            }).encode('utf-8')):
+                print(f"Error sending peer address to {username}")
+            return
+        
+        share = self.file_store.find_share(file_hash, message.get('filename'), username)
+        if share is None and peer:
+            self.request_relay_upload(requester_socket, username, peer)
+            return
+        if share is None:
+            print(f"File {file_hash or message.get('filename')} not found")
+            return
+        
+        token = self.issue_transfer_token(username, share['hash'], 'download')
+        if not self.send_to(requester_socket, json.dumps({
+            'type': 'file_download_ready',
+            'filename': message.get('filename') or share['filename'],
+            'hash': share['hash'],
+            'size': share['size'],
+            'from': share['uploaded_by'],
+            'token': token
+        }).encode('utf-8')):
+            print(f"Error sending download token to {username}")
+    
+    def request_relay_upload(self, requester_socket, username, peer):
+        """A receiver couldn't reach the sharer directly: have the sharer upload the file to the store,
+        then serve the receiver from there."""
+        print(f"Direct download of {peer['filename']} failed for {username}, relaying via server")
+        with self.lock:
+            waiting = self.relay_requests.setdefault(peer['hash'], [])
+            first = not waiting
+            waiting.append(requester_socket)
+        if first:
+            self.send_to_user(peer['uploaded_by'], json.dumps({
+                'type': 'file_upload_request',
+                'hash': peer['hash'],
+                'filename': peer['filename'],
+                'recipient': peer['recipient']
+            }).encode('utf-8'))
+    
+    def serve_relay_requests(self, file_hash):
+        with self.lock:
+            waiting = self.relay_requests.pop(file_hash, [])
+        for requester_socket in waiting:
+            self.handle_file_download(requester_socket, {'hash': file_hash, 'relay': True})
+    
+    def handle_data_channel(self, client_socket, username, token, codecs):
+        """One file transfer on its own connection, authorized by a one-time token.
+        Runs on the connection's own thread without the server lock, so transfers proceed in parallel."""
+        with self.lock:
+            grant = self.transfer_tokens.pop(token, None)
+        if grant is None or grant['username'] != username or grant['expires'] < time.time():
+            print(f"Rejected data connection from {username}: invalid token")
+            client_socket.sendall(pack_frame({'type': 'error', 'message': 'invalid token'}))
+            return
+        
+        client_socket.settimeout(None)
+        if grant['action'] == 'upload':
+            self.receive_upload(client_socket, username, grant['hash'], grant.get('base'))
+        else:
+            self.send_download(client_socket, username, grant['hash'], [c for c in codecs if c in COMPRESSION_CODECS])
+    
+    def send_download(self, client_socket, username, file_hash, codecs):
+        """A framed header, then the file bytes straight from the store: raw, or as one compressed
+        stream when the client accepts a codec and the start of the file looks compressible."""
+        paths = self.file_store.chunk_paths(file_hash)
+        if paths is None:
+            client_socket.sendall(pack_frame({'type': 'error', 'message': 'file not found'}))
+            return
+        try:
+            size = sum(os.path.getsize(path) for path in paths)
+            codec = None
+            if codecs and paths:
+                with open(paths[0], 'rb') as f:
+                    codec = choose_compression(f.read(COMPRESSION_SAMPLE), codecs)
+            
+            start = time.time()
+            header = {'type': 'file_data', 'hash': file_hash, 'size': size}
+            if codec:
+                header['codec'] = codec
+            client_socket.sendall(pack_frame(header))
+            sent = send_stream(client_socket, paths, codec)
+        finally:
+            self.file_store.release(file_hash)
+        elapsed = max(time.time() - start, 1e-6)
+        print(f"File {file_hash[:12]} downloaded by {username} ({size} bytes as {sent} {codec or 'raw'}, "
+              f"{size / elapsed / 1e6:.1f} MB/s)")
+    
+    def receive_upload(self, client_socket, username, file_hash, base=None):
+        """Store framed chunks ({'index', optional 'codec'} header, chunk payload) until the client
+        finishes sending, then confirm how many were stored.
+        With a base the ready frame carries the base's block signature, and the client may instead
+        send the whole file as a delta: {'copy': [first_block, count]} frames and {'literal': true,
+        optional 'codec'} frames with the bytes, in file order."""
+        base_paths = self.file_store.chunk_paths(base) if base else None
+        try:
+            ready = {'type': 'upload_ready', 'hash': file_hash, 'codecs': list(COMPRESSION_CODECS)}
+            payload = b''
+            assembler = None
+            if base_paths is not None:
+                block_size = block_size_for(sum(os.path.getsize(path) for path in base_paths))
+                payload = signature(base_paths, block_size)
+                ready.update({'base': base, 'block_size': block_size})
+                assembler = DeltaAssembler(self.file_store, file_hash, base_paths, block_size)
+            client_socket.sendall(pack_frame(ready, payload))
+            
+            stored = 0
+            received = 0
+            start = time.time()
+            while self.running:
+                header, payload, _ = read_frame(client_socket)
+                if header is None:
+                    break
+                received += len(payload)
                 try:
-                    requester_socket.send(response)
-                    print(f"File {filename} downloaded by {self.clients[requester_socket]['username']}")
+                    data = bytes(payload)
+                    if header.get('codec'):
+                        data = decompress_chunk(header['codec'], data)
+                    if assembler and 'copy' in header:
+                        waiting = assembler.copy(*header['copy'])
+                    elif assembler and header.get('literal'):
+                        waiting = assembler.literal(data)
+                    else:
+                        waiting = self.file_store.put_chunk(file_hash, header.get('index', -1), data)
+                        stored += 1
                 except Exception as e:
-                    print(f"Error sending file: {e}")
-            else:
-                print(f"File {filename} not found")
+                    print(f"Error storing chunk of {file_hash}: {e}")
+                    client_socket.sendall(pack_frame({'type': 'error', 'message': str(e)}))
+                    return
+                for share in waiting or []:
+                    self.publish_share(share['socket'], share)
+            if assembler:
+                # The end of the delta: store the last, partial chunk
+                try:
+                    waiting = assembler.finish()
+                except Exception as e:
+                    print(f"Error storing chunk of {file_hash}: {e}")
+                    client_socket.sendall(pack_frame({'type': 'error', 'message': str(e)}))
+                    return
+                for share in waiting or []:
+                    self.publish_share(share['socket'], share)
+        finally:
+            if base_paths is not None:
+                self.file_store.release(base)
+        if assembler:
+            stored += assembler.stored
+        client_socket.sendall(pack_frame({'type': 'upload_done', 'hash': file_hash, 'chunks': stored}))
+        elapsed = max(time.time() - start, 1e-6)
+        kind = f"as a delta against {base[:12]}, " if assembler and assembler.stored else ''
+        print(f"File {file_hash[:12]} uploaded by {username} ({kind}{received} bytes, {received / elapsed / 1e6:.1f} MB/s)")
+    
+    def print_stats(self):
+        for media_class, values in self.get_media_stats().items():
+            print(f"{media_class:>6}: forwarded={values['forwarded']} queued={values['queued']} "
+                  f"dropped={values['dropped']} rate_limited={values['rate_limited']} "
+                  f"delay avg={values['delay_avg_ms']:.1f} ms max={values['delay_max_ms']:.1f} ms")
+        files = self.file_store.stats()
+        with self.lock:
+            direct = len(self.peer_shares)
+        print(f" files: shares={files['shares']} direct={direct} contents={files['files']} chunks={files['chunks']} "
+              f"stored={files['stored_bytes']}/{files['max_bytes']} bytes for {files['shared_bytes']} bytes shared")
+        print(f"        hits={files['hits']} misses={files['misses']} evictions={files['evictions']} "
+              f"({files['evicted_bytes']} bytes) expired={files['expired']} rejected={files['rejected']} "
+              f"uploaders={files['users']}")
+        print(f"  chat: messages={self.chat_log.count()} room={self.chat_log.room}")
     
     def update_status(self, client_socket, message):
         with self.lock:
@@ -395,12 +1607,36 @@ class ConferenceServer:
         
     def remove_client(self, client_socket, username):
         with self.lock:
-            if client_socket in self.clients:
-                print(f"Client {username} disconnected")
+            disconnected = client_socket in self.clients
+            if disconnected:
                 del self.clients[client_socket]
+            if username and self.user_sockets.get(username) is client_socket:
+                del self.user_sockets[username]
             
             if username and username in self.username_to_udp:
                 del self.username_to_udp[username]
+            
+            if username:
+                self.speaker_levels.pop(username, None)
+                self.video_buckets.pop(username, None)
+                self.peer_shares = {h: share for h, share in self.peer_shares.items() if share['uploaded_by'] != username}
+                self.file_store.remove_peer_shares(username)
+                if username not in self.user_sockets:
+                    # Not reconnected on another socket: nothing will finish their uploads
+                    self.file_store.remove_uploads(username)
+            
+            presenter_left = username is not None and username == self.screen_presenter
+            if presenter_left:
+                self.screen_presenter = None
+                self.screen_cache = {}
+        
+        if disconnected:
+            print(f"Client {username} disconnected")
+        
+        if presenter_left:
+            self.broadcast_screen_share_tcp(json.dumps({
+                'type': 'screen_share', 'action': 'stop', 'username': username
+            }).encode('utf-8'), username)
         
         try:
             client_socket.close()
@@ -412,17 +1648,22 @@ class ConferenceServer:
     def stop(self):
         # Notify all clients that the server is shutting down
         shutdown_msg = json.dumps({'type': 'server_shutdown'}).encode('utf-8')
-        with self.lock:
-            for client_socket in list(self.clients.keys()):
-                try:
-                    client_socket.send(shutdown_msg)
-                except:
-                    pass
+        self.broadcast(shutdown_msg)
         
         # Give clients a moment to receive the message
         time.sleep(0.5)
         
         self.running = False
+        with self.media_ready:
+            self.media_ready.notify_all()
+        with self.lock:
+            viewers = list(self.screen_viewers.values())
+        for viewer in viewers:
+            viewer.stop()
+            try:
+                viewer.sock.close()
+            except:
+                pass
         with self.lock:
             for client_socket in list(self.clients.keys()):
                 try:
@@ -434,9 +1675,24 @@ class ConferenceServer:
             self.udp_socket.close()
         except:
             pass
+        self.chat_log.close()
+        if self.owned_chat_dir:
+            shutil.rmtree(self.owned_chat_dir, ignore_errors=True)
+        if self.owned_file_store:
+            shutil.rmtree(self.file_store.root, ignore_errors=True)
 
 if __name__ == "__main__":
-    server = ConferenceServer()
+    import argparse
+    parser = argparse.ArgumentParser(description="Conference relay server")
+    parser.add_argument('--data-dir', help="keep shared files and chat history here across restarts "
+                                           "(default: temp directories removed on exit)")
+    args = parser.parse_args()
+    if args.data_dir:
+        os.makedirs(args.data_dir, exist_ok=True)
+        server = ConferenceServer(file_store_dir=os.path.join(args.data_dir, 'files'),
+                                  chat_log_path=os.path.join(args.data_dir, 'chat_history.db'))
+    else:
+        server = ConferenceServer()
     print("\n" + "="*50)
     print("Conference Server Started")
     print("="*50)
@@ -444,6 +1700,7 @@ if __name__ == "__main__":
     print(f"UDP Port: 5556")
     print("\nPress Ctrl+C to stop the server")
     print("Or type 'quit' and press Enter")
+    print("Type 'stats' for relay statistics")
     print("="*50 + "\n")
     
     server_thread = threading.Thread(target=server.start)
@@ -462,12 +1719,16 @@ if __name__ == "__main__":
                         if cmd in ['quit', 'exit', 'q']:
                             print("\nShutting down server...")
                             break
+                        elif cmd == 'stats':
+                            server.print_stats()
                 else:
                     if select.select([sys.stdin], [], [], 1)[0]:
                         cmd = input().strip().lower()
                         if cmd in ['quit', 'exit', 'q']:
                             print("\nShutting down server...")
                             break
+                        elif cmd == 'stats':
+                            server.print_stats()
             except:
                 pass
             
@@ -0,0 +1,104 @@
+import hashlib
+import lzma
+import math
+import zlib
+
+# File transfer helpers shared by client and server.
+# Files are identified by the SHA-256 of their content and stored as fixed-size chunks,
+# each identified by its own SHA-256, so identical content is kept and sent only once.
+CHUNK_SIZE = 256 * 1024
+
+def hash_bytes(data):
+    return hashlib.sha256(data).hexdigest()
+
+def iter_file_chunks(path, chunk_size=CHUNK_SIZE):
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+def hash_file(path, chunk_size=CHUNK_SIZE):
+    """Return (file_hash, chunk_hashes, size) for a file, reading it one chunk at a time."""
+    file_hash = hashlib.sha256()
+    chunk_hashes = []
+    size = 0
+    for chunk in iter_file_chunks(path, chunk_size):
+        file_hash.update(chunk)
+        chunk_hashes.append(hash_bytes(chunk))
+        size += len(chunk)
+    return file_hash.hexdigest(), chunk_hashes, size
+
+def split_chunks(data, chunk_size=CHUNK_SIZE):
+    return [data[offset:offset + chunk_size] for offset in range(0, len(data), chunk_size)]
+
+# Transfer compression, chosen per file. Fast levels only: the aim is to beat the wire, not to archive.
+# zlib level 1 is the default; lzma preset 0 packs text tighter at a few times the CPU cost.
+COMPRESSION_CODECS = ('zlib', 'lzma')
+# Bytes of the first chunk sampled to decide whether a file is worth compressing
+COMPRESSION_SAMPLE = 64 * 1024
+# Above this many bits per byte the data is already compressed (zip, jpeg, mp4...) or random
+COMPRESSION_MAX_ENTROPY = 7.2
+
+def byte_entropy(data):
+    """Shannon entropy of a byte string, in bits per byte (0 to 8)."""
+    if not data:
+        return 0.0
+    total = len(data)
+    counts = [data.count(value) for value in range(256)]
+    return -sum(count / total * math.log2(count / total) for count in counts if count)
+
+def choose_compression(sample, codecs=COMPRESSION_CODECS):
+    """First of codecs to compress a file with, judging by a sample of it, or None to send it as is."""
+    if not codecs or byte_entropy(bytes(sample[:COMPRESSION_SAMPLE])) > COMPRESSION_MAX_ENTROPY:
+        return None
+    return codecs[0]
+
+def compressor(codec):
+    """Streaming compressor with compress(data) and flush()."""
+    if codec == 'zlib':
+        return zlib.compressobj(1)
+    if codec == 'lzma':
+        return lzma.LZMACompressor(preset=0)
+    raise ValueError(f"unknown compression {codec}")
+
+def decompressor(codec):
+    """Streaming decompressor with decompress(data, max_length) and eof."""
+    if codec == 'zlib':
+        return zlib.decompressobj()
+    if codec == 'lzma':
+        return lzma.LZMADecompressor()
+    raise ValueError(f"unknown compression {codec}")
+
+def compress_chunk(codec, data):
+    stream = compressor(codec)
+    return stream.compress(data) + stream.flush()
+
+def decompress_chunk(codec, data, max_size=CHUNK_SIZE):
+    """Decompress one independently compressed chunk, refusing to inflate past max_size."""
+    stream = decompressor(codec)
+    output = stream.decompress(data, max_size + 1)
+    if not stream.eof or len(output) > max_size:
+        raise ValueError("compressed chunk is truncated or too large")
+    return output
+
+def send_stream(sock, paths, codec=None):
+    """Send the concatenation of files on a socket: raw with sendfile (zero-copy where the OS has it),
+    or as one compressed stream. Returns the number of bytes put on the wire."""
+    if not codec:
+        sent = 0
+        for path in paths:
+            with open(path, 'rb') as f:
+                sent += sock.sendfile(f)
+        return sent
+    stream = compressor(codec)
+    sent = 0
+    for path in paths:
+        for chunk in iter_file_chunks(path):
+            data = stream.compress(chunk)
+            sock.sendall(data)
+            sent += len(data)
+    data = stream.flush()
+    sock.sendall(data)
+    return sent + len(data)